@@ -6,8 +6,8 @@ import tqdm
 from PIL import Image
 
 from kernel.logging_utility import log_report
-from kernel.geometry import _pose2Rotation, _rotation2Pose
-from kernel.scale import _parseImagesFile, _parsePoints3D, _scaleFordepth, _calculateDepth
+from kernel.pose_utility import pose2matrix, matrix2pose
+from kernel.scale import _readColmapArrays, _scaleForDepthArrays, _calculateDepthArrays
 from kernel.utility import _transstring2trans,  _trans2transstring
 
 
@@ -70,12 +70,18 @@ def _get_obj_insameworkspace(obj, types):
         return []
 
 def _apply_trans2obj(obj, trans):
-    origin_pose = [list(obj.location), list(obj.rotation_quaternion)]
-    origin_trans = _pose2Rotation(origin_pose)
-    after_align_trans = trans.dot(origin_trans)
-    after_align_pose = _rotation2Pose(after_align_trans)
-    obj.location = after_align_pose[0]
-    obj.rotation_quaternion = after_align_pose[1]/np.linalg.norm(after_align_pose[1])
+    _apply_trans2objs([obj], trans)
+
+def _apply_trans2objs(objs, trans):
+    if len(objs) == 0:
+        return
+    ## all the objects converted at once, (x, y, z, qw, qx, qy, qz)
+    origin_poses = np.array([list(obj.location) + list(obj.rotation_quaternion) for obj in objs])
+    after_align_poses = matrix2pose(np.matmul(trans, pose2matrix(origin_poses)))
+    after_align_poses[:, 3:] = after_align_poses[:, 3:] / np.linalg.norm(after_align_poses[:, 3:], axis = 1, keepdims = True)
+    for obj, after_align_pose in zip(objs, after_align_poses):
+        obj.location = after_align_pose[:3].tolist()
+        obj.rotation_quaternion = after_align_pose[3:]
 
 def _get_allrgb_insameworkspace(config):
     im_list = []
@@ -129,31 +135,17 @@ def _initreconpose(config):
 def _align_reconstruction(config, scene, THRESHOLD = 0.01, NUM_THRESHOLD = 5):
     filepath = config.reconstructionsrc
 
-    imagefilepath = os.path.join(filepath, "images.txt")
-    points3Dpath = os.path.join(filepath, "points3D.txt")
     datapath = config.datasrc  
 
-    intrinsic = np.array([
-        [config.fx, 0, config.cx],
-        [0, config.fy, config.cy],
-        [0, 0, 1],
-    ])
-
     depth_scale = config.depth_scale
 
-    Camera_dict = {}
-    PointsDict = {}
-    PointsDepth = {}
-    _parseImagesFile(imagefilepath, Camera_dict, PointsDict)
-    _parsePoints3D(points3Dpath, PointsDict)
+    ## the binary model of the mapper when it is there, else the text export
+    cameras, observations, points = _readColmapArrays(filepath)
     print("Auto Aligning the scale:....")
-    for camera_idx in tqdm.tqdm(Camera_dict):
-            rgb_name = Camera_dict[camera_idx]["name"]
-            with Image.open(os.path.join(datapath, "depth", rgb_name)) as im:
-                depth = np.array(im) * depth_scale
-                _scaleFordepth(depth, camera_idx, intrinsic, Camera_dict, PointsDict, PointsDepth, POSE_INVERSE = config.inverse_pose)
+    point, _, scales = _scaleForDepthArrays(cameras, observations, points, os.path.join(datapath, "depth"), depth_scale, 
+                                            POSE_INVERSE = config.inverse_pose, progress = tqdm.tqdm)
         
-    scale = _calculateDepth(THRESHOLD = THRESHOLD, NUM_THRESHOLD = NUM_THRESHOLD, PointsDepth = PointsDepth)
+    scale = _calculateDepthArrays(THRESHOLD = THRESHOLD, NUM_THRESHOLD = NUM_THRESHOLD, point = point, scale = scales)
     print("The scale is : {0}".format(scale))
     return scale
 
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+from kernel.pose_utility import pose2matrix, matrix2pose
+
+CAMPOSE_HEADER = "# IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME\n\n"
+
+
+class CamPoses:
+    """
+    Columnar content of a campose.txt, one row per camera
+        ids: [N] image ids
+        quaternions: [N, 4] (qw, qx, qy, qz)
+        translations: [N, 3] (tx, ty, tz)
+        camera_ids: [N] camera ids
+        names: list of N image names
+    """
+    def __init__(self, ids, quaternions, translations, camera_ids, names):
+        self.ids = ids
+        self.quaternions = quaternions
+        self.translations = translations
+        self.camera_ids = camera_ids
+        self.names = names
+
+    def __len__(self):
+        return len(self.names)
+
+    def poses(self):
+        ## [N, 7] (x, y, z, qw, qx, qy, qz), the layout of kernel.pose_utility
+        return np.concatenate([self.translations, self.quaternions], axis = 1)
+
+    def matrices(self):
+        return pose2matrix(self.poses())
+
+    def select(self, indices):
+        indices = np.asarray(indices, dtype = np.int64)
+        return CamPoses(self.ids[indices], self.quaternions[indices], self.translations[indices],
+                        self.camera_ids[indices], [self.names[i] for i in indices])
+
+
+def _sidecar_path(path):
+    ## hidden next to the campose file, e.g. .campose.txt.npz
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".npz")
+
+
+def _save_sidecar(path, camposes):
+    stat = os.stat(path)
+    sidecar = _sidecar_path(path)
+    ## one temporary file per process, the worker processes all read the campose file at once
+    tmp = "{0}.{1}.tmp".format(sidecar, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            np.savez(f, mtime_ns = stat.st_mtime_ns, size = stat.st_size, ids = camposes.ids, quaternions = camposes.quaternions,
+                     translations = camposes.translations, camera_ids = camposes.camera_ids, names = np.array(camposes.names, dtype = str))
+        os.replace(tmp, sidecar)
+    except OSError:
+        ## the cache is optional, e.g. the reconstruction folder could be read only
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _load_sidecar(path):
+    sidecar = _sidecar_path(path)
+    if not os.path.exists(sidecar):
+        return None
+    stat = os.stat(path)
+    try:
+        with np.load(sidecar) as data:
+            if int(data["mtime_ns"]) != stat.st_mtime_ns or int(data["size"]) != stat.st_size:
+                return None
+            return CamPoses(data["ids"], data["quaternions"], data["translations"], data["camera_ids"], data["names"].tolist())
+    except Exception:
+        ## any unreadable sidecar (e.g. truncated, BadZipFile or EOFError) is parsed again from the text
+        return None
+
+
+def _parse_campose(text):
+    ## the camera lines start with a numeric image id, fields 1-7 are the pose and the name is the last field,
+    ## CAMERA_ID (field 8) is optional and there could be more fields before the name
+    lines = [l.split() for l in text.split("\n") if l.split(" ", 1)[0].isnumeric()]
+    for l in lines:
+        if len(l) < 9:
+            raise ValueError("Campose line without pose or name: " + " ".join(l))
+    names = [l[-1] for l in lines]
+    values = np.array(" ".join(" ".join(l[1:8]) for l in lines).split(), dtype = np.float64).reshape(-1, 7)
+    ids = np.array([int(l[0]) for l in lines], dtype = np.int64)
+    camera_ids = np.array([int(l[8]) if len(l) > 9 and l[8].isnumeric() else 1 for l in lines], dtype = np.int64)
+    return CamPoses(ids, values[:, :4], values[:, 4:], camera_ids, names)
+
+
+def read_campose(path, CACHE = True):
+    """
+    Read a campose.txt (COLMAP images.txt layout without the point lines) into columnar arrays
+    Args:
+        path: path of the campose file
+        CACHE: keep the parsed arrays in a .npz sidecar, reused while the campose file is not modified
+    Returns:
+        CamPoses
+    """
+    if CACHE:
+        camposes = _load_sidecar(path)
+        if camposes is not None:
+            return camposes
+    with open(path, "r") as f:
+        camposes = _parse_campose(f.read())
+    if CACHE:
+        _save_sidecar(path, camposes)
+    return camposes
+
+
+def write_campose(path, poses, names, ids = None, camera_id = 1, CACHE = True):
+    """
+    Write the camera poses into a campose file with a single buffered write
+    Args:
+        path: path of the campose file
+        poses: [N, 4, 4] transformations or [N, 7] poses (x, y, z, qw, qx, qy, qz)
+        names: list of N image names
+        ids: [N] image ids, default 1 to N
+        camera_id: camera id of all the images
+        CACHE: also write the .npz sidecar of read_campose
+    """
+    poses = np.asarray(poses, dtype = np.float64)
+    if poses.ndim == 3:
+        poses = matrix2pose(poses)
+    poses = poses.reshape(-1, 7)
+    if ids is None:
+        ids = np.arange(1, len(names) + 1)
+    ids = np.asarray(ids, dtype = np.int64)
+    lines = ["{0} {1} {2} {3} {4} {5} {6} {7} {8} {9}\n".format(idx, *pose[3:], *pose[:3], camera_id, name)
+             for idx, pose, name in zip(ids.tolist(), poses.tolist(), names)]
+    with open(path, "w") as f:
+        f.write(CAMPOSE_HEADER + "".join(lines))
+    if CACHE:
+        _save_sidecar(path, CamPoses(ids, poses[:, 3:].copy(), poses[:, :3].copy(), np.full(len(ids), camera_id, dtype = np.int64), list(names)))
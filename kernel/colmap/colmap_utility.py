@@ -0,0 +1,119 @@
+import os
+import mmap
+import struct
+import numpy as np
+
+## number of parameters of the COLMAP camera models, indexed by model id
+CAMERA_MODEL_NUM_PARAMS = {
+    0: 3,   # SIMPLE_PINHOLE
+    1: 4,   # PINHOLE
+    2: 4,   # SIMPLE_RADIAL
+    3: 5,   # RADIAL
+    4: 8,   # OPENCV
+    5: 8,   # OPENCV_FISHEYE
+    6: 12,  # FULL_OPENCV
+    7: 5,   # FOV
+    8: 4,   # SIMPLE_RADIAL_FISHEYE
+    9: 5,   # RADIAL_FISHEYE
+    10: 12, # THIN_PRISM_FISHEYE
+}
+
+CAMERA_DTYPE = np.dtype([("id", "<i4"), ("model", "<i4"), ("width", "<u8"), ("height", "<u8")])
+IMAGE_DTYPE = np.dtype([("id", "<u4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<u4")])
+POINT2D_DTYPE = np.dtype([("x", "<f8"), ("y", "<f8"), ("point3D_id", "<i8")])
+POINT3D_DTYPE = np.dtype([("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3), ("error", "<f8"), ("track_length", "<u8")])
+
+
+def _map_file(path):
+    ## memory mapped when possible, the arrays returned by np.frombuffer are views of the file
+    with open(path, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            ## empty files could not be mapped
+            return f.read()
+
+
+def find_binary_model(path):
+    """
+    Folder with images.bin and points3D.bin, the model itself or its first sub-model "0" written by the mapper, None if there is none
+    """
+    for folder in [path, os.path.join(path, "0")]:
+        if os.path.exists(os.path.join(folder, "images.bin")) and os.path.exists(os.path.join(folder, "points3D.bin")):
+            return folder
+    return None
+
+
+def read_cameras_binary(path):
+    """
+    Returns:
+        cameras: structured array (id, model, width, height)
+        params: list of the parameter arrays of the cameras
+    """
+    buffer = _map_file(path)
+    num_cameras, = struct.unpack_from("<Q", buffer, 0)
+    cameras = np.empty(num_cameras, dtype = CAMERA_DTYPE)
+    params = []
+    offset = 8
+    for i in range(num_cameras):
+        cameras[i] = np.frombuffer(buffer, dtype = CAMERA_DTYPE, count = 1, offset = offset)[0]
+        offset += CAMERA_DTYPE.itemsize
+        num_params = CAMERA_MODEL_NUM_PARAMS[int(cameras[i]["model"])]
+        params.append(np.frombuffer(buffer, dtype = "<f8", count = num_params, offset = offset))
+        offset += 8 * num_params
+    return cameras, params
+
+
+def read_images_binary(path):
+    """
+    Returns:
+        images: structured array (id, qvec (qw, qx, qy, qz), tvec, camera_id) in the file order
+        names: list of the image names
+        observations: structured array (image, x, y, point3D_id) of all the 2D points, image is the index in images,
+                      point3D_id is -1 for the points without 3D point
+    """
+    buffer = _map_file(path)
+    num_images, = struct.unpack_from("<Q", buffer, 0)
+    images = np.empty(num_images, dtype = IMAGE_DTYPE)
+    names = []
+    points2D = []
+    offset = 8
+    for i in range(num_images):
+        images[i] = np.frombuffer(buffer, dtype = IMAGE_DTYPE, count = 1, offset = offset)[0]
+        offset += IMAGE_DTYPE.itemsize
+        name_end = buffer.find(b"\0", offset)
+        names.append(buffer[offset:name_end].decode("utf-8"))
+        offset = name_end + 1
+        num_points2D, = struct.unpack_from("<Q", buffer, offset)
+        offset += 8
+        points2D.append(np.frombuffer(buffer, dtype = POINT2D_DTYPE, count = num_points2D, offset = offset))
+        offset += POINT2D_DTYPE.itemsize * num_points2D
+    observations = np.empty(sum(len(p) for p in points2D), dtype = [("image", "<i8")] + POINT2D_DTYPE.descr)
+    if len(observations) > 0:
+        observations["image"] = np.repeat(np.arange(num_images), [len(p) for p in points2D])
+        for field in POINT2D_DTYPE.names:
+            observations[field] = np.concatenate([p[field] for p in points2D])
+    return images, names, observations
+
+
+def read_points3D_binary(path):
+    """
+    Returns:
+        points: structured array (id, xyz, rgb, error, track_length) in the file order, the tracks are skipped
+    """
+    buffer = _map_file(path)
+    num_points, = struct.unpack_from("<Q", buffer, 0)
+    ## every record is the fixed part followed by track_length (image_id, point2D_idx) pairs of 8 bytes
+    offsets = np.empty(num_points, dtype = np.int64)
+    offset = 8
+    fixed = POINT3D_DTYPE.itemsize
+    track_length = POINT3D_DTYPE.fields["track_length"][1]
+    for i in range(num_points):
+        offsets[i] = offset
+        offset += fixed + 8 * struct.unpack_from("<Q", buffer, offset + track_length)[0]
+    ## gather the fixed parts of the records block-wise, bounding the size of the index arrays
+    data = np.frombuffer(buffer, dtype = np.uint8)
+    records = np.empty((num_points, fixed), dtype = np.uint8)
+    for start in range(0, num_points, 65536):
+        records[start:start + 65536] = data[offsets[start:start + 65536, None] + np.arange(fixed)]
+    return records.view(POINT3D_DTYPE).reshape(-1)
@@ -50,6 +50,9 @@ def _createbgpyrender(image, segement, dirpath, perfix):
     img.save(colorfileName)
 
 def _createrbg(image, model, dirpath, perfix, T, intrinsic):
+    ## model: [N, 4] homogeneous vertices or the path of the model file
+    if isinstance(model, str):
+        model = _loadModel(model)
     segement = _render(image, T, intrinsic, model)
     colorfileName = os.path.join(dirpath, perfix + ".png")
     img = Image.fromarray(segement.astype(np.uint8))
@@ -0,0 +1,61 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+def _read_frame(color_path, depth_path, depth_scale, depth_ignore):
+    color_im = np.array(Image.open(color_path))
+    depth_im = np.multiply(np.asarray(Image.open(depth_path)), depth_scale, dtype=np.float32)
+    depth_im[depth_im > depth_ignore] = 0
+    return color_im, depth_im
+
+
+class FrameReader:
+    """
+    Decode rgb and depth frames ahead of the consumer on a thread pool, the frames are yielded in order as
+    (color, depth) with the depth in meter and 0 beyond depth_ignore
+        paths: list of (color_path, depth_path)
+        depth_scale: depth unit in meter
+        depth_ignore: maximal valid depth in meter
+        lookahead: maximal number of frames decoded ahead, bounds the memory
+    """
+    def __init__(self, paths, depth_scale, depth_ignore, lookahead = 8, num_threads = None):
+        self.paths = list(paths)
+        self.depth_scale = depth_scale
+        self.depth_ignore = depth_ignore
+        self.lookahead = max(1, lookahead)
+        if num_threads is None:
+            num_threads = min(4, os.cpu_count() or 1)
+        self.num_threads = num_threads
+
+    @classmethod
+    def from_names(cls, datasrc, names, depth_scale, depth_ignore, **kwargs):
+        ## frames named the same in <datasrc>/rgb and <datasrc>/depth
+        paths = [(os.path.join(datasrc, "rgb", name), os.path.join(datasrc, "depth", name)) for name in names]
+        return cls(paths, depth_scale, depth_ignore, **kwargs)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers = self.num_threads)
+        pending = deque()
+        paths = iter(self.paths)
+        try:
+            for color_path, depth_path in paths:
+                pending.append(executor.submit(_read_frame, color_path, depth_path, self.depth_scale, self.depth_ignore))
+                if len(pending) >= self.lookahead:
+                    break
+            while pending:
+                frame = pending.popleft().result()
+                for color_path, depth_path in paths:
+                    pending.append(executor.submit(_read_frame, color_path, depth_path, self.depth_scale, self.depth_ignore))
+                    break
+                yield frame
+        finally:
+            ## the consumer could stop early, drop the frames not decoded yet
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait = True)
@@ -4,6 +4,7 @@ from PIL import Image
 import tqdm
 import os
 from scipy.spatial.transform import Rotation as R
+from kernel.model_utility import load_model_arrays
 
 def _pose2Rotation(pose):
     x, y, z = pose[0]
@@ -62,6 +63,30 @@ def _rotation2Pose(rotation):
     location = rotation[:3, 3]
     return [[float(location[0]), float(location[1]), float(location[2])], [float(qw), float(qx), float(qy), float(qz)]]
 
+
+def _interpolatePoses(T0, T1, t):
+    """
+    Interpolate the rigid transformations batch-wise, rotation by slerp and translation linearly
+    Args:
+        T0: [N, 4, 4] poses at t = 0
+        T1: [N, 4, 4] poses at t = 1
+        t: [N] interpolation parameters in [0, 1]
+    Returns:
+        [N, 4, 4] interpolated poses
+    """
+    T0 = np.asarray(T0, dtype = np.float64)
+    T1 = np.asarray(T1, dtype = np.float64)
+    t = np.asarray(t, dtype = np.float64)
+    R0 = R.from_matrix(T0[:, :3, :3])
+    R1 = R.from_matrix(T1[:, :3, :3])
+    ## slerp is the shortest geodesic R0 * exp(t * log(R0^-1 * R1))
+    delta = (R0.inv() * R1).as_rotvec()
+    T = np.zeros((len(t), 4, 4))
+    T[:, :3, :3] = (R0 * R.from_rotvec(delta * t[:, None])).as_matrix()
+    T[:, :3, 3] = (1 - t[:, None]) * T0[:, :3, 3] + t[:, None] * T1[:, :3, 3]
+    T[:, 3, 3] = 1
+    return T
+
 def _render(image, pose, intrinsic, model):
     homoP = np.dot(pose[0:3, :], model.T)
     homoP = homoP / homoP[2]
@@ -83,31 +108,101 @@ def _render(image, pose, intrinsic, model):
     return segimage
 
 def _loadModel(modelPath):
-    ## load vertex from .obj
-    pointCloud = []
-    f = open(modelPath, "r")
-    line = f.readline()
-    while line:
-        if line.startswith("v "):
-            line = line.replace("\n", "")
-            point = line.split(" ")[1:]
-            pointCloud.append([float(point[i]) for i in range(3)] + [1.])
-        else:
-            pass
-        line = f.readline()
-    return np.array(pointCloud)
+    ## [N, 4] homogeneous vertices of the model, read from its binary cache entry
+    vertices, _, _ = load_model_arrays(modelPath)
+    return np.concatenate([vertices, np.ones((len(vertices), 1), dtype = np.float32)], axis = 1).astype(np.float64)
+
+def _planeHypotheses(pts, indices):
+    """
+    Args:
+        pts: [N, 3] points
+        indices: [K, n] indices of the n >= 3 points of each hypothesis
+    Returns:
+        [K, 3] unit normals and [K] offsets of the planes n.x + d = 0, normal 0 for degenerate samples
+    """
+    samples = pts[indices]
+    if indices.shape[1] == 3:
+        normals = np.cross(samples[:, 1] - samples[:, 0], samples[:, 2] - samples[:, 0])
+    else:
+        ## least squares plane of each sample, the singular vector of the smallest singular value
+        normals = np.linalg.svd(samples - samples.mean(axis = 1, keepdims = True))[2][:, -1]
+    norms = np.linalg.norm(normals, axis = 1)
+    valid = norms > 1e-12
+    normals[valid] /= norms[valid, None]
+    normals[~valid] = 0
+    offsets = -np.einsum("ij,ij->i", normals, samples[:, 0])
+    return normals, offsets
+
+def ransac_plane(pts, threshold, n = 3, max_iterations = 1000, confidence = 0.999, early_stop_ratio = 1.0, 
+                 num_scoring = 20000, block_size = 64, seed = None):
+    """
+    RANSAC plane fitting with the hypotheses scored block-wise, each block of hypotheses is one matrix product with a
+    random subsample of the points, the best plane is refined by least squares on its inliers in the full cloud
+    Args:
+        pts: [N, 3] points
+        threshold: inlier distance to the plane
+        n: number of points sampled for each hypothesis
+        max_iterations: maximal number of hypotheses
+        confidence: stop when a better plane is found with probability below 1 - confidence
+        early_stop_ratio: stop when the inlier ratio of the best plane is above it
+        num_scoring: number of points the hypotheses are scored on
+        block_size: number of hypotheses scored at once
+    Returns:
+        [a, b, c, d] of the plane ax + by + cz + d = 0 with a unit normal and the indices of its inliers
+    """
+    pts = np.asarray(pts, dtype = np.float64)
+    num_pts = len(pts)
+    if num_pts < n:
+        raise ValueError("Need at least {0} points to fit a plane, got {1}".format(n, num_pts))
+    rng = np.random.default_rng(seed)
+    ## drawn with replacement, a permutation of a large cloud costs more than the whole scoring
+    scoring = pts if num_pts <= num_scoring else pts[rng.integers(0, num_pts, size = num_scoring)]
+
+    best_count = 0
+    best_normal, best_offset = None, None
+    iterations = 0
+    required = max_iterations
+    while iterations < min(required, max_iterations):
+        k = min(block_size, max_iterations - iterations)
+        normals, offsets = _planeHypotheses(pts, rng.integers(0, num_pts, size = (k, n)))
+        counts = np.count_nonzero(np.abs(scoring @ normals.T + offsets) < threshold, axis = 0)
+        ## degenerate samples have a zero normal and would count every point
+        counts[~normals.any(axis = 1)] = 0
+        iterations += k
+        best = np.argmax(counts)
+        if counts[best] > best_count:
+            best_count = counts[best]
+            best_normal, best_offset = normals[best], offsets[best]
+            ratio = best_count / len(scoring)
+            if ratio >= early_stop_ratio:
+                break
+            ## number of samples to draw an all-inlier sample with the probability of confidence
+            if ratio >= 1:
+                required = iterations
+            else:
+                required = np.log(1 - confidence) / np.log(max(1 - ratio ** n, 1e-12))
+    if best_normal is None:
+        raise ValueError("All the sampled points are collinear")
+
+    ## least squares refinement on the inliers of the whole cloud
+    inliers = np.nonzero(np.abs(pts @ best_normal + best_offset) < threshold)[0]
+    if len(inliers) >= 3:
+        inlier_pts = pts[inliers]
+        center = inlier_pts.mean(axis = 0)
+        ## eigenvector of the smallest eigenvalue of the 3x3 scatter matrix
+        normal = np.linalg.eigh(inlier_pts.T @ inlier_pts / len(inliers) - np.outer(center, center))[1][:, 0]
+        if normal @ best_normal < 0:
+            normal = -normal
+        best_normal, best_offset = normal, -normal @ center
+        inliers = np.nonzero(np.abs(pts @ best_normal + best_offset) < threshold)[0]
+    return [*best_normal.tolist(), float(best_offset)], inliers
 
 def plane_alignment(filepath, scale, alignT, threshold, n, iteration):
     pcd = o3d.io.read_point_cloud(filepath)
     scaled_xyz = (alignT[:3, :3].dot(np.asarray(pcd.points).T * scale) + alignT[:3, [3]]).T 
-    scaled_pcd = o3d.geometry.PointCloud()
-    scaled_pcd.points = o3d.utility.Vector3dVector(scaled_xyz)
-    plane_model, inliers = scaled_pcd.segment_plane(distance_threshold=threshold,
-                                         ransac_n=n,
-                                         num_iterations=iteration)
+    plane_model, inliers = ransac_plane(scaled_xyz, threshold, n = n, max_iterations = iteration)
     [a, b, c, d] = plane_model
-    plane_cloud = scaled_pcd.select_by_index(inliers)
-    plane_xyz = np.asarray(plane_cloud.points)
+    plane_xyz = scaled_xyz[inliers]
     plane_center = np.mean(plane_xyz, axis = 0)
     plane_center[2] = -(a * plane_center[0] + b * plane_center[1] + d)/c
     
@@ -29,7 +29,7 @@ def get_config(camera='uw'):
 
     return config
 
-def set_config(resX, resY, fx, fy, cx, cy, tsdf_voxel_size, tsdf_trunc_margin, pcd_voxel_size):
+def set_config(resX, resY, fx, fy, cx, cy, tsdf_voxel_size, tsdf_trunc_margin, pcd_voxel_size, tsdf_backend='auto', icp_method='multiscale'):
     config = dict()
     config['im_w'] = resX
     config['im_h'] = resY
@@ -41,6 +41,8 @@ def set_config(resX, resY, fx, fy, cx, cy, tsdf_voxel_size, tsdf_trunc_margin, p
     config['tsdf_voxel_size'] = tsdf_voxel_size  # in meter
     config['tsdf_trunc_margin'] = tsdf_trunc_margin # in meter
     config['pcd_voxel_size'] = pcd_voxel_size  # in meter
+    config['tsdf_backend'] = tsdf_backend  # "cuda", "cpu", "hash" or "auto"
+    config['icp_method'] = icp_method  # "multiscale" (open3d) or "projective"
 
     return config          
 
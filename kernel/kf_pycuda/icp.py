@@ -0,0 +1,257 @@
+import numpy as np
+import scipy.linalg as la
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def _halve_depth(depth, depth_jump):
+    h, w = depth.shape[0] // 2, depth.shape[1] // 2
+    coarse = np.zeros((h, w), dtype=np.float32)
+    for v in prange(h):
+        for u in range(w):
+            closest = np.inf
+            for dv in range(2):
+                for du in range(2):
+                    d = depth[2*v + dv, 2*u + du]
+                    if d > 0 and d < closest:
+                        closest = d
+            total = 0.0
+            count = 0
+            for dv in range(2):
+                for du in range(2):
+                    d = depth[2*v + dv, 2*u + du]
+                    if d > 0 and d - closest < depth_jump:
+                        total += d
+                        count += 1
+            if count > 0:
+                coarse[v, u] = total / count
+    return coarse
+
+
+def depth_pyramid(depth_im, cam_intr, num_levels=3, depth_trunc=1.5, depth_jump=0.03):
+    """halve the depth image num_levels - 1 times
+
+    Args:
+        depth_im (np.ndarray): [(H, W) depth in meter, 0 for invalid]
+        cam_intr (np.ndarray): [(3, 3) intrinsic of the full resolution]
+        num_levels (int): [number of levels]
+        depth_trunc (float): [depth beyond this is invalid, same as create_pcd]
+        depth_jump (float): [a coarse pixel averages the fine pixels within depth_jump of the closest one, no flying pixels on edges]
+
+    Returns:
+        [list]: [(depth, intrinsic) from the full resolution to the coarsest level]
+    """
+    depth = np.where(depth_im > depth_trunc, 0, depth_im).astype(np.float32)
+    pyramid = [(depth, np.asarray(cam_intr, dtype=np.float64))]
+    for _ in range(num_levels - 1):
+        depth, intr = pyramid[-1]
+        coarse_intr = intr.copy()
+        ## pixel centers of the 2x2 block
+        coarse_intr[0, 0] /= 2
+        coarse_intr[1, 1] /= 2
+        coarse_intr[0, 2] = (intr[0, 2] - 0.5) / 2
+        coarse_intr[1, 2] = (intr[1, 2] - 0.5) / 2
+        pyramid.append((_halve_depth(depth, depth_jump), coarse_intr))
+    return pyramid
+
+
+@njit(parallel=True, cache=True)
+def _vertex_normal_map(depth_im, fx, fy, cx, cy, vertices, normals, valid):
+    h, w = depth_im.shape
+    for v in prange(h):
+        for u in range(w):
+            d = depth_im[v, u]
+            vertices[v, u, 0] = (u - cx) / fx * d
+            vertices[v, u, 1] = (v - cy) / fy * d
+            vertices[v, u, 2] = d
+    for v in prange(1, h - 1):
+        for u in range(1, w - 1):
+            if depth_im[v, u] == 0 or depth_im[v, u + 1] == 0 or depth_im[v, u - 1] == 0 or \
+               depth_im[v + 1, u] == 0 or depth_im[v - 1, u] == 0:
+                continue
+            du_x = vertices[v, u + 1, 0] - vertices[v, u - 1, 0]
+            du_y = vertices[v, u + 1, 1] - vertices[v, u - 1, 1]
+            du_z = vertices[v, u + 1, 2] - vertices[v, u - 1, 2]
+            dv_x = vertices[v + 1, u, 0] - vertices[v - 1, u, 0]
+            dv_y = vertices[v + 1, u, 1] - vertices[v - 1, u, 1]
+            dv_z = vertices[v + 1, u, 2] - vertices[v - 1, u, 2]
+            n_x = du_y*dv_z - du_z*dv_y
+            n_y = du_z*dv_x - du_x*dv_z
+            n_z = du_x*dv_y - du_y*dv_x
+            norm = np.sqrt(n_x*n_x + n_y*n_y + n_z*n_z)
+            if norm == 0:
+                continue
+            ## towards the camera
+            if n_x*vertices[v, u, 0] + n_y*vertices[v, u, 1] + n_z*vertices[v, u, 2] > 0:
+                norm = -norm
+            normals[v, u, 0] = n_x / norm
+            normals[v, u, 1] = n_y / norm
+            normals[v, u, 2] = n_z / norm
+            valid[v, u] = True
+
+
+def vertex_normal_map(depth_im, cam_intr):
+    """back-project a depth image and estimate the normals from the image neighbors
+
+    Returns:
+        vertices (np.ndarray): [(H, W, 3) points in the camera frame]
+        normals (np.ndarray): [(H, W, 3) unit normals towards the camera]
+        valid (np.ndarray): [(H, W) bool, pixels with a depth and all four neighbors]
+    """
+    h, w = depth_im.shape
+    vertices = np.empty((h, w, 3), dtype=np.float32)
+    normals = np.zeros((h, w, 3), dtype=np.float32)
+    valid = np.zeros((h, w), dtype=bool)
+    _vertex_normal_map(np.ascontiguousarray(depth_im, dtype=np.float32),
+                       cam_intr[0, 0], cam_intr[1, 1], cam_intr[0, 2], cam_intr[1, 2], vertices, normals, valid)
+    return vertices, normals, valid
+
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _icp_system(src_vertices, src_normals, src_valid, tgt_vertices, tgt_normals, tgt_valid,
+                fx, fy, cx, cy, transformation, dist_thresh, cos_thresh):
+    ## projective association and per row sums of the point to plane normal equations:
+    ## 36 entries of J^T J, 6 of -J^T r, number of correspondences and squared error
+    h, w = src_valid.shape
+    tgt_h, tgt_w = tgt_valid.shape
+    rows = np.zeros((h, 44))
+    R = transformation[:3, :3]
+    t = transformation[:3, 3]
+    for v in prange(h):
+        J = np.empty(6)
+        acc = rows[v]
+        for u in range(w):
+            if not src_valid[v, u]:
+                continue
+            p = src_vertices[v, u]
+            q_x = R[0, 0]*p[0] + R[0, 1]*p[1] + R[0, 2]*p[2] + t[0]
+            q_y = R[1, 0]*p[0] + R[1, 1]*p[1] + R[1, 2]*p[2] + t[1]
+            q_z = R[2, 0]*p[0] + R[2, 1]*p[1] + R[2, 2]*p[2] + t[2]
+            if q_z <= 0:
+                continue
+            pu = np.rint(fx * q_x / q_z + cx)
+            pv = np.rint(fy * q_y / q_z + cy)
+            if pu < 0 or pu >= tgt_w or pv < 0 or pv >= tgt_h:
+                continue
+            tu = int(pu)
+            tv = int(pv)
+            if not tgt_valid[tv, tu]:
+                continue
+            d_x = q_x - tgt_vertices[tv, tu, 0]
+            d_y = q_y - tgt_vertices[tv, tu, 1]
+            d_z = q_z - tgt_vertices[tv, tu, 2]
+            if d_x*d_x + d_y*d_y + d_z*d_z >= dist_thresh*dist_thresh:
+                continue
+            n = tgt_normals[tv, tu]
+            sn = src_normals[v, u]
+            rn_x = R[0, 0]*sn[0] + R[0, 1]*sn[1] + R[0, 2]*sn[2]
+            rn_y = R[1, 0]*sn[0] + R[1, 1]*sn[1] + R[1, 2]*sn[2]
+            rn_z = R[2, 0]*sn[0] + R[2, 1]*sn[1] + R[2, 2]*sn[2]
+            if rn_x*n[0] + rn_y*n[1] + rn_z*n[2] <= cos_thresh:
+                continue
+
+            ## residual n . (q - p), jacobian [q x n, n] for a left-multiplied twist
+            residual = d_x*n[0] + d_y*n[1] + d_z*n[2]
+            J[0] = q_y*n[2] - q_z*n[1]
+            J[1] = q_z*n[0] - q_x*n[2]
+            J[2] = q_x*n[1] - q_y*n[0]
+            J[3] = n[0]
+            J[4] = n[1]
+            J[5] = n[2]
+            for i in range(6):
+                for j in range(6):
+                    acc[i*6 + j] += J[i] * J[j]
+                acc[36 + i] -= J[i] * residual
+            acc[42] += 1
+            acc[43] += residual * residual
+    return rows.sum(axis=0)
+
+
+def _se3_exp(xi):
+    ## twist (rx, ry, rz, tx, ty, tz) to a 4x4 transformation
+    T = np.eye(4)
+    T[:3, :3] = la.expm(np.array([[0, -xi[2], xi[1]], [xi[2], 0, -xi[0]], [-xi[1], xi[0], 0]]))
+    T[:3, 3] = xi[3:]
+    return T
+
+
+def projective_icp(src_depth, tgt_depth, cam_intr, init=np.eye(4), num_levels=3,
+                   max_iter_list=(10, 5, 3), dist_thresh_list=(0.075, 0.03, 0.015), angle_thresh=np.deg2rad(30),
+                   depth_trunc=1.5, min_correspondences=100):
+    """point to plane ICP with projective data association on depth pyramids (KinectFusion tracking)
+
+    Args:
+        src_depth (np.ndarray): [(H, W) source depth in meter, e.g. rendered from the model]
+        tgt_depth (np.ndarray): [(H, W) target depth in meter, same camera intrinsic]
+        cam_intr (np.ndarray): [(3, 3) camera intrinsic]
+        init (np.ndarray): [(4, 4) initial source to target transformation]
+        max_iter_list (tuple): [iterations from the coarsest to the finest level]
+        dist_thresh_list (tuple): [maximal point distance of a correspondence from the coarsest to the finest level]
+        angle_thresh (float): [maximal angle between the normals of a correspondence]
+
+    Returns:
+        [np.ndarray]: [(4, 4) transformation T with tgt ~ T @ src as in open3d registration_icp, None if tracking is lost]
+    """
+    src_pyramid = depth_pyramid(src_depth, cam_intr, num_levels, depth_trunc)
+    tgt_pyramid = depth_pyramid(tgt_depth, cam_intr, num_levels, depth_trunc)
+    transformation = np.array(init, dtype=np.float64)
+    cos_thresh = np.cos(angle_thresh)
+    for level in range(num_levels - 1, -1, -1):
+        src_vertices, src_normals, src_valid = vertex_normal_map(*src_pyramid[level])
+        tgt_vertices, tgt_normals, tgt_valid = vertex_normal_map(*tgt_pyramid[level])
+        intr = tgt_pyramid[level][1]
+        coarse_idx = num_levels - 1 - level
+        max_iter = max_iter_list[min(coarse_idx, len(max_iter_list) - 1)]
+        dist_thresh = dist_thresh_list[min(coarse_idx, len(dist_thresh_list) - 1)]
+        for _ in range(max_iter):
+            system = _icp_system(src_vertices, src_normals, src_valid, tgt_vertices, tgt_normals, tgt_valid,
+                                 intr[0, 0], intr[1, 1], intr[0, 2], intr[1, 2], transformation, dist_thresh, cos_thresh)
+            if system[42] < min_correspondences:
+                if level == 0:
+                    return None
+                break
+            try:
+                xi = la.solve(system[:36].reshape(6, 6), system[36:42], assume_a='pos')
+            except (la.LinAlgError, ValueError):
+                return None
+            transformation = _se3_exp(xi) @ transformation
+            if np.linalg.norm(xi) < 1e-6:
+                break
+    return transformation
+
+
+if __name__ == '__main__':
+    ## benchmark: a synthetic box corner seen from two poses, recover the relative motion
+    import time
+    im_h, im_w = 480, 640
+    cam_intr = np.array([[600., 0., 319.5], [0., 600., 239.5], [0., 0., 1.]])
+
+    def render_corner(cam_pose):
+        ## depth of the three planes x=-0.3, y=0.2, z=1.0 (world) seen from cam_pose (camera to world)
+        v, u = np.mgrid[0:im_h, 0:im_w]
+        rays = np.stack([(u - cam_intr[0, 2]) / cam_intr[0, 0], (v - cam_intr[1, 2]) / cam_intr[1, 1], np.ones((im_h, im_w))], axis=2)
+        dirs = rays @ cam_pose[:3, :3].T
+        origin = cam_pose[:3, 3]
+        depth = np.full((im_h, im_w), np.inf)
+        for axis, offset in [(0, -0.3), (1, 0.2), (2, 1.0)]:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                s = (offset - origin[axis]) / dirs[..., axis]
+            depth = np.where((s > 0) & (s < depth), s, depth)
+        depth[~np.isfinite(depth)] = 0
+        return depth.astype(np.float32)
+
+    pose_a = np.eye(4)
+    pose_b = _se3_exp(np.array([0.02, -0.03, 0.01, 0.02, -0.01, 0.015]))
+    depth_a, depth_b = render_corner(pose_a), render_corner(pose_b)
+    ## source in frame a, target in frame b: T = inv(pose_b) @ pose_a
+    expected = la.inv(pose_b) @ pose_a
+    projective_icp(depth_a, depth_b, cam_intr)
+    tic = time.time()
+    n = 10
+    for _ in range(n):
+        T = projective_icp(depth_a, depth_b, cam_intr)
+    elapsed = (time.time() - tic) / n
+    error = la.inv(expected) @ T
+    print("projective icp: {0:.1f} ms per frame ({1:.1f} fps), rotation error {2:.4f} deg, translation error {3:.2f} mm".format(
+        elapsed * 1000, 1 / elapsed, np.rad2deg(np.arccos(np.clip((np.trace(error[:3, :3]) - 1) / 2, -1, 1))),
+        np.linalg.norm(error[:3, 3]) * 1000))
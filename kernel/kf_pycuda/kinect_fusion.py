@@ -11,16 +11,12 @@ from scipy.io import loadmat
 from tqdm import tqdm
 from tqdm.contrib import tzip
 
-import pycuda.autoinit
-import pycuda.driver as cuda
-from pycuda import gpuarray
-
-from kernel.kf_pycuda.tsdf_lib import TSDFVolume
-from kernel.kf_pycuda.cuda_kernels import source_module
+from kernel.kf_pycuda.tsdf_lib import get_tsdf_volume_class
 from kernel.kf_pycuda import utils
+from kernel.kf_pycuda.icp import projective_icp
 from kernel.kf_pycuda.config import get_config, print_config
 
-from kernel.geometry import _rotation2Pose
+from kernel.campose_utility import write_campose
 
 # open3d version should be at least 0.11.0
 reg = o3d.pipelines.registration
@@ -33,7 +29,13 @@ class KinectFusion:
         self.init_transformation = None
         self.transformation = None
         self.prev_pcd = None
+        self.prev_depth = None
         self.cam_poses = []  
+        ## pycuda is only initialized when the cuda backend is used
+        self.TSDFVolume = get_tsdf_volume_class(cfg.get('tsdf_backend', 'auto') if cfg is not None else 'auto')
+        ## "multiscale": open3d ICP on downsampled point clouds, "projective": projective ICP on depth pyramids
+        self.icp_method = cfg.get('icp_method', 'multiscale') if cfg is not None else 'multiscale'
+        assert self.icp_method in ["multiscale", "projective"]
     
     def initialize_tsdf_volume(self, color_im, depth_im, pose=None, visualize=False):
         if pose is not None:
@@ -47,11 +49,12 @@ class KinectFusion:
             vol_bnds[:, 1] = np.mean(transformed_pts, axis = 0) + np.abs(transformed_pts - np.mean(transformed_pts, axis = 0)).max(0)*1.2
             self.init_transformation = la.inv(pose).copy()
             self.transformation = la.inv(pose).copy()
-            self.tsdf_volume = TSDFVolume(vol_bnds=vol_bnds,
+            self.tsdf_volume = self.TSDFVolume(vol_bnds=vol_bnds,
                                         voxel_size=self.cfg['tsdf_voxel_size'],
                                         trunc_margin=self.cfg['tsdf_trunc_margin'])
             self.tsdf_volume.integrate(color_im, depth_im, self.cfg['cam_intr'], pose)
             self.prev_pcd = pcd
+            self.prev_depth = depth_im
             self.cam_poses.append(pose)
         else:
             pcd = utils.create_pcd(depth_im, self.cfg['cam_intr'], color_im)
@@ -74,11 +77,12 @@ class KinectFusion:
 
             self.init_transformation = plane_frame.copy()
             self.transformation = plane_frame.copy()
-            self.tsdf_volume = TSDFVolume(vol_bnds=vol_bnds,
+            self.tsdf_volume = self.TSDFVolume(vol_bnds=vol_bnds,
                                         voxel_size=self.cfg['tsdf_voxel_size'],
                                         trunc_margin=self.cfg['tsdf_trunc_margin'])
             self.tsdf_volume.integrate(color_im, depth_im, self.cfg['cam_intr'], cam_pose)
             self.prev_pcd = pcd
+            self.prev_depth = depth_im
             self.cam_poses.append(cam_pose)            
     
 
@@ -117,11 +121,17 @@ class KinectFusion:
         return result_icp
 
     def update_pose_using_icp(self, depth_im):
-        curr_pcd = utils.create_pcd(depth_im, self.cfg['cam_intr'])
-
         cam_pose = la.inv(self.transformation)
         rendered_depth, _ = self.tsdf_volume.ray_casting(self.cfg['im_w'], self.cfg['im_h'], self.cfg['cam_intr'], 
                                                          cam_pose, to_host=True)
+        if self.icp_method == "projective":
+            transformation = projective_icp(rendered_depth, depth_im, self.cfg['cam_intr'])
+            if transformation is None:
+                return False
+            self.transformation = transformation @ self.transformation
+            return True
+
+        curr_pcd = utils.create_pcd(depth_im, self.cfg['cam_intr'])
         rendered_pcd = utils.create_pcd(rendered_depth, self.cfg['cam_intr'])
 
         result_icp = self.multiscale_icp(rendered_pcd,
@@ -196,15 +206,22 @@ class KinectFusion:
 
         self.init_transformation = la.inv(cam_pose.copy())
         self.transformation = la.inv(cam_pose.copy())
-        self.tsdf_volume = TSDFVolume(vol_bnds=vol_bnds,
+        self.tsdf_volume = self.TSDFVolume(vol_bnds=vol_bnds,
                                       voxel_size=self.cfg['tsdf_voxel_size'],
                                       trunc_margin=self.cfg['tsdf_trunc_margin'])
         self.tsdf_volume.integrate(color_im, depth_im, self.cfg['cam_intr'], cam_pose)
         self.prev_pcd = pcd
+        self.prev_depth = depth_im
         self.cam_poses.append(cam_pose)
 
     def F2FPoseEstimation(self, color_im, depth_im, accurate_pose = None):
         if accurate_pose is None:
+            if self.icp_method == "projective":
+                transformation = projective_icp(self.prev_depth, depth_im, self.cfg['cam_intr'], max_iter_list=[10, 10, 10])
+                if transformation is not None:
+                    self.transformation = transformation @ self.transformation
+                self.prev_depth = depth_im
+                return la.inv(self.transformation)
             curr_pcd = utils.create_pcd(depth_im, self.cfg['cam_intr'])
             # #------------------------------ frame to frame ICP (open loop) ------------------------------
             result_icp = self.multiscale_icp(self.prev_pcd, curr_pcd,
@@ -213,6 +230,7 @@ class KinectFusion:
             if result_icp is not None:
                 self.transformation = result_icp.transformation @ self.transformation
             self.prev_pcd = curr_pcd
+            self.prev_depth = depth_im
             cam_pose = la.inv(self.transformation)
             return cam_pose
         else:
@@ -220,23 +238,15 @@ class KinectFusion:
             curr_pcd = utils.create_pcd(depth_im, self.cfg['cam_intr'])
             self.transformation = la.inv(cam_pose)
             self.prev_pcd = curr_pcd   
+            self.prev_depth = depth_im
             return True
 
 
     def save(self, output_folder, prefix_list):
 
-        cam_poses = np.stack(self.cam_poses)
-        camout = open(os.path.join(output_folder, "campose.txt"), "w+")
-        camout.writelines("# IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME\n")
-        camout.writelines("\n")
-        for index, rot, prefix in zip(range(1, cam_poses.shape[0] + 1), cam_poses, prefix_list):
-            pose = _rotation2Pose(rot)
-            line = str(index) + " " + str(pose[1][0]) + " " + str(pose[1][1])\
-                    + " " + str(pose[1][2]) + " " + str(pose[1][3])\
-                    + " " + str(pose[0][0]) + " " + str(pose[0][1]) + " " + str(pose[0][2])\
-                    + " " + "1" + " " + prefix + ".png\n"
-            camout.writelines(line)
-        camout.close()
+        num_poses = min(len(self.cam_poses), len(prefix_list))
+        write_campose(os.path.join(output_folder, "campose.txt"), np.stack(self.cam_poses[:num_poses]), 
+                      [prefix + ".png" for prefix in prefix_list[:num_poses]])
         surface = self.tsdf_volume.get_surface_cloud_marching_cubes(voxel_size=0.005)
         o3d.io.write_point_cloud(os.path.join(output_folder, 'fused.ply'), surface)
         print(f"Results have been saved to {output_folder}.")
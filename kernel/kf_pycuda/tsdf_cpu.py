@@ -0,0 +1,371 @@
+import numpy as np
+import scipy.linalg as la
+from numba import njit, prange
+
+from kernel.kf_pycuda.tsdf_lib import TSDFVolume
+
+## CPU version of the kernels in cuda_kernels.py, the volumes are stored flat in the same (z, y, x) order
+_COLOR_CONST = 65536
+
+
+@njit(cache=True)
+def _deserialize_color(color):
+    b = np.floor(color / _COLOR_CONST)
+    g = np.floor((color - b*_COLOR_CONST) / 256)
+    r = color - b*_COLOR_CONST - g*256
+    return r, g, b
+
+
+@njit(error_model='numpy', cache=True)
+def _integrate_voxel(tsdf_vol, weight_vol, color_vol, voxel_idx, pt_x, pt_y, pt_z, cam_intr, cam_pose,
+                     color_im, depth_im, trunc_margin, weight):
+    ## update one voxel at world position pt, the body of the integrate kernel
+    im_h, im_w = depth_im.shape
+    fx, fy, cx, cy = cam_intr[0, 0], cam_intr[1, 1], cam_intr[0, 2], cam_intr[1, 2]
+
+    # world coordinates to camera coordinates
+    tmp_pt_x = pt_x - cam_pose[0, 3]
+    tmp_pt_y = pt_y - cam_pose[1, 3]
+    tmp_pt_z = pt_z - cam_pose[2, 3]
+    cam_pt_x = cam_pose[0, 0]*tmp_pt_x + cam_pose[1, 0]*tmp_pt_y + cam_pose[2, 0]*tmp_pt_z
+    cam_pt_y = cam_pose[0, 1]*tmp_pt_x + cam_pose[1, 1]*tmp_pt_y + cam_pose[2, 1]*tmp_pt_z
+    cam_pt_z = cam_pose[0, 2]*tmp_pt_x + cam_pose[1, 2]*tmp_pt_y + cam_pose[2, 2]*tmp_pt_z
+    if cam_pt_z <= 0:
+        return
+
+    # skip if outside view frustum
+    pixel_x = np.rint(fx*(cam_pt_x/cam_pt_z) + cx)
+    pixel_y = np.rint(fy*(cam_pt_y/cam_pt_z) + cy)
+    if pixel_x < 0 or pixel_x >= im_w or pixel_y < 0 or pixel_y >= im_h:
+        return
+    px = int(pixel_x)
+    py = int(pixel_y)
+
+    depth_value = depth_im[py, px]
+    if depth_value == 0:
+        return
+    # skip voxels that are beyond truncated value
+    depth_diff = depth_value - cam_pt_z
+    if depth_diff < -trunc_margin:
+        return
+
+    w_old = weight_vol[voxel_idx]
+    w_new = w_old + weight
+    weight_vol[voxel_idx] = w_new
+
+    dist = min(1.0, depth_diff / trunc_margin)
+    tsdf_vol[voxel_idx] = (tsdf_vol[voxel_idx]*w_old + weight*dist) / w_new
+
+    old_r, old_g, old_b = _deserialize_color(color_vol[voxel_idx])
+    new_r = min(np.floor((old_r*w_old + weight*color_im[py, px, 0]) / w_new + 0.5), 255.0)
+    new_g = min(np.floor((old_g*w_old + weight*color_im[py, px, 1]) / w_new + 0.5), 255.0)
+    new_b = min(np.floor((old_b*w_old + weight*color_im[py, px, 2]) / w_new + 0.5), 255.0)
+    color_vol[voxel_idx] = new_b*_COLOR_CONST + new_g*256 + new_r
+
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _integrate(tsdf_vol, weight_vol, color_vol, dim, vol_origin, voxel_size, cam_intr, cam_pose,
+               color_im, depth_im, trunc_margin, weight):
+    for z in prange(dim[2]):
+        for y in range(dim[1]):
+            for x in range(dim[0]):
+                _integrate_voxel(tsdf_vol, weight_vol, color_vol, z*dim[0]*dim[1] + y*dim[0] + x,
+                                 vol_origin[0] + x * voxel_size, vol_origin[1] + y * voxel_size, vol_origin[2] + z * voxel_size,
+                                 cam_intr, cam_pose, color_im, depth_im, trunc_margin, weight)
+
+
+@njit(error_model='numpy', cache=True)
+def _setup_ray(dim, vol_origin, voxel_size, cam_intr, cam_pose, u, v):
+    fx, fy, cx, cy = cam_intr[0, 0], cam_intr[1, 1], cam_intr[0, 2], cam_intr[1, 2]
+    px = (u - cx) / fx
+    py = (v - cy) / fy
+    ray_x = cam_pose[0, 0]*px + cam_pose[0, 1]*py + cam_pose[0, 2]
+    ray_y = cam_pose[1, 0]*px + cam_pose[1, 1]*py + cam_pose[1, 2]
+    ray_z = cam_pose[2, 0]*px + cam_pose[2, 1]*py + cam_pose[2, 2]
+    norm = np.sqrt(ray_x*ray_x + ray_y*ray_y + ray_z*ray_z)
+    # ray contains information of both direction and magnitute
+    ray = (voxel_size * ray_x / norm, voxel_size * ray_y / norm, voxel_size * ray_z / norm)
+    cam_pos = (cam_pose[0, 3], cam_pose[1, 3], cam_pose[2, 3])
+
+    t_enter = -np.inf
+    t_exit = np.inf
+    for i in range(3):
+        lo = vol_origin[i]
+        hi = vol_origin[i] + voxel_size * dim[i]
+        t_lo = ((lo if ray[i] > 0 else hi) - cam_pos[i]) / ray[i]
+        t_hi = ((hi if ray[i] > 0 else lo) - cam_pos[i]) / ray[i]
+        t_enter = max(t_enter, t_lo)
+        t_exit = min(t_exit, t_hi)
+    dist = (cam_pos[0] - vol_origin[0], cam_pos[1] - vol_origin[1], cam_pos[2] - vol_origin[2])
+    return ray, dist, max(t_enter, 0.0), t_exit
+
+
+@njit(cache=True)
+def _voxel_at(ray, dist, voxel_size, t):
+    return (int(np.rint((dist[0] + ray[0] * t) / voxel_size)),
+            int(np.rint((dist[1] + ray[1] * t) / voxel_size)),
+            int(np.rint((dist[2] + ray[2] * t) / voxel_size)))
+
+
+@njit(cache=True)
+def _inside(voxel, dim):
+    return 0 <= voxel[0] < dim[0] and 0 <= voxel[1] < dim[1] and 0 <= voxel[2] < dim[2]
+
+
+@njit(cache=True)
+def _shade(tsdf_vol, color_vol, dim, vol_origin, voxel_size, inv_cam_pose, voxel, depth_im, color_im, v, u):
+    voxel_idx = voxel[2]*dim[0]*dim[1] + voxel[1]*dim[0] + voxel[0]
+    p_x = vol_origin[0] + voxel[0] * voxel_size
+    p_y = vol_origin[1] + voxel[1] * voxel_size
+    p_z = vol_origin[2] + voxel[2] * voxel_size
+    depth_im[v, u] = inv_cam_pose[2, 0]*p_x + inv_cam_pose[2, 1]*p_y + inv_cam_pose[2, 2]*p_z + inv_cam_pose[2, 3]
+    r, g, b = _deserialize_color(color_vol[voxel_idx])
+    color_im[v, u, 0] = r
+    color_im[v, u, 1] = g
+    color_im[v, u, 2] = b
+
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _ray_casting(tsdf_vol, color_vol, dim, vol_origin, voxel_size, cam_intr, cam_pose, inv_cam_pose,
+                 start_row, start_col, depth_im, color_im):
+    im_h, im_w = depth_im.shape
+    for y in prange(im_h):
+        for x in range(im_w):
+            ray, dist, t_enter, t_exit = _setup_ray(dim, vol_origin, voxel_size, cam_intr, cam_pose, start_col + x, start_row + y)
+            if not (t_enter < t_exit):
+                continue
+            t_min = int(np.ceil(t_enter))
+            t_max = int(np.floor(t_exit))
+            if t_min >= t_max:
+                continue
+
+            prev_voxel = _voxel_at(ray, dist, voxel_size, t_min)
+            ray_inside_box = False
+            for t in range(t_min + 1, t_max):
+                curr_voxel = _voxel_at(ray, dist, voxel_size, t)
+                if not ray_inside_box:
+                    if _inside(prev_voxel, dim):
+                        ray_inside_box = True
+                    else:
+                        prev_voxel = curr_voxel
+                        continue
+                # Box has a convex shape. A ray cannot re-enter a box after leaving it.
+                if not _inside(curr_voxel, dim):
+                    break
+
+                prev_tsdf = tsdf_vol[prev_voxel[2]*dim[0]*dim[1] + prev_voxel[1]*dim[0] + prev_voxel[0]]
+                curr_tsdf = tsdf_vol[curr_voxel[2]*dim[0]*dim[1] + curr_voxel[1]*dim[0] + curr_voxel[0]]
+                # zero crossing from front
+                if prev_tsdf > 0 and curr_tsdf < 0 and curr_tsdf > -1:
+                    _shade(tsdf_vol, color_vol, dim, vol_origin, voxel_size, inv_cam_pose, curr_voxel, depth_im, color_im, y, x)
+                    break
+                prev_voxel = curr_voxel
+
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _batch_ray_casting(tsdf_vol, color_vol, dim, vol_origin, voxel_size, cam_intr, cam_poses, inv_cam_poses,
+                       start_row, start_col, batch_depth_im, batch_color_im):
+    batch_size, im_h, im_w = batch_depth_im.shape
+    t_step = 5  # 5 is relatively safe. 10 is much faster but may miss the crossing point.
+    for job in prange(batch_size * im_h):
+        z = job // im_h
+        y = job % im_h
+        depth_im = batch_depth_im[z]
+        color_im = batch_color_im[z]
+        for x in range(im_w):
+            ray, dist, t_enter, t_exit = _setup_ray(dim, vol_origin, voxel_size, cam_intr, cam_poses[z], start_col + x, start_row + y)
+            if not (t_enter < t_exit):
+                continue
+            t_min = int(np.floor(t_enter))
+            t_max = int(np.ceil(t_exit))
+            if t_min >= t_max:
+                continue
+
+            prev_voxel = _voxel_at(ray, dist, voxel_size, t_min)
+            ray_inside_box = False
+            done = False
+            for t in range(t_min + 1, t_max - 1, t_step):
+                curr_voxel = _voxel_at(ray, dist, voxel_size, t)
+                if not ray_inside_box:
+                    if _inside(prev_voxel, dim):
+                        ray_inside_box = True
+                    else:
+                        prev_voxel = curr_voxel
+                        continue
+                if not _inside(curr_voxel, dim):
+                    break
+
+                prev_tsdf = tsdf_vol[prev_voxel[2]*dim[0]*dim[1] + prev_voxel[1]*dim[0] + prev_voxel[0]]
+                curr_tsdf = tsdf_vol[curr_voxel[2]*dim[0]*dim[1] + curr_voxel[1]*dim[0] + curr_voxel[0]]
+                if prev_tsdf > 0 and curr_tsdf < 0:
+                    # find the exact zero crossing time
+                    for i in range(max(t_min + 1, t - t_step), t + 1):
+                        voxel = _voxel_at(ray, dist, voxel_size, i)
+                        if not _inside(voxel, dim):
+                            continue
+                        voxel_tsdf = tsdf_vol[voxel[2]*dim[0]*dim[1] + voxel[1]*dim[0] + voxel[0]]
+                        if voxel_tsdf < 0:
+                            if voxel_tsdf > -1:
+                                _shade(tsdf_vol, color_vol, dim, vol_origin, voxel_size, inv_cam_poses[z], voxel, depth_im, color_im, y, x)
+                                done = True
+                            break  # false surface otherwise
+                    if done:
+                        break
+                prev_voxel = curr_voxel
+
+
+class TSDFVolumeCPU(TSDFVolume):
+    """
+    TSDF volume on the CPU with Numba, same interface and results as the pycuda TSDFVolume
+    for the machines without a GPU
+    """
+
+    def __init__(self, vol_bnds, voxel_size, trunc_margin=0.015):
+        """
+        Args:
+            vol_bnds (ndarray): An ndarray of shape (3, 2). Specifies the xyz bounds (min/max) in meters.
+            voxel_size (float): The volume discretization in meters.
+        """
+        vol_bnds = np.asarray(vol_bnds)
+        assert vol_bnds.shape == (3, 2), "[!] `vol_bnds` should be of shape (3, 2)."
+
+        self._vol_bnds = vol_bnds
+        self._voxel_size = voxel_size
+        self._trunc_margin = trunc_margin
+        self._color_const = np.float32(256 * 256)
+
+        self._vol_dim = np.ceil((self._vol_bnds[:,1] - self._vol_bnds[:,0])/self._voxel_size).copy(order='C').astype(int)
+        self._vol_bnds[:,1] = self._vol_bnds[:,0] + self._vol_dim*self._voxel_size
+        self._vol_origin = self._vol_bnds[:,0].copy(order='C').astype(np.float32)
+
+        # initialize tsdf values to be -1
+        xyz = int(np.prod(self._vol_dim))
+        self._tsdf_vol = np.full(xyz, -1, dtype=np.float32)
+        self._weight_vol = np.zeros(xyz, dtype=np.float32)
+        self._color_vol = np.zeros(xyz, dtype=np.float32)
+
+    def integrate(self, color_im, depth_im, cam_intr, cam_pose, weight=1.0):
+        """ Integrate an RGB-D frame into the TSDF volume.
+
+        Args:
+            color_im (np.ndarray): input RGB image of shape (H, W, 3)
+            depth_im (np.ndarray): input depth image of shape (H, W)
+            cam_intr (np.ndarray): Camera intrinsics matrix of shape (3, 3)
+            cam_pose (np.ndarray): Camera pose of shape (4, 4)
+            weight (float, optional): weight to be assigned for the current observation. Defaults to 1.0.
+        """
+        _integrate(self._tsdf_vol, self._weight_vol, self._color_vol,
+                   self._vol_dim.astype(np.int64), self._vol_origin.astype(np.float64), float(self._voxel_size),
+                   np.asarray(cam_intr, dtype=np.float64), np.asarray(cam_pose, dtype=np.float64),
+                   np.ascontiguousarray(color_im[..., :3], dtype=np.float32), np.ascontiguousarray(depth_im, dtype=np.float32),
+                   float(self._trunc_margin), float(weight))
+
+    def batch_ray_casting(self, im_w, im_h, cam_intr, cam_poses, inv_cam_poses, start_row=0, start_col=0, batch_size=1, to_host=True):
+        batch_depth_im = np.zeros((batch_size, im_h, im_w), dtype=np.float32)
+        batch_color_im = np.zeros((batch_size, im_h, im_w, 3), dtype=np.uint8)
+        _batch_ray_casting(self._tsdf_vol, self._color_vol,
+                           self._vol_dim.astype(np.int64), self._vol_origin.astype(np.float64), float(self._voxel_size),
+                           np.asarray(cam_intr, dtype=np.float64),
+                           np.asarray(cam_poses, dtype=np.float64).reshape(batch_size, 4, 4),
+                           np.asarray(inv_cam_poses, dtype=np.float64).reshape(batch_size, 4, 4),
+                           start_row, start_col, batch_depth_im, batch_color_im)
+        return batch_depth_im, batch_color_im
+
+    def ray_casting(self, im_w, im_h, cam_intr, cam_pose, start_row=0, start_col=0, to_host=True):
+        """
+        Render an image patch
+        """
+        depth_im = np.zeros((im_h, im_w), dtype=np.float32)
+        color_im = np.zeros((im_h, im_w, 3), dtype=np.uint8)
+        _ray_casting(self._tsdf_vol, self._color_vol,
+                     self._vol_dim.astype(np.int64), self._vol_origin.astype(np.float64), float(self._voxel_size),
+                     np.asarray(cam_intr, dtype=np.float64), np.asarray(cam_pose, dtype=np.float64),
+                     la.inv(cam_pose).astype(np.float64), start_row, start_col, depth_im, color_im)
+        return depth_im, color_im
+
+    def get_volume(self):
+        x_dim, y_dim, z_dim = self._vol_dim
+        tsdf_vol_cpu = self._tsdf_vol.reshape((z_dim, y_dim, x_dim)).transpose(2, 1, 0)
+        color_vol_cpu = self._color_vol.reshape((z_dim, y_dim, x_dim)).transpose(2, 1, 0)
+        weight_vol_cpu = self._weight_vol.reshape((z_dim, y_dim, x_dim)).transpose(2, 1, 0)
+        return tsdf_vol_cpu, color_vol_cpu, weight_vol_cpu
+
+    def save(self, output_path):
+        np.savez_compressed(output_path,
+            vol_bounds=self._vol_bnds,
+            voxel_size=self._voxel_size,
+            trunc_margin=self._trunc_margin,
+            tsdf_vol=self._tsdf_vol,
+            weight_vol=self._weight_vol,
+            color_vol=self._color_vol
+        )
+        print(f"tsdf volume has been saved to: {output_path}")
+
+    @classmethod
+    def load(cls, input_path):
+        loaded = np.load(input_path)
+        obj = cls(loaded['vol_bounds'], loaded['voxel_size'], loaded['trunc_margin'])
+        obj._tsdf_vol = loaded['tsdf_vol'].astype(np.float32)
+        obj._weight_vol = loaded['weight_vol'].astype(np.float32)
+        obj._color_vol = loaded['color_vol'].astype(np.float32)
+        print(f"tsdf volume has been loaded from: {input_path}")
+        return obj
+
+
+def _integrate_reference(vol, color_im, depth_im, cam_intr, cam_pose, weight=1.0):
+    ## line by line NumPy transcription of the integrate kernel in cuda_kernels.py, for the self-check
+    x_dim, y_dim, z_dim = vol._vol_dim
+    z, y, x = np.meshgrid(np.arange(z_dim), np.arange(y_dim), np.arange(x_dim), indexing='ij')
+    pts = vol._vol_origin[None] + np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1) * vol._voxel_size
+    cam_pts = (pts - cam_pose[:3, 3]) @ cam_pose[:3, :3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pixel_x = np.rint(cam_intr[0, 0]*cam_pts[:, 0]/cam_pts[:, 2] + cam_intr[0, 2])
+        pixel_y = np.rint(cam_intr[1, 1]*cam_pts[:, 1]/cam_pts[:, 2] + cam_intr[1, 2])
+    im_h, im_w = depth_im.shape
+    valid = (pixel_x >= 0) & (pixel_x < im_w) & (pixel_y >= 0) & (pixel_y < im_h) & (cam_pts[:, 2] > 0)
+    idx = np.nonzero(valid)[0]
+    px, py = pixel_x[idx].astype(int), pixel_y[idx].astype(int)
+    depth_diff = depth_im[py, px] - cam_pts[idx, 2]
+    keep = (depth_im[py, px] != 0) & (depth_diff >= -vol._trunc_margin)
+    idx, px, py, depth_diff = idx[keep], px[keep], py[keep], depth_diff[keep]
+    w_old = vol._weight_vol[idx]
+    w_new = w_old + weight
+    vol._weight_vol[idx] = w_new
+    vol._tsdf_vol[idx] = (vol._tsdf_vol[idx]*w_old + weight*np.minimum(1, depth_diff/vol._trunc_margin)) / w_new
+    old_b = np.floor(vol._color_vol[idx] / 65536)
+    old_g = np.floor((vol._color_vol[idx] - old_b*65536) / 256)
+    old_r = vol._color_vol[idx] - old_b*65536 - old_g*256
+    new = [np.minimum(np.floor((old*w_old + weight*color_im[py, px, c]) / w_new + 0.5), 255) for c, old in enumerate([old_r, old_g, old_b])]
+    vol._color_vol[idx] = new[2]*65536 + new[1]*256 + new[0]
+
+
+if __name__ == '__main__':
+    ## self-check: the integration against the kernel semantics, then ray cast a synthetic plane back from the same view
+    def _pose_around(angle):
+        pose = np.eye(4)
+        pose[:3, :3] = np.array([[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]])
+        pose[0, 3] = -0.5*np.sin(angle)
+        return pose
+
+    im_h, im_w = 120, 160
+    cam_intr = np.array([[200., 0., 80.], [0., 200., 60.], [0., 0., 1.]])
+    depth_im = np.full((im_h, im_w), 0.5, dtype=np.float32)
+    color_im = np.zeros((im_h, im_w, 3), dtype=np.uint8)
+    color_im[..., 0] = 200
+    color_im[..., 2] = 30
+    vol = TSDFVolumeCPU(np.array([[-0.2, 0.2], [-0.15, 0.15], [0.3, 0.7]]), voxel_size=0.005, trunc_margin=0.02)
+    reference = TSDFVolumeCPU(np.array([[-0.2, 0.2], [-0.15, 0.15], [0.3, 0.7]]), voxel_size=0.005, trunc_margin=0.02)
+    rng = np.random.default_rng(0)
+    for pose in [np.eye(4), _pose_around(0.05), _pose_around(-0.05)]:
+        noisy_depth = (depth_im + rng.normal(0, 0.002, depth_im.shape)).astype(np.float32)
+        vol.integrate(color_im, noisy_depth, cam_intr, pose)
+        _integrate_reference(reference, color_im, noisy_depth, cam_intr, pose)
+    print("integrate: max tsdf difference {0:.2e}, weight difference {1}, color difference {2}".format(
+        np.abs(vol._tsdf_vol - reference._tsdf_vol).max(), np.abs(vol._weight_vol - reference._weight_vol).max(),
+        np.abs(vol._color_vol - reference._color_vol).max()))
+    rendered_depth, rendered_color = vol.ray_casting(im_w, im_h, cam_intr, np.eye(4))
+    valid = rendered_depth > 0
+    print("ray casting: {0:.1f}% pixels hit, max depth error {1:.4f} m, color {2}".format(
+        valid.mean()*100, np.abs(rendered_depth[valid] - 0.5).max(), rendered_color[valid][0]))
+    batch_depth, _ = vol.batch_ray_casting(im_w, im_h, cam_intr, np.eye(4)[np.newaxis], np.eye(4)[np.newaxis])
+    print("batch ray casting: max depth difference {0:.4f} m".format(np.abs(batch_depth[0] - rendered_depth)[valid & (batch_depth[0] > 0)].max()))
@@ -0,0 +1,408 @@
+import numpy as np
+import scipy.linalg as la
+import open3d as o3d
+from numba import njit, prange
+
+from kernel.kf_pycuda.tsdf_lib import TSDFVolume, _marching_cubes
+from kernel.kf_pycuda.tsdf_cpu import _integrate_voxel, _setup_ray, _voxel_at, _deserialize_color
+
+## voxels are grouped in bricks of BRICK^3 voxels, only the bricks around the observed surface are allocated
+BRICK = 8
+BRICK_VOXELS = BRICK * BRICK * BRICK
+## the surface is extracted from dense chunks of CHUNK^3 bricks
+CHUNK = 8
+
+
+@njit(cache=True)
+def _hash(bx, by, bz, mask):
+    return ((bx * 73856093) ^ (by * 19349669) ^ (bz * 83492791)) & mask
+
+
+@njit(cache=True)
+def _lookup(table_coords, table_slots, bx, by, bz):
+    ## slot of a brick, -1 if the brick is not allocated
+    mask = table_slots.shape[0] - 1
+    h = _hash(bx, by, bz, mask)
+    while True:
+        slot = table_slots[h]
+        if slot == -1:
+            return -1
+        if table_coords[h, 0] == bx and table_coords[h, 1] == by and table_coords[h, 2] == bz:
+            return slot
+        h = (h + 1) & mask
+
+
+@njit(cache=True)
+def _insert(table_coords, table_slots, bx, by, bz, slot):
+    mask = table_slots.shape[0] - 1
+    h = _hash(bx, by, bz, mask)
+    while table_slots[h] != -1:
+        h = (h + 1) & mask
+    table_coords[h, 0] = bx
+    table_coords[h, 1] = by
+    table_coords[h, 2] = bz
+    table_slots[h] = slot
+
+
+@njit(cache=True)
+def _rehash(table_coords, table_slots, brick_coords, num_bricks):
+    for slot in range(num_bricks):
+        _insert(table_coords, table_slots, brick_coords[slot, 0], brick_coords[slot, 1], brick_coords[slot, 2], slot)
+
+
+@njit(error_model='numpy', cache=True)
+def _allocate(table_coords, table_slots, brick_coords, num_bricks, stamp, frame_stamp, touched,
+              vol_origin, voxel_size, cam_intr, cam_pose, depth_im, trunc_margin):
+    """allocate the bricks crossed by the truncation band [depth - trunc, depth + trunc] of every pixel
+
+    Returns:
+        [int]: [number of allocated bricks, -1 if the pool or the table is full]
+        [int]: [number of bricks touched by this frame, listed in touched]
+    """
+    im_h, im_w = depth_im.shape
+    fx, fy, cx, cy = cam_intr[0, 0], cam_intr[1, 1], cam_intr[0, 2], cam_intr[1, 2]
+    ## sample the band at half a brick, no brick along the ray is skipped
+    num_steps = int(np.ceil(2 * trunc_margin / (0.5 * BRICK * voxel_size))) + 1
+    capacity = brick_coords.shape[0]
+    max_load = table_slots.shape[0] // 2
+    num_touched = 0
+    for v in range(im_h):
+        for u in range(im_w):
+            depth = depth_im[v, u]
+            if depth == 0:
+                continue
+            x_n = (u - cx) / fx
+            y_n = (v - cy) / fy
+            for k in range(num_steps + 1):
+                s = depth - trunc_margin + 2 * trunc_margin * k / num_steps
+                if s <= 0:
+                    continue
+                bx = int(np.floor(np.rint((cam_pose[0, 0]*x_n*s + cam_pose[0, 1]*y_n*s + cam_pose[0, 2]*s + cam_pose[0, 3] - vol_origin[0]) / voxel_size) / BRICK))
+                by = int(np.floor(np.rint((cam_pose[1, 0]*x_n*s + cam_pose[1, 1]*y_n*s + cam_pose[1, 2]*s + cam_pose[1, 3] - vol_origin[1]) / voxel_size) / BRICK))
+                bz = int(np.floor(np.rint((cam_pose[2, 0]*x_n*s + cam_pose[2, 1]*y_n*s + cam_pose[2, 2]*s + cam_pose[2, 3] - vol_origin[2]) / voxel_size) / BRICK))
+                slot = _lookup(table_coords, table_slots, bx, by, bz)
+                if slot == -1:
+                    if num_bricks >= capacity or num_bricks >= max_load:
+                        return -1, num_touched
+                    slot = num_bricks
+                    brick_coords[slot, 0] = bx
+                    brick_coords[slot, 1] = by
+                    brick_coords[slot, 2] = bz
+                    _insert(table_coords, table_slots, bx, by, bz, slot)
+                    num_bricks += 1
+                if stamp[slot] != frame_stamp:
+                    stamp[slot] = frame_stamp
+                    touched[num_touched] = slot
+                    num_touched += 1
+    return num_bricks, num_touched
+
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _integrate_bricks(tsdf_pool, weight_pool, color_pool, brick_coords, touched, vol_origin, voxel_size,
+                      cam_intr, cam_pose, color_im, depth_im, trunc_margin, weight):
+    tsdf_vol = tsdf_pool.reshape(-1)
+    weight_vol = weight_pool.reshape(-1)
+    color_vol = color_pool.reshape(-1)
+    for n in prange(touched.shape[0]):
+        slot = touched[n]
+        for lz in range(BRICK):
+            for ly in range(BRICK):
+                for lx in range(BRICK):
+                    _integrate_voxel(tsdf_vol, weight_vol, color_vol, slot*BRICK_VOXELS + lz*BRICK*BRICK + ly*BRICK + lx,
+                                     vol_origin[0] + (brick_coords[slot, 0]*BRICK + lx) * voxel_size,
+                                     vol_origin[1] + (brick_coords[slot, 1]*BRICK + ly) * voxel_size,
+                                     vol_origin[2] + (brick_coords[slot, 2]*BRICK + lz) * voxel_size,
+                                     cam_intr, cam_pose, color_im, depth_im, trunc_margin, weight)
+
+
+@njit(cache=True)
+def _voxel_index(table_coords, table_slots, x, y, z):
+    ## flat index of a voxel in the pools, -1 if its brick is not allocated
+    bx, by, bz = x // BRICK, y // BRICK, z // BRICK
+    slot = _lookup(table_coords, table_slots, bx, by, bz)
+    if slot == -1:
+        return -1
+    return slot*BRICK_VOXELS + (z - bz*BRICK)*BRICK*BRICK + (y - by*BRICK)*BRICK + (x - bx*BRICK)
+
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _ray_casting(table_coords, table_slots, tsdf_pool, color_pool, voxel_min, dim, vol_origin, voxel_size,
+                 cam_intr, cam_poses, inv_cam_poses, start_row, start_col, batch_depth_im, batch_color_im):
+    batch_size, im_h, im_w = batch_depth_im.shape
+    tsdf_vol = tsdf_pool.reshape(-1)
+    color_vol = color_pool.reshape(-1)
+    ## the rays are clipped to the box of the allocated bricks
+    box_origin = vol_origin + voxel_min * voxel_size
+    for job in prange(batch_size * im_h):
+        b = job // im_h
+        y = job % im_h
+        inv_cam_pose = inv_cam_poses[b]
+        for x in range(im_w):
+            ray, dist, t_enter, t_exit = _setup_ray(dim, box_origin, voxel_size, cam_intr, cam_poses[b], start_col + x, start_row + y)
+            if not (t_enter < t_exit):
+                continue
+            t = int(np.ceil(t_enter))
+            t_max = int(np.floor(t_exit))
+            prev_tsdf = -1.0
+            while t < t_max:
+                voxel = _voxel_at(ray, dist, voxel_size, t)
+                voxel_idx = _voxel_index(table_coords, table_slots, voxel[0] + voxel_min[0], voxel[1] + voxel_min[1], voxel[2] + voxel_min[2])
+                if voxel_idx == -1:
+                    ## empty space, jump half a brick
+                    prev_tsdf = -1.0
+                    t += BRICK // 2
+                    continue
+                curr_tsdf = tsdf_vol[voxel_idx]
+                # zero crossing from front
+                if prev_tsdf > 0 and curr_tsdf < 0 and curr_tsdf > -1:
+                    p_x = vol_origin[0] + (voxel[0] + voxel_min[0]) * voxel_size
+                    p_y = vol_origin[1] + (voxel[1] + voxel_min[1]) * voxel_size
+                    p_z = vol_origin[2] + (voxel[2] + voxel_min[2]) * voxel_size
+                    batch_depth_im[b, y, x] = inv_cam_pose[2, 0]*p_x + inv_cam_pose[2, 1]*p_y + inv_cam_pose[2, 2]*p_z + inv_cam_pose[2, 3]
+                    r, g, bl = _deserialize_color(color_vol[voxel_idx])
+                    batch_color_im[b, y, x, 0] = r
+                    batch_color_im[b, y, x, 1] = g
+                    batch_color_im[b, y, x, 2] = bl
+                    break
+                prev_tsdf = curr_tsdf
+                t += 1
+
+
+class TSDFVolumeHash(TSDFVolume):
+    """
+    Sparse TSDF volume, the voxels are stored in bricks of 8^3 allocated on demand from a spatial hash,
+    so the memory follows the observed surface and the scene could grow beyond vol_bnds.
+    vol_bnds only anchors the voxel grid, the interface is the same as TSDFVolume
+    """
+
+    def __init__(self, vol_bnds, voxel_size, trunc_margin=0.015, initial_bricks=4096):
+        """
+        Args:
+            vol_bnds (ndarray): An ndarray of shape (3, 2). The voxel grid is aligned to the min bounds.
+            voxel_size (float): The volume discretization in meters.
+            initial_bricks (int): number of bricks allocated at first, the pool grows when needed.
+        """
+        vol_bnds = np.asarray(vol_bnds)
+        assert vol_bnds.shape == (3, 2), "[!] `vol_bnds` should be of shape (3, 2)."
+
+        self._vol_bnds = vol_bnds
+        self._voxel_size = voxel_size
+        self._trunc_margin = trunc_margin
+        self._color_const = np.float32(256 * 256)
+        self._vol_origin = self._vol_bnds[:,0].copy(order='C').astype(np.float32)
+
+        self._num_bricks = 0
+        self._frame_stamp = 0
+        self._allocate_pool(initial_bricks)
+
+    def _allocate_pool(self, capacity):
+        ## (re)allocate the brick pool and a hash table twice as large, the allocated bricks are kept
+        num_bricks = self._num_bricks
+        old = None if num_bricks == 0 else (self._brick_coords, self._tsdf_pool, self._weight_pool, self._color_pool, self._stamp)
+        self._brick_coords = np.zeros((capacity, 3), dtype=np.int64)
+        # initialize tsdf values to be -1
+        self._tsdf_pool = np.full((capacity, BRICK_VOXELS), -1, dtype=np.float32)
+        self._weight_pool = np.zeros((capacity, BRICK_VOXELS), dtype=np.float32)
+        self._color_pool = np.zeros((capacity, BRICK_VOXELS), dtype=np.float32)
+        self._stamp = np.full(capacity, -1, dtype=np.int64)
+        if old is not None:
+            for new_array, old_array in zip((self._brick_coords, self._tsdf_pool, self._weight_pool, self._color_pool, self._stamp), old):
+                new_array[:num_bricks] = old_array[:num_bricks]
+        table_size = 1 << int(np.ceil(np.log2(2 * capacity)))
+        self._table_coords = np.zeros((table_size, 3), dtype=np.int64)
+        self._table_slots = np.full(table_size, -1, dtype=np.int64)
+        _rehash(self._table_coords, self._table_slots, self._brick_coords, num_bricks)
+
+    def _camera_args(self, cam_intr, cam_pose):
+        return (self._vol_origin.astype(np.float64), float(self._voxel_size),
+                np.asarray(cam_intr, dtype=np.float64), np.asarray(cam_pose, dtype=np.float64))
+
+    def integrate(self, color_im, depth_im, cam_intr, cam_pose, weight=1.0):
+        """ Integrate an RGB-D frame into the TSDF volume, allocating the bricks around the observed surface.
+
+        Args:
+            color_im (np.ndarray): input RGB image of shape (H, W, 3)
+            depth_im (np.ndarray): input depth image of shape (H, W)
+            cam_intr (np.ndarray): Camera intrinsics matrix of shape (3, 3)
+            cam_pose (np.ndarray): Camera pose of shape (4, 4)
+            weight (float, optional): weight to be assigned for the current observation. Defaults to 1.0.
+        """
+        depth_im = np.ascontiguousarray(depth_im, dtype=np.float32)
+        vol_origin, voxel_size, cam_intr, cam_pose = self._camera_args(cam_intr, cam_pose)
+        while True:
+            ## a new stamp for every attempt, an interrupted attempt leaves stale stamps only
+            self._frame_stamp += 1
+            touched = np.empty(self._brick_coords.shape[0], dtype=np.int64)
+            num_bricks, num_touched = _allocate(self._table_coords, self._table_slots, self._brick_coords, self._num_bricks,
+                                                self._stamp, self._frame_stamp, touched, vol_origin, voxel_size,
+                                                cam_intr, cam_pose, depth_im, float(self._trunc_margin))
+            if num_bricks >= 0:
+                self._num_bricks = num_bricks
+                break
+            ## the bricks inserted before running out of space are kept, count them before growing
+            self._num_bricks = int(np.count_nonzero(self._table_slots != -1))
+            self._allocate_pool(2 * self._brick_coords.shape[0])
+        _integrate_bricks(self._tsdf_pool, self._weight_pool, self._color_pool, self._brick_coords, touched[:num_touched],
+                          vol_origin, voxel_size, cam_intr, cam_pose,
+                          np.ascontiguousarray(color_im[..., :3], dtype=np.float32), depth_im,
+                          float(self._trunc_margin), float(weight))
+
+    def _voxel_box(self):
+        ## voxel index range of the allocated bricks
+        coords = self._brick_coords[:self._num_bricks]
+        voxel_min = coords.min(axis=0) * BRICK
+        voxel_max = (coords.max(axis=0) + 1) * BRICK
+        return voxel_min, voxel_max
+
+    def batch_ray_casting(self, im_w, im_h, cam_intr, cam_poses, inv_cam_poses, start_row=0, start_col=0, batch_size=1, to_host=True):
+        batch_depth_im = np.zeros((batch_size, im_h, im_w), dtype=np.float32)
+        batch_color_im = np.zeros((batch_size, im_h, im_w, 3), dtype=np.uint8)
+        if self._num_bricks == 0:
+            return batch_depth_im, batch_color_im
+        voxel_min, voxel_max = self._voxel_box()
+        _ray_casting(self._table_coords, self._table_slots, self._tsdf_pool, self._color_pool,
+                     voxel_min, voxel_max - voxel_min, self._vol_origin.astype(np.float64), float(self._voxel_size),
+                     np.asarray(cam_intr, dtype=np.float64),
+                     np.asarray(cam_poses, dtype=np.float64).reshape(batch_size, 4, 4),
+                     np.asarray(inv_cam_poses, dtype=np.float64).reshape(batch_size, 4, 4),
+                     start_row, start_col, batch_depth_im, batch_color_im)
+        return batch_depth_im, batch_color_im
+
+    def ray_casting(self, im_w, im_h, cam_intr, cam_pose, start_row=0, start_col=0, to_host=True):
+        """
+        Render an image patch
+        """
+        batch_depth_im, batch_color_im = self.batch_ray_casting(im_w, im_h, cam_intr, cam_pose[np.newaxis], la.inv(cam_pose)[np.newaxis],
+                                                                start_row=start_row, start_col=start_col)
+        return batch_depth_im[0], batch_color_im[0]
+
+    def _dense_block(self, voxel_min, shape):
+        ## dense (x, y, z) tsdf, color and weight of a box of voxels, unallocated voxels are unobserved (-1)
+        tsdf_vol = np.full(shape, -1, dtype=np.float32)
+        color_vol = np.zeros(shape, dtype=np.float32)
+        weight_vol = np.zeros(shape, dtype=np.float32)
+        coords = self._brick_coords[:self._num_bricks] * BRICK - voxel_min
+        inside = np.all((coords > -BRICK) & (coords < np.array(shape)), axis=1)
+        for slot in np.nonzero(inside)[0]:
+            lo = coords[slot]
+            src = tuple(slice(max(0, -lo[i]), min(BRICK, shape[i] - lo[i])) for i in range(3))
+            dst = tuple(slice(max(0, lo[i]), min(shape[i], lo[i] + BRICK)) for i in range(3))
+            ## bricks are stored in (z, y, x) order
+            tsdf_vol[dst] = self._tsdf_pool[slot].reshape(BRICK, BRICK, BRICK).transpose(2, 1, 0)[src]
+            color_vol[dst] = self._color_pool[slot].reshape(BRICK, BRICK, BRICK).transpose(2, 1, 0)[src]
+            weight_vol[dst] = self._weight_pool[slot].reshape(BRICK, BRICK, BRICK).transpose(2, 1, 0)[src]
+        return tsdf_vol, color_vol, weight_vol
+
+    def get_volume(self):
+        ## dense volume over the box of the allocated bricks, memory follows the box, prefer the brick-wise methods
+        if self._num_bricks == 0:
+            return np.full((0, 0, 0), -1, dtype=np.float32), np.zeros((0, 0, 0), dtype=np.float32), np.zeros((0, 0, 0), dtype=np.float32)
+        voxel_min, voxel_max = self._voxel_box()
+        return self._dense_block(voxel_min, tuple(voxel_max - voxel_min))
+
+    def get_surface_cloud_marching_cubes(self, voxel_size=0.005):
+        ## marching cubes chunk by chunk, a chunk is extended by one voxel to close the seams with its neighbors
+        coords = self._brick_coords[:self._num_bricks]
+        chunks = np.unique(np.floor_divide(coords, CHUNK), axis=0)
+        size = CHUNK * BRICK
+        all_verts, all_colors = [], []
+        for chunk in chunks:
+            voxel_min = chunk * size
+            tsdf_vol, color_vol, weight_vol = self._dense_block(voxel_min, (size + 1, size + 1, size + 1))
+            if not (tsdf_vol.min() < 0 < tsdf_vol.max()):
+                continue
+            verts = _marching_cubes(tsdf_vol)
+            verts_ind = np.round(verts).astype(int)
+
+            # remove false surface
+            verts_weight = weight_vol[verts_ind[:, 0], verts_ind[:, 1], verts_ind[:, 2]]
+            verts_val = tsdf_vol[verts_ind[:, 0], verts_ind[:, 1], verts_ind[:, 2]]
+            valid_idx = (verts_weight > 0) & (np.abs(verts_val) < 0.2)
+            verts_ind = verts_ind[valid_idx]
+            all_verts.append((verts[valid_idx] + voxel_min)*self._voxel_size + self._vol_origin)
+            all_colors.append(color_vol[verts_ind[:, 0], verts_ind[:, 1], verts_ind[:, 2]])
+        verts = np.concatenate(all_verts) if all_verts else np.zeros((0, 3))
+        rgb_vals = np.concatenate(all_colors) if all_colors else np.zeros(0)
+
+        # Get vertex colors
+        colors_b = np.floor(rgb_vals / self._color_const)
+        colors_g = np.floor((rgb_vals - colors_b*self._color_const) / 256)
+        colors_r = rgb_vals - colors_b*self._color_const - colors_g*256
+        colors = np.floor(np.asarray([colors_r, colors_g, colors_b])).T
+
+        surface_cloud = o3d.geometry.PointCloud()
+        surface_cloud.points = o3d.utility.Vector3dVector(verts)
+        surface_cloud.colors = o3d.utility.Vector3dVector(colors / 255)
+        surface_cloud = surface_cloud.voxel_down_sample(voxel_size=voxel_size)
+        return surface_cloud
+
+    def get_conservative_volume(self, voxel_size=0.01):
+        coords = self._brick_coords[:self._num_bricks]
+        slots, local = np.nonzero(self._tsdf_pool[:self._num_bricks] < -0.2)
+        ## local index is in (z, y, x) order
+        lz, ly, lx = np.unravel_index(local, (BRICK, BRICK, BRICK))
+        verts = coords[slots] * BRICK + np.stack([lx, ly, lz], axis=1)
+        verts = verts*self._voxel_size + self._vol_origin
+
+        conservative_volume = o3d.geometry.PointCloud()
+        conservative_volume.points = o3d.utility.Vector3dVector(verts)
+        conservative_volume = conservative_volume.voxel_down_sample(voxel_size=voxel_size)
+        return conservative_volume
+
+    def save(self, output_path):
+        np.savez_compressed(output_path,
+            vol_bounds=self._vol_bnds,
+            voxel_size=self._voxel_size,
+            trunc_margin=self._trunc_margin,
+            brick_coords=self._brick_coords[:self._num_bricks],
+            tsdf_pool=self._tsdf_pool[:self._num_bricks],
+            weight_pool=self._weight_pool[:self._num_bricks],
+            color_pool=self._color_pool[:self._num_bricks]
+        )
+        print(f"tsdf volume has been saved to: {output_path}")
+
+    @classmethod
+    def load(cls, input_path):
+        loaded = np.load(input_path)
+        num_bricks = loaded['brick_coords'].shape[0]
+        obj = cls(loaded['vol_bounds'], loaded['voxel_size'], loaded['trunc_margin'], initial_bricks=max(num_bricks, 4096))
+        obj._brick_coords[:num_bricks] = loaded['brick_coords']
+        obj._tsdf_pool[:num_bricks] = loaded['tsdf_pool']
+        obj._weight_pool[:num_bricks] = loaded['weight_pool']
+        obj._color_pool[:num_bricks] = loaded['color_pool']
+        obj._num_bricks = num_bricks
+        _rehash(obj._table_coords, obj._table_slots, obj._brick_coords, num_bricks)
+        print(f"tsdf volume has been loaded from: {input_path}")
+        return obj
+
+
+if __name__ == '__main__':
+    ## self-check: the same frames fused in the dense cpu volume and in the hashed volume, then a frame far outside the first bounds
+    from kernel.kf_pycuda.tsdf_cpu import TSDFVolumeCPU
+
+    im_h, im_w = 120, 160
+    cam_intr = np.array([[200., 0., 80.], [0., 200., 60.], [0., 0., 1.]])
+    v, u = np.mgrid[0:im_h, 0:im_w]
+    depth_im = (0.5 + 0.1 * np.sin(u / 20.0)).astype(np.float32)
+    color_im = np.zeros((im_h, im_w, 3), dtype=np.uint8)
+    color_im[..., 1] = 120
+    vol_bnds = np.array([[-0.25, 0.25], [-0.2, 0.2], [0.3, 0.7]])
+    dense = TSDFVolumeCPU(vol_bnds.copy(), voxel_size=0.005, trunc_margin=0.02)
+    sparse = TSDFVolumeHash(vol_bnds.copy(), voxel_size=0.005, trunc_margin=0.02, initial_bricks=16)
+    for _ in range(2):
+        dense.integrate(color_im, depth_im, cam_intr, np.eye(4))
+        sparse.integrate(color_im, depth_im, cam_intr, np.eye(4))
+    dense_depth, _ = dense.ray_casting(im_w, im_h, cam_intr, np.eye(4))
+    sparse_depth, sparse_color = sparse.ray_casting(im_w, im_h, cam_intr, np.eye(4))
+    both = (dense_depth > 0) & (sparse_depth > 0)
+    print("ray casting: {0:.1f}% / {1:.1f}% pixels hit (dense / hash), max difference {2:.4f} m, color {3}".format(
+        (dense_depth > 0).mean()*100, (sparse_depth > 0).mean()*100, np.abs(dense_depth - sparse_depth)[both].max(), sparse_color[both][0]))
+    print("memory: dense {0:.1f} MB, hash {1:.1f} MB in {2} bricks".format(
+        3 * dense._tsdf_vol.nbytes / 2**20, 3 * sparse._tsdf_pool[:sparse._num_bricks].nbytes / 2**20, sparse._num_bricks))
+    print("surface points: dense {0}, hash {1}".format(
+        len(dense.get_surface_cloud_marching_cubes().points), len(sparse.get_surface_cloud_marching_cubes().points)))
+    far_pose = np.eye(4)
+    far_pose[0, 3] = 2.0
+    sparse.integrate(color_im, depth_im, cam_intr, far_pose)
+    far_depth, _ = sparse.ray_casting(im_w, im_h, cam_intr, far_pose)
+    print("outside the first bounds: {0:.1f}% pixels hit, {1} bricks".format((far_depth > 0).mean()*100, sparse._num_bricks))
@@ -6,11 +6,43 @@ import os
 import json
 from skimage import measure
 
-import pycuda.autoinit
-import pycuda.driver as cuda
-from pycuda import gpuarray, cumath
+try:
+    import pycuda.autoinit
+    import pycuda.driver as cuda
+    from pycuda import gpuarray, cumath
 
-from kernel.kf_pycuda.cuda_kernels import source_module
+    from kernel.kf_pycuda.cuda_kernels import source_module
+    CUDA_AVAILABLE = True
+except Exception:
+    ## no pycuda or no GPU, only the CPU volume in tsdf_cpu.py could be used
+    CUDA_AVAILABLE = False
+
+
+def _marching_cubes(volume):
+    ## marching_cubes_classic is removed from recent scikit-image, lorensen is the same algorithm
+    if hasattr(measure, "marching_cubes_classic"):
+        return measure.marching_cubes_classic(volume, level=0)[0]
+    return measure.marching_cubes(volume, level=0, method='lorensen')[0]
+
+
+def get_tsdf_volume_class(backend="auto"):
+    """TSDF volume implementation of a backend
+
+    Args:
+        backend (str): ["cuda", "cpu", "hash" (sparse bricks on the cpu, unbounded) 
+                        or "auto" (cuda if pycuda works on this machine, cpu otherwise)]
+
+    Returns:
+        [type]: [class with the TSDFVolume interface]
+    """
+    assert backend in ["auto", "cuda", "cpu", "hash"]
+    if backend == "cuda" or (backend == "auto" and CUDA_AVAILABLE):
+        return TSDFVolume
+    if backend == "hash":
+        from kernel.kf_pycuda.tsdf_hash import TSDFVolumeHash
+        return TSDFVolumeHash
+    from kernel.kf_pycuda.tsdf_cpu import TSDFVolumeCPU
+    return TSDFVolumeCPU
 
 
 class TSDFVolume:
@@ -21,6 +53,8 @@ class TSDFVolume:
             vol_bnds (ndarray): An ndarray of shape (3, 2). Specifies the xyz bounds (min/max) in meters.
             voxel_size (float): The volume discretization in meters.
         """
+        if not CUDA_AVAILABLE:
+            raise RuntimeError("pycuda could not be initialized, use the cpu tsdf_backend")
         vol_bnds = np.asarray(vol_bnds)
         assert vol_bnds.shape == (3, 2), "[!] `vol_bnds` should be of shape (3, 2)."
 
@@ -172,7 +206,7 @@ class TSDFVolume:
         tsdf_vol, color_vol, weight_vol = self.get_volume()
 
         # Marching cubes
-        verts = measure.marching_cubes_classic(tsdf_vol, level=0)[0]
+        verts = _marching_cubes(tsdf_vol)
         verts_ind = np.round(verts).astype(int)
 
         # remove false surface
@@ -5,6 +5,7 @@ import open3d as o3d
 import numpy as np
 from numba import njit, prange
 import scipy.linalg as la
+from kernel.geometry import ransac_plane
 
 def timeit(f, n=1, need_compile=False):
     def wrapper(*args, **kwargs):
@@ -96,33 +97,11 @@ def plane_detection_ransac(pcd: o3d.geometry.PointCloud,
     num_pts = len(pcd.points)
     pts = np.asarray(pcd.points)
 
-    origin = None
-    plane_normal = None
-    max_inlier_ratio = 0
-    max_num_inliers = 0
-
-    for _ in range(max_iterations):
-        # sample 3 points from the point cloud
-        selected_indices = np.random.choice(num_pts, size=3, replace=False)
-        selected_pts = pts[selected_indices]
-        p1 = selected_pts[0]
-        v1 = selected_pts[1] - p1
-        v2 = selected_pts[2] - p1
-        normal = np.cross(v1, v2)
-        normal /= la.norm(normal)
-
-        dist = np.abs((pts - p1) @ normal)
-        num_inliers = np.sum(dist < inlier_thresh)
-        inlier_ratio = num_inliers / num_pts
-
-        if num_inliers > max_num_inliers:
-            max_num_inliers = num_inliers
-            origin = p1
-            plane_normal = normal
-            max_inlier_ratio = inlier_ratio
-
-        if inlier_ratio > early_stop_thresh:
-            break
+    ## hypotheses scored block-wise on a subsample, the best one refined on the whole cloud
+    plane_model, inliers = ransac_plane(pts, inlier_thresh, max_iterations=max_iterations, early_stop_ratio=early_stop_thresh)
+    plane_normal = np.array(plane_model[:3])
+    origin = pts[inliers].mean(axis=0)
+    max_inlier_ratio = len(inliers) / num_pts
     
     if plane_normal[2] < 0:
         plane_normal *= -1
@@ -153,11 +132,141 @@ def plane_detection_ransac(pcd: o3d.geometry.PointCloud,
     return plane_frame, max_inlier_ratio
 
 
+@njit(cache=True)
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@njit(cache=True)
+def _close_cells(pts, start_a, end_a, start_b, end_b, radius_sq):
+    # any point pair of the two cells closer than the radius
+    for i in range(start_a, end_a):
+        for j in range(start_b, end_b):
+            d = (pts[i, 0] - pts[j, 0]) ** 2 + (pts[i, 1] - pts[j, 1]) ** 2 + (pts[i, 2] - pts[j, 2]) ** 2
+            if d < radius_sq:
+                return True
+    return False
+
+
+@njit(cache=True)
+def _build_cell_table(cell_keys):
+    # open addressing hash table key -> cell index, the capacity is a power of 2 at least twice the number of cells
+    capacity = 1
+    while capacity < 2 * cell_keys.shape[0]:
+        capacity *= 2
+    table_keys = np.full(capacity, -1, dtype=np.int64)
+    table_cells = np.empty(capacity, dtype=np.int64)
+    for c in range(cell_keys.shape[0]):
+        slot = (cell_keys[c] * 0x5851F42D4C957F2D) & (capacity - 1)
+        while table_keys[slot] != -1:
+            slot = (slot + 1) & (capacity - 1)
+        table_keys[slot] = cell_keys[c]
+        table_cells[slot] = c
+    return table_keys, table_cells
+
+
+@njit(cache=True)
+def _lookup_cell(table_keys, table_cells, key):
+    capacity = table_keys.shape[0]
+    slot = (key * 0x5851F42D4C957F2D) & (capacity - 1)
+    while table_keys[slot] != -1:
+        if table_keys[slot] == key:
+            return table_cells[slot]
+        slot = (slot + 1) & (capacity - 1)
+    return -1
+
+
+@njit(cache=True)
+def _union_cells(pts, cell_keys, cell_starts, cell_coords, offsets, dims, radius_sq):
+    """union the occupied cells connected by at least one point pair closer than the radius
+
+    Args:
+        pts (np.ndarray): [N, 3 points sorted by cell]
+        cell_keys (np.ndarray): [sorted keys of the occupied cells]
+        cell_starts (np.ndarray): [M + 1 offsets of the points of each cell in pts]
+        cell_coords (np.ndarray): [M, 3 integer coordinates of the cells]
+        offsets (np.ndarray): [K, 3 half of the neighboring cell offsets, the other half is covered by symmetry]
+        dims (np.ndarray): [3 grid size]
+
+    Returns:
+        parent (np.ndarray): [union-find forest of the cells]
+    """
+    M = cell_keys.shape[0]
+    parent = np.arange(M)
+    table_keys, table_cells = _build_cell_table(cell_keys)
+    for c in range(M):
+        for k in range(offsets.shape[0]):
+            x = cell_coords[c, 0] + offsets[k, 0]
+            y = cell_coords[c, 1] + offsets[k, 1]
+            z = cell_coords[c, 2] + offsets[k, 2]
+            if x < 0 or y < 0 or z < 0 or x >= dims[0] or y >= dims[1] or z >= dims[2]:
+                continue
+            key = (x * dims[1] + y) * dims[2] + z
+            n = _lookup_cell(table_keys, table_cells, key)
+            if n < 0:
+                continue
+            root_c = _find(parent, c)
+            root_n = _find(parent, n)
+            # only the boundary between two different components is refined on the points
+            if root_c != root_n and _close_cells(pts, cell_starts[c], cell_starts[c + 1], cell_starts[n], cell_starts[n + 1], radius_sq):
+                parent[max(root_c, root_n)] = min(root_c, root_n)
+    for c in range(M):
+        parent[c] = _find(parent, c)
+    return parent
+
+
 def extract_euclidean_clusters(pcd: o3d.geometry.PointCloud,
                                search_radius: 0.03,
                                min_pts_per_cluster=100,
                                max_pts_per_cluster=np.inf):
-    """extract euclidean clusters from a point cloud
+    """extract euclidean clusters from a point cloud, i.e. connected components of the points closer than search_radius
+    The points are hashed into cells of size search_radius / sqrt(3), so the points of a cell are always connected, and
+    the neighboring cells are unioned when one of their point pairs is closer than search_radius
+
+    Args:
+        pcd (o3d.geometry.PointCloud): [input point cloud]
+        search_radius (0.03): [max radius during clustering]
+        min_pts_per_cluster (int, optional): [min number of points per cluster]. Defaults to 100.
+        max_pts_per_cluster ([type], optional): [max number of points per cluster]. Defaults to np.inf.
+
+    Returns:
+        [list]: [a list of clusters, each cluster is an array of point indices, ordered by their smallest point index]
+    """
+    pts = np.asarray(pcd.points)
+    if pts.shape[0] == 0:
+        return []
+    cell_size = search_radius / np.sqrt(3)
+    coords = np.floor((pts - pts.min(axis=0)) / cell_size).astype(np.int64)
+    dims = coords.max(axis=0) + 1
+    keys = (coords[:, 0] * dims[1] + coords[:, 1]) * dims[2] + coords[:, 2]
+    order = np.argsort(keys, kind='stable')
+    cell_keys, cell_starts, cell_of_pts = np.unique(keys[order], return_index=True, return_inverse=True)
+    cell_starts = np.append(cell_starts, len(order))
+    cell_coords = coords[order[cell_starts[:-1]]]
+
+    # cells within 2 steps can hold points closer than the radius, except the 8 corners (min distance sqrt(3) * cell_size)
+    offsets = np.array([(x, y, z) for x in range(-2, 3) for y in range(-2, 3) for z in range(-2, 3)
+                        if (x, y, z) > (0, 0, 0) and not (abs(x) == 2 and abs(y) == 2 and abs(z) == 2)], dtype=np.int64)
+    parent = _union_cells(np.ascontiguousarray(pts[order]), cell_keys, cell_starts, cell_coords, offsets, dims, search_radius ** 2)
+
+    labels = np.empty(len(order), dtype=np.int64)
+    labels[order] = parent[cell_of_pts.reshape(-1)]
+    # group the point indices by label, the clusters in the order of their first point
+    point_order = np.argsort(labels, kind='stable')
+    _, first, counts = np.unique(labels[point_order], return_index=True, return_counts=True)
+    clusters = np.split(point_order, first[1:])
+    clustered_indices = [clusters[i] for i in np.argsort(point_order[first]) if min_pts_per_cluster < counts[i] < max_pts_per_cluster]
+    return clustered_indices
+
+
+def _extract_euclidean_clusters_bfs(pcd: o3d.geometry.PointCloud,
+                                    search_radius: 0.03,
+                                    min_pts_per_cluster=100,
+                                    max_pts_per_cluster=np.inf):
+    """extract euclidean clusters from a point cloud by a BFS with one KD-tree query per point (reference of the benchmark)
     https://pcl.readthedocs.io/en/latest/cluster_extraction.html
     https://github.com/PointCloudLibrary/pcl/blob/master/segmentation/include/pcl/segmentation/impl/extract_clusters.hpp
 
@@ -239,8 +348,9 @@ def get_view_frustum(depth_im, cam_intr, cam_pose):
 if __name__ == '__main__':
 
     pcd = o3d.io.read_point_cloud('demo.pcd')
-    clusters = timeit(extract_euclidean_clusters)(pcd, search_radius=0.05)
-    print(len(clusters))
+    clusters_bfs = timeit(_extract_euclidean_clusters_bfs)(pcd, search_radius=0.05)
+    clusters = timeit(extract_euclidean_clusters, need_compile=True)(pcd, search_radius=0.05)
+    print(len(clusters_bfs), len(clusters))
     pcds = []
     for cluster in clusters:
         cluster_pcd = pcd.select_by_index(cluster)
@@ -7,19 +7,20 @@ from mathutils import Vector
 import json
 from tqdm import tqdm
 
-from kernel.geometry import _pose2Rotation, _rotation2Pose
+from kernel.pose_utility import pose2matrix, matrix2pose, inverse, axis_align
 from kernel.ply_importer.point_data_file_handler import(
     PointDataFileHandler
 )
 from kernel.ply_importer.utility import(
     draw_points
 )
-from kernel.utility import _transstring2trans, _parse_camfile
+from kernel.utility import _transstring2trans
+from kernel.campose_utility import read_campose
 
 from kernel.logging_utility import log_report
 from registeration.init_configuration import config_json_dict, decode_dict
 from kernel.blender_utility import \
-    _get_configuration, _get_obj_insameworkspace, _apply_trans2obj, \
+    _get_configuration, _get_obj_insameworkspace, _apply_trans2obj, _apply_trans2objs, \
     _clear_allrgbdcam_insameworkspace, _getsameinstance, _getnextperfixforinstance
 from kernel.utility import _select_sample_files, _generate_image_list
 import time
@@ -263,79 +264,73 @@ def load_reconstruction_result(filepath,
     depth_files = os.listdir(depth_path)
     
     ## load camera and image result
-    camera_lines = _parse_camfile(camera_rgb_file)
-    camera_selected_lines = _select_sample_files(camera_lines, IMPORT_RATIO)
+    camposes = read_campose(camera_rgb_file)
+    camposes = camposes.select(_select_sample_files(list(range(len(camposes))), IMPORT_RATIO))
     _clear_allrgbdcam_insameworkspace(bpy.context.scene.configuration[config_id])
-    for l in tqdm(camera_selected_lines):
-        data = l.split(" ")
-        if data[0].isnumeric():
-            pose = [[float(data[5]) * pointcloudscale, float(data[6]) * pointcloudscale, float(data[7]) * pointcloudscale], 
-                    [float(data[1]), float(data[2]), float(data[3]), float(data[4])]]
-            Axis_align = np.array([[1, 0, 0, 0],
-                                    [0, -1, 0, 0],
-                                    [0, 0, -1, 0],
-                                    [0, 0, 0, 1],]
-            )
-            Trans = _pose2Rotation(pose).dot(Axis_align) if not CAMPOSE_INVERSE else np.linalg.inv(_pose2Rotation(pose)).dot(Axis_align)
-            pose = _rotation2Pose(Trans)
-            framename = data[-1]
-            perfix = framename.split(".")[0]
-
-            cam_name = workspace_name + ":view" + perfix
-            if cam_name in bpy.data.objects:
-                cam_object = bpy.data.objects[cam_name]
-                cam_object.location = pose[0]
-                cam_object.rotation_quaternion = pose[1]
-            elif perfix + ".png" in rgb_files and perfix + ".png" in depth_files:
-                cam_data = bpy.data.cameras.new(cam_name)
-                cam_data.lens = bpy.context.scene.configuration[config_id].lens
-                f = (bpy.context.scene.configuration[config_id].fx + bpy.context.scene.configuration[config_id].fy)/2
-                cam_data.sensor_width = cam_data.lens * bpy.context.scene.configuration[config_id].resX/f
-                cam_data.shift_x = (bpy.context.scene.configuration[config_id].resX/2 - bpy.context.scene.configuration[config_id].cx)/bpy.context.scene.configuration[config_id].resX
-                ### divide resX not resY
-                cam_data.shift_y = (bpy.context.scene.configuration[config_id].cy - bpy.context.scene.configuration[config_id].resY/2)/bpy.context.scene.configuration[config_id].resX
-                cam_data.display_size = camera_display_scale
-                ## allow background display
-                cam_data.background_images.new()
-
-                cam_object = bpy.data.objects.new(cam_name, cam_data)
-                cam_collection.objects.link(cam_object)
-                cam_object.rotation_mode = 'QUATERNION'
-                cam_object.location = pose[0]
-                cam_object.rotation_quaternion = pose[1]
-                ## load rgb
-                rgb_name = workspace_name + ":rgb" + perfix
-                if rgb_name not in bpy.data.images:
-                    bpy.ops.image.open(filepath=os.path.join(rgb_path, perfix + ".png"), 
-                                        directory=rgb_path, 
-                                        files=[{"name":perfix + ".png"}], 
-                                        relative_path=True, show_multiview=False)
-                    bpy.data.images[perfix + ".png"].name = rgb_name
-                bpy.data.images[rgb_name]["UPDATEALPHA"] = True
-                bpy.data.images[rgb_name]["alpha"] = [0.5]
-                ## load depth
-                depth_name = workspace_name + ":depth" + perfix
-                if depth_name not in bpy.data.images:
-                    bpy.ops.image.open(filepath=os.path.join(depth_path, perfix + ".png"), 
-                                        directory=depth_path, 
-                                        files=[{"name":perfix + ".png"}], 
-                                        relative_path=True, show_multiview=False)
-                    bpy.data.images[perfix + ".png"].name = depth_name
-                    depth = np.array(Image.open(os.path.join(depth_path, perfix + ".png")))
-                    depth = depth[::-1, ::]
-                    bpy.data.images[depth_name]["depth"] = depth.flatten().astype(np.float32)
-                bpy.data.images[depth_name]["UPDATEALPHA"] = True
-                bpy.data.images[depth_name]["alpha"] = [0.5]
-                cam_object["depth"] = bpy.data.images[depth_name]
-                cam_object["rgb"] = bpy.data.images[rgb_name]
-                cam_object["type"] = "camera" 
+    ## all the camera poses converted at once, (x, y, z, qw, qx, qy, qz)
+    poses = camposes.poses()
+    poses[:, :3] = poses[:, :3] * pointcloudscale
+    Trans = pose2matrix(poses) if not CAMPOSE_INVERSE else inverse(pose2matrix(poses))
+    camera_poses = matrix2pose(axis_align(Trans)).tolist()
+    for framename, pose in tqdm(zip(camposes.names, camera_poses), total = len(camposes)):
+        pose = [pose[:3], pose[3:]]
+        perfix = framename.split(".")[0]
+
+        cam_name = workspace_name + ":view" + perfix
+        if cam_name in bpy.data.objects:
+            cam_object = bpy.data.objects[cam_name]
+            cam_object.location = pose[0]
+            cam_object.rotation_quaternion = pose[1]
+        elif perfix + ".png" in rgb_files and perfix + ".png" in depth_files:
+            cam_data = bpy.data.cameras.new(cam_name)
+            cam_data.lens = bpy.context.scene.configuration[config_id].lens
+            f = (bpy.context.scene.configuration[config_id].fx + bpy.context.scene.configuration[config_id].fy)/2
+            cam_data.sensor_width = cam_data.lens * bpy.context.scene.configuration[config_id].resX/f
+            cam_data.shift_x = (bpy.context.scene.configuration[config_id].resX/2 - bpy.context.scene.configuration[config_id].cx)/bpy.context.scene.configuration[config_id].resX
+            ### divide resX not resY
+            cam_data.shift_y = (bpy.context.scene.configuration[config_id].cy - bpy.context.scene.configuration[config_id].resY/2)/bpy.context.scene.configuration[config_id].resX
+            cam_data.display_size = camera_display_scale
+            ## allow background display
+            cam_data.background_images.new()
+
+            cam_object = bpy.data.objects.new(cam_name, cam_data)
+            cam_collection.objects.link(cam_object)
+            cam_object.rotation_mode = 'QUATERNION'
+            cam_object.location = pose[0]
+            cam_object.rotation_quaternion = pose[1]
+            ## load rgb
+            rgb_name = workspace_name + ":rgb" + perfix
+            if rgb_name not in bpy.data.images:
+                bpy.ops.image.open(filepath=os.path.join(rgb_path, perfix + ".png"), 
+                                    directory=rgb_path, 
+                                    files=[{"name":perfix + ".png"}], 
+                                    relative_path=True, show_multiview=False)
+                bpy.data.images[perfix + ".png"].name = rgb_name
+            bpy.data.images[rgb_name]["UPDATEALPHA"] = True
+            bpy.data.images[rgb_name]["alpha"] = [0.5]
+            ## load depth
+            depth_name = workspace_name + ":depth" + perfix
+            if depth_name not in bpy.data.images:
+                bpy.ops.image.open(filepath=os.path.join(depth_path, perfix + ".png"), 
+                                    directory=depth_path, 
+                                    files=[{"name":perfix + ".png"}], 
+                                    relative_path=True, show_multiview=False)
+                bpy.data.images[perfix + ".png"].name = depth_name
+                depth = np.array(Image.open(os.path.join(depth_path, perfix + ".png")))
+                depth = depth[::-1, ::]
+                bpy.data.images[depth_name]["depth"] = depth.flatten().astype(np.float32)
+            bpy.data.images[depth_name]["UPDATEALPHA"] = True
+            bpy.data.images[depth_name]["alpha"] = [0.5]
+            cam_object["depth"] = bpy.data.images[depth_name]
+            cam_object["rgb"] = bpy.data.images[rgb_name]
+            cam_object["type"] = "camera" 
     
     obj_lists = _get_obj_insameworkspace(cam_object, ["reconstruction", "camera"])
     _, config = _get_configuration(cam_object)
 
     trans = _transstring2trans(config.recon_trans)
+    _apply_trans2objs(obj_lists, trans)
     for obj in obj_lists:
-        _apply_trans2obj(obj, trans)  
         if obj['type'] == 'reconstruction':
             obj["alignT"] = trans.tolist()      
     
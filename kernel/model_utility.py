@@ -0,0 +1,166 @@
+import os
+import json
+import shutil
+import numpy as np
+import trimesh
+
+## meshes already loaded by this process, keyed by (path, size, mtime), shared by all the instances of a model
+_MESHES = {}
+## number of levels of detail, the cell size of level l is the bounding box diagonal / 2^(l + 3)
+LOD_LEVELS = 8
+
+
+def _cache_dir(path):
+    ## hidden next to the model file, e.g. modelsrc/mug/.mug.obj.cache
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".cache")
+
+
+def _model_key(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def save_model_arrays(path, vertices, faces, normals):
+    """
+    Write the binary cache entry of a model file, the entry holds until the model file is modified
+    Args:
+        path: path of the model file (.obj)
+        vertices: [N, 3] vertices
+        faces: [M, 3] triangles
+        normals: [N, 3] vertex normals
+    """
+    cache = _cache_dir(path)
+    ## written aside and renamed, other processes never see a partial entry
+    tmp = "{0}.{1}.tmp".format(cache, os.getpid())
+    try:
+        os.makedirs(tmp, exist_ok = True)
+        np.save(os.path.join(tmp, "vertices.npy"), np.ascontiguousarray(vertices, dtype = np.float32))
+        np.save(os.path.join(tmp, "faces.npy"), np.ascontiguousarray(faces, dtype = np.uint32))
+        np.save(os.path.join(tmp, "normals.npy"), np.ascontiguousarray(normals, dtype = np.float32))
+        with open(os.path.join(tmp, "key.json"), "w") as f:
+            json.dump(_model_key(path), f)
+        if os.path.exists(cache):
+            shutil.rmtree(cache, ignore_errors = True)
+        os.rename(tmp, cache)
+    except OSError:
+        ## the cache is optional, e.g. the model folder could be read only or another process wrote the entry first
+        shutil.rmtree(tmp, ignore_errors = True)
+
+
+def _load_model_cache(path, prefix = "", names = ("vertices", "faces", "normals")):
+    ## prefix selects the level of detail files, stored in the same entry
+    cache = _cache_dir(path)
+    try:
+        with open(os.path.join(cache, "key.json"), "r") as f:
+            if json.load(f) != _model_key(path):
+                return None
+        return tuple(np.load(os.path.join(cache, prefix + name + ".npy"), mmap_mode = "r") for name in names)
+    except (OSError, ValueError):
+        return None
+
+
+def load_model_arrays(path, CACHE = True):
+    """
+    Vertices, triangles and vertex normals of a model, the model file is only parsed when its cache entry is missing or stale
+    Args:
+        path: path of the model file (.obj)
+        CACHE: read and write the binary cache entry next to the model file
+    Returns:
+        vertices: [N, 3] float32
+        faces: [M, 3] uint32
+        normals: [N, 3] float32
+        memory mapped from the cache entry when it exists
+    """
+    if CACHE:
+        arrays = _load_model_cache(path)
+        if arrays is not None:
+            return arrays
+    tm = trimesh.load(path, force = "mesh")
+    arrays = (np.asarray(tm.vertices, dtype = np.float32), np.asarray(tm.faces, dtype = np.uint32), np.asarray(tm.vertex_normals, dtype = np.float32))
+    if CACHE:
+        save_model_arrays(path, *arrays)
+    return arrays
+
+
+def load_mesh(path, CACHE = True):
+    """
+    trimesh.Trimesh of a model, loaded once per process and shared by all the callers, do not modify it in place
+    """
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _MESHES:
+        vertices, faces, normals = load_model_arrays(path, CACHE = CACHE)
+        _MESHES[key] = trimesh.Trimesh(vertices = vertices, faces = faces, vertex_normals = normals, process = False)
+    return _MESHES[key]
+
+
+def lod_cell_size(bounds, level):
+    """
+    Cell size of the vertex clustering of a level of detail
+    Args:
+        bounds: [2, 3] bounding box of the model
+    """
+    return np.linalg.norm(bounds[1] - bounds[0]) / 2 ** (level + 3)
+
+
+def decimate_vertex_clustering(vertices, faces, cell_size):
+    """
+    Merge the vertices in the cells of a regular grid into their mean, the collapsed triangles are removed.
+    Every vertex, and so every point of the surface, moves by at most the returned error, less than the cell diagonal
+    Args:
+        vertices: [N, 3] vertices
+        faces: [M, 3] triangles
+        cell_size: edge of the cells
+    Returns:
+        vertices: [N', 3] float64
+        faces: [M', 3] int64
+        error: largest distance between a vertex and the vertex it is merged into
+    """
+    vertices = np.asarray(vertices, dtype = np.float64)
+    faces = np.asarray(faces, dtype = np.int64)
+    cells = np.floor((vertices - vertices.min(axis = 0)) / cell_size).astype(np.int64)
+    dims = cells.max(axis = 0) + 1
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    _, cluster, counts = np.unique(keys, return_inverse = True, return_counts = True)
+    cluster = cluster.reshape(-1)
+    merged = np.stack([np.bincount(cluster, weights = vertices[:, k], minlength = len(counts)) for k in range(3)], axis = 1) / counts[:, None]
+    error = np.sqrt(np.max(np.sum((vertices - merged[cluster]) ** 2, axis = 1))) if len(vertices) > 0 else 0.
+    faces = cluster[faces]
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+    ## the vertices of the collapsed triangles only are dropped
+    used, faces = np.unique(faces, return_inverse = True)
+    return merged[used], faces.reshape(-1, 3), error
+
+
+def load_model_lod(path, level, CACHE = True):
+    """
+    Level of detail of a model (decimate_vertex_clustering with lod_cell_size), built once and kept in the cache entry of the model
+    Args:
+        path: path of the model file (.obj)
+        level: 0 (coarsest) to LOD_LEVELS - 1
+    Returns:
+        vertices, faces, normals as load_model_arrays
+        error: geometric error of the level, no point of the surface moved further
+    """
+    prefix = "lod{0}_".format(level)
+    names = ("vertices", "faces", "normals", "error")
+    if CACHE:
+        arrays = _load_model_cache(path, prefix, names)
+        if arrays is not None:
+            return arrays[:3] + (float(arrays[3]),)
+    vertices, faces, _ = load_model_arrays(path, CACHE = CACHE)
+    vertices, faces, error = decimate_vertex_clustering(vertices, faces, lod_cell_size(np.array([vertices.min(axis = 0), vertices.max(axis = 0)]), level))
+    normals = trimesh.Trimesh(vertices = vertices, faces = faces, process = False).vertex_normals
+    arrays = (vertices.astype(np.float32), faces.astype(np.uint32), np.asarray(normals, dtype = np.float32), np.float64(error))
+    if CACHE and _load_model_cache(path) is not None:
+        cache = _cache_dir(path)
+        ## the error is written last, it marks a complete level
+        for name, array in zip(names, arrays):
+            tmp = os.path.join(cache, "{0}{1}.{2}.tmp.npy".format(prefix, name, os.getpid()))
+            try:
+                np.save(tmp, array)
+                os.replace(tmp, os.path.join(cache, prefix + name + ".npy"))
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+    return arrays[:3] + (float(error),)
@@ -0,0 +1,167 @@
+import numpy as np
+
+## flip between the camera frame of the reconstruction (y down, z forward) and the blender/pyrender camera (y up, z backward)
+AXIS_ALIGN = np.array([[1, 0, 0, 0],
+                       [0, -1, 0, 0],
+                       [0, 0, -1, 0],
+                       [0, 0, 0, 1],], dtype = np.float64)
+
+
+def quaternion2matrix(q):
+    """
+    Args:
+        q: [N, 4] quaternions (qw, qx, qy, qz), not necessarily normalized
+    Returns:
+        [N, 3, 3] rotation matrices
+    """
+    q = np.asarray(q, dtype = np.float64)
+    ## the norm of every quaternion with the dot product of np.linalg.norm on a single vector (geometry._pose2Rotation),
+    ## np.linalg.norm(axis = -1) sums in another order and the matrices would differ in the last bits
+    q = q / np.sqrt(np.matmul(q[..., None, :], q[..., :, None]))[..., 0]
+    q0, q1, q2, q3 = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    R = np.empty(q.shape[:-1] + (3, 3))
+    R[..., 0, 0] = 2 * (q0 * q0 + q1 * q1) - 1
+    R[..., 0, 1] = 2 * (q1 * q2 - q0 * q3)
+    R[..., 0, 2] = 2 * (q1 * q3 + q0 * q2)
+    R[..., 1, 0] = 2 * (q1 * q2 + q0 * q3)
+    R[..., 1, 1] = 2 * (q0 * q0 + q2 * q2) - 1
+    R[..., 1, 2] = 2 * (q2 * q3 - q0 * q1)
+    R[..., 2, 0] = 2 * (q1 * q3 - q0 * q2)
+    R[..., 2, 1] = 2 * (q2 * q3 + q0 * q1)
+    R[..., 2, 2] = 2 * (q0 * q0 + q3 * q3) - 1
+    return R
+
+
+def matrix2quaternion(R):
+    """
+    Same branches as geometry._rotation2Pose, so the sign of the quaternions is the same
+    Args:
+        R: [N, 3, 3] rotation matrices
+    Returns:
+        [N, 4] quaternions (qw, qx, qy, qz)
+    """
+    m = np.asarray(R, dtype = np.float64)
+    m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+    tr = m00 + m11 + m22
+    case_w = tr > 0
+    case_x = ~case_w & (m00 > m11) & (m00 > m22)
+    case_y = ~case_w & ~case_x & (m11 > m22)
+    case_z = ~case_w & ~case_x & ~case_y
+    ## every branch only divides by its own S, which is > 0 where the branch is taken
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        S = np.select([case_w, case_x, case_y, case_z],
+                      [np.sqrt(np.maximum(tr + 1., 0)), np.sqrt(np.maximum(1. + m00 - m11 - m22, 0)),
+                       np.sqrt(np.maximum(1. + m11 - m22 - m00, 0)), np.sqrt(np.maximum(1. + m22 - m11 - m00, 0))]) * 2
+        q = np.empty(m.shape[:-2] + (4,))
+        q[..., 0] = np.select([case_w, case_x, case_y, case_z], [S / 4, (m21 - m12) / S, (m02 - m20) / S, (m10 - m01) / S])
+        q[..., 1] = np.select([case_w, case_x, case_y, case_z], [(m21 - m12) / S, S / 4, (m01 + m10) / S, (m02 + m20) / S])
+        q[..., 2] = np.select([case_w, case_x, case_y, case_z], [(m02 - m20) / S, (m01 + m10) / S, S / 4, (m12 + m21) / S])
+        q[..., 3] = np.select([case_w, case_x, case_y, case_z], [(m10 - m01) / S, (m02 + m20) / S, (m12 + m21) / S, S / 4])
+    return q
+
+
+def pose2matrix(poses):
+    """
+    Args:
+        poses: [N, 7] poses (x, y, z, qw, qx, qy, qz), the layout of campose.txt and geometry._pose2Rotation
+    Returns:
+        [N, 4, 4] transformations
+    """
+    poses = np.asarray(poses, dtype = np.float64)
+    T = np.zeros(poses.shape[:-1] + (4, 4))
+    T[..., :3, :3] = quaternion2matrix(poses[..., 3:])
+    T[..., :3, 3] = poses[..., :3]
+    T[..., 3, 3] = 1
+    return T
+
+
+def matrix2pose(T):
+    """
+    Args:
+        T: [N, 4, 4] transformations
+    Returns:
+        [N, 7] poses (x, y, z, qw, qx, qy, qz)
+    """
+    T = np.asarray(T, dtype = np.float64)
+    return np.concatenate([T[..., :3, 3], matrix2quaternion(T[..., :3, :3])], axis = -1)
+
+
+def compose(A, B):
+    """
+    A @ B for [N, 4, 4] (or broadcastable) transformations
+    """
+    return np.matmul(A, B)
+
+
+def inverse(T):
+    """
+    Inverse of [N, 4, 4] rigid transformations, (R, t)^-1 = (R^T, -R^T t)
+    """
+    T = np.asarray(T, dtype = np.float64)
+    Rt = np.swapaxes(T[..., :3, :3], -1, -2)
+    T_inv = np.zeros(T.shape)
+    T_inv[..., :3, :3] = Rt
+    T_inv[..., :3, 3] = -np.matmul(Rt, T[..., :3, 3, None])[..., 0]
+    T_inv[..., 3, 3] = 1
+    return T_inv
+
+
+def axis_align(T):
+    """
+    T @ AXIS_ALIGN for [N, 4, 4] transformations, the y and z axes of the rotation are flipped
+    """
+    T = np.array(T, dtype = np.float64)
+    T[..., :3, 1:3] *= -1
+    return T
+
+
+if __name__ == "__main__":
+    ## micro-benchmark against the per pose conversions of kernel.geometry
+    import os
+    import sys
+    import time
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from kernel.geometry import _pose2Rotation, _rotation2Pose
+
+    N = 100000
+    rng = np.random.default_rng(0)
+    poses = np.concatenate([rng.normal(size = (N, 3)), rng.normal(size = (N, 4))], axis = 1)
+
+    start = time.time()
+    T_ref = np.stack([_pose2Rotation([pose[:3], pose[3:]]) for pose in poses])
+    t_pose2rot = time.time() - start
+    start = time.time()
+    T = pose2matrix(poses)
+    t_pose2matrix = time.time() - start
+    assert np.array_equal(T, T_ref)
+
+    start = time.time()
+    P_ref = np.array([np.concatenate(_rotation2Pose(t)) for t in T_ref])
+    t_rot2pose = time.time() - start
+    start = time.time()
+    P = matrix2pose(T_ref)
+    t_matrix2pose = time.time() - start
+    assert np.allclose(P, P_ref)
+
+    start = time.time()
+    Tinv_ref = np.stack([np.linalg.inv(t) for t in T_ref])
+    t_inv = time.time() - start
+    start = time.time()
+    Tinv = inverse(T_ref)
+    t_inverse = time.time() - start
+    assert np.allclose(Tinv, Tinv_ref)
+
+    start = time.time()
+    A_ref = np.stack([t.dot(AXIS_ALIGN) for t in T_ref])
+    t_dot = time.time() - start
+    start = time.time()
+    A = axis_align(T_ref)
+    t_align = time.time() - start
+    assert np.array_equal(A, A_ref)
+
+    print("{0} poses".format(N))
+    for name, t_loop, t_batch in [("pose -> matrix", t_pose2rot, t_pose2matrix), ("matrix -> pose", t_rot2pose, t_matrix2pose),
+                                  ("inverse", t_inv, t_inverse), ("axis align", t_dot, t_align)]:
+        print("{0:>16}: per pose {1:8.1f} ms, batched {2:6.1f} ms, x{3:.0f}".format(name, t_loop * 1000, t_batch * 1000, t_loop / t_batch))
@@ -1,7 +1,9 @@
 from kernel.kf_pycuda.config import set_config, print_config
 from kernel.kf_pycuda.kinect_fusion import KinectFusion
 from offline.parse import offlineParam
-from kernel.geometry import _pose2Rotation
+from kernel.pose_utility import inverse
+from kernel.campose_utility import read_campose
+from kernel.frame_utility import FrameReader
 from tqdm import tqdm
 from PIL import Image
 import os
@@ -13,24 +15,20 @@ def KinectfusionRecon(
     data_folder, save_folder, prefix_list,
     resX, resY, fx, fy, cx, cy, 
     tsdf_voxel_size, tsdf_trunc_margin, pcd_voxel_size, depth_scale, depth_ignore, 
-    DISPLAY, frame_per_display,
+    DISPLAY, frame_per_display, lookahead = 8, tsdf_backend = "auto", icp_method = "multiscale",
     ):
     depth_path = os.path.join(data_folder, "depth")
     color_path = os.path.join(data_folder, "rgb")
 
-    config = set_config(resX, resY, fx, fy, cx, cy, tsdf_voxel_size, tsdf_trunc_margin, pcd_voxel_size)
+    config = set_config(resX, resY, fx, fy, cx, cy, tsdf_voxel_size, tsdf_trunc_margin, pcd_voxel_size, tsdf_backend = tsdf_backend, icp_method = icp_method)
     kf = KinectFusion(cfg=config)
     print_config(config)
 
 
-    for idx, prefix in enumerate(tqdm(prefix_list)):
-        color_im_path = os.path.join(color_path, prefix + '.png')
-        depth_im_path = os.path.join(depth_path, prefix + '.png')
-        
-        color_im = np.asarray(Image.open(color_im_path))
-        depth_im = np.asarray(Image.open(depth_im_path)).astype(np.float32) * depth_scale
-        depth_im[depth_im > depth_ignore] = 0
-
+    ## frames are decoded on background threads while the previous ones are tracked
+    frames = FrameReader([(os.path.join(color_path, prefix + '.png'), os.path.join(depth_path, prefix + '.png')) for prefix in prefix_list], 
+                         depth_scale, depth_ignore, lookahead = lookahead)
+    for idx, (color_im, depth_im) in enumerate(tqdm(frames)):
         kf.update(color_im, depth_im)
         # if (idx + 1) % 500 == 0:
         #     kf.save(save_folder)
@@ -38,28 +36,23 @@ def KinectfusionRecon(
 
 def poseFusion(
     param_path,
-    tsdf_voxel_size, tsdf_trunc_margin, pcd_voxel_size, depth_ignore, MAXFRAME = 200
+    tsdf_voxel_size, tsdf_trunc_margin, pcd_voxel_size, depth_ignore, MAXFRAME = 200, tsdf_backend = "auto"
     ):
     def parsecamfile(param):
-        param.camposes = {}
-        f = open(os.path.join(param.reconstructionsrc, "campose.txt"))
-        lines = f.readlines()
-        for l in lines:
-            datas = l.split(" ")
-            if datas[0].isnumeric():
-                param.camposes[datas[-1].split("\n")[0]] = _pose2Rotation([[float(datas[5]), float(datas[6]), float(datas[7])],\
-                                                        [float(datas[1]), float(datas[2]), float(datas[3]), float(datas[4])]])
+        camposes = read_campose(os.path.join(param.reconstructionsrc, "campose.txt"))
+        param.camposes = dict(zip(camposes.names, camposes.matrices()))
 
     def applytrans2cam(param):
+        if len(param.camposes) == 0:
+            return
         scale = param.recon["scale"]
         trans = param.recon["trans"]
-        for cam in param.camposes:
-            origin_pose = param.camposes[cam]
-            origin_pose[:3, 3] = origin_pose[:3, 3] * scale
-            # origin_pose = np.linalg.inv(origin_pose).dot(Axis_align)
-            if param.camera["inverse_pose"]:
-                origin_pose = np.linalg.inv(origin_pose)
-            param.camposes[cam] = trans.dot(origin_pose)  
+        origin_poses = np.stack(list(param.camposes.values()))
+        origin_poses[:, :3, 3] = origin_poses[:, :3, 3] * scale
+        # origin_poses = axis_align(inverse(origin_poses))
+        if param.camera["inverse_pose"]:
+            origin_poses = inverse(origin_poses)
+        param.camposes = dict(zip(param.camposes.keys(), np.matmul(trans, origin_poses)))
     
     param = offlineParam(param_path)
     parsecamfile(param)
@@ -70,7 +63,8 @@ def poseFusion(
     config = set_config(param.camera["resolution"][0], param.camera["resolution"][1], 
                         param.camera["intrinsic"][0, 0], param.camera["intrinsic"][1, 1],
                         param.camera["intrinsic"][0, 2], param.camera["intrinsic"][1, 2], 
-                        tsdf_voxel_size = tsdf_voxel_size, tsdf_trunc_margin = tsdf_trunc_margin, pcd_voxel_size = pcd_voxel_size)
+                        tsdf_voxel_size = tsdf_voxel_size, tsdf_trunc_margin = tsdf_trunc_margin, pcd_voxel_size = pcd_voxel_size, 
+                        tsdf_backend = tsdf_backend)
     depth_ignore = depth_ignore
     kf = KinectFusion(cfg=config)
     frame_keys = list(param.camposes.keys())
@@ -82,12 +76,8 @@ def poseFusion(
 
     #     depth[depth > depth_ignore] = 0
     #     kf.update(rgb, depth, param.camposes[frame])
-    for frame_id in tqdm(range(min(len(param.camposes), MAXFRAME))):
-        frame = frame_keys[int(frame_id)] if ratio <= 1 else frame_keys[int(frame_id * ratio)]
-        rgb = np.array(Image.open(os.path.join(rgb_path, frame)))
-        depth = np.array(Image.open(os.path.join(depth_path, frame))).astype(np.float32) * param.data['depth_scale']
-
-        depth[depth > depth_ignore] = 0
+    frames = [frame_keys[int(frame_id)] if ratio <= 1 else frame_keys[int(frame_id * ratio)] for frame_id in range(min(len(param.camposes), MAXFRAME))]
+    for frame, (rgb, depth) in zip(frames, tqdm(FrameReader.from_names(param.datasrc, frames, param.data['depth_scale'], depth_ignore))):
         kf.update(rgb, depth, param.camposes[frame])
     surface = kf.tsdf_volume.get_surface_cloud_marching_cubes(voxel_size=pcd_voxel_size)
     o3d.io.write_point_cloud(os.path.join(param.reconstructionsrc, 'depthfused.ply'), surface)
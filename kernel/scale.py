@@ -2,7 +2,9 @@ from scipy.spatial.transform import Rotation as R
 import numpy as np
 from PIL import Image
 import os
+from concurrent.futures import ThreadPoolExecutor
 from kernel.logging_utility import log_report
+from kernel.colmap.colmap_utility import find_binary_model, read_images_binary, read_points3D_binary
 
 def _parseImagesFile(filename, Camera_dict, PointsDict):
     with open(filename) as f:
@@ -96,6 +98,171 @@ def _calculateDepth(THRESHOLD, NUM_THRESHOLD, PointsDepth):
     else:
         return total_scale/number
 
+def _colmapPoses(qvec, tvec):
+    ## [N, 4] (qw, qx, qy, qz) and [N, 3] translations to [N, 4, 4]
+    T = np.zeros((len(qvec), 4, 4))
+    T[:, :3, :3] = R.from_quat(np.asarray(qvec)[:, [1, 2, 3, 0]]).as_matrix() if len(qvec) else np.empty((0, 3, 3))
+    T[:, :3, 3] = tvec
+    T[:, 3, 3] = 1
+    return T
+
+
+def _parseImagesArrays(filename):
+    """
+    Columnar version of _parseImagesFile
+    Returns:
+        cameras: dict with "id" [C], "name" list of C, "pose" [C, 4, 4] in the file order
+        observations: dict with "camera" [M] camera index (not id), "point" [M] point id, "px" [M], "py" [M] in the file order, the observations without point are dropped
+    """
+    camera_ids, camera_names, camera_poses = [], [], []
+    obs_camera, obs_values = [], []
+    with open(filename) as f:
+        lines = f.readlines()
+    for line in lines:
+        if line.startswith("#"):
+            continue
+        words = line.split(" ")
+        if '\n' in words:
+            words = words[:-1]
+        if words[0].isnumeric() and words[-1].endswith(".png\n"):
+            camera_ids.append(int(words[0]))
+            camera_names.append(words[-1].split("\n")[0])
+            camera_poses.append([float(w) for w in words[1:8]])
+        else:
+            values = np.array(line.split(), dtype = np.float64).reshape(-1, 3)
+            values = values[values[:, 2] != -1]
+            obs_camera.append(np.full(len(values), len(camera_ids) - 1, dtype = np.int64))
+            obs_values.append(values)
+    camera_poses = np.array(camera_poses, dtype = np.float64).reshape(-1, 7)
+    T = _colmapPoses(camera_poses[:, :4], camera_poses[:, 4:7])
+    obs_values = np.concatenate(obs_values) if obs_values else np.empty((0, 3))
+    cameras = {"id": np.array(camera_ids, dtype = np.int64), "name": camera_names, "pose": T}
+    observations = {"camera": np.concatenate(obs_camera) if obs_camera else np.empty(0, dtype = np.int64),
+                    "point": obs_values[:, 2].astype(np.int64), "px": obs_values[:, 0], "py": obs_values[:, 1]}
+    return cameras, observations
+
+
+def _parsePoints3DArrays(filename):
+    """
+    Columnar version of _parsePoints3D
+    Returns:
+        dict with "id" [P] sorted point ids, "location" [P, 3], "error" [P]
+    """
+    with open(filename) as f:
+        lines = [line for line in f.readlines() if not line.split(" ")[0] == '#']
+    values = np.array([line.split(" ")[:8] for line in lines], dtype = np.float64).reshape(-1, 8)
+    order = np.argsort(values[:, 0], kind = 'stable')
+    return {"id": values[order, 0].astype(np.int64), "location": values[order, 1:4], "error": values[order, 7]}
+
+
+def _readColmapArrays(path):
+    """
+    Cameras, observations and points of _parseImagesArrays and _parsePoints3DArrays, read from the binary model
+    (images.bin, points3D.bin in path or path/0) when there is one, else from images.txt and points3D.txt in path
+    """
+    binary_path = find_binary_model(path)
+    if binary_path is None:
+        return _parseImagesArrays(os.path.join(path, "images.txt")) + (_parsePoints3DArrays(os.path.join(path, "points3D.txt")),)
+    images, names, observations = read_images_binary(os.path.join(binary_path, "images.bin"))
+    observations = observations[observations["point3D_id"] != -1]
+    cameras = {"id": images["id"].astype(np.int64), "name": names, "pose": _colmapPoses(images["qvec"], images["tvec"])}
+    observations = {"camera": observations["image"], "point": observations["point3D_id"], "px": observations["x"], "py": observations["y"]}
+    points3D = read_points3D_binary(os.path.join(binary_path, "points3D.bin"))
+    order = np.argsort(points3D["id"], kind = 'stable')
+    points = {"id": points3D["id"][order].astype(np.int64), "location": points3D["xyz"][order], "error": points3D["error"][order]}
+    return cameras, observations, points
+
+
+def _sampleDepth(depth_path, depth_scale, px, py):
+    with Image.open(depth_path) as im:
+        depth = np.array(im) * depth_scale
+    ## same pixel as _depthInterpolation(depth, py, px)
+    return depth[np.floor(py).astype(np.int64), np.floor(px).astype(np.int64)]
+
+
+def _scaleForDepthArrays(cameras, observations, points, depthpath, depth_scale, POSE_INVERSE = True, num_threads = None, progress = None):
+    """
+    Columnar version of _parseImagesFile + _scaleFordepth, the depth frames are loaded in parallel and each of them sampled by one fancy-index
+    Args:
+        depthpath: folder of the depth frames named as the cameras
+        progress: optional wrapper of the iterator over the cameras, e.g. tqdm
+    Returns:
+        point [K] point ids, camera [K] camera indices and scale [K] depth_real/depth_recon, one per (point, camera), 
+        ordered as PointsDepth (points by first observation, then cameras in the file order)
+    """
+    cam = observations["camera"]
+    pid = observations["point"]
+    ## a point observed twice by a camera keeps the last observation, as in the dictionaries
+    key = cam * (pid.max() + 1 if len(pid) else 1) + pid
+    _, last = np.unique(key[::-1], return_index = True)
+    keep = np.sort(len(key) - 1 - last)
+    _, first, inverse = np.unique(pid, return_index = True, return_inverse = True)
+    point_rank = np.empty(len(first), dtype = np.int64)
+    point_rank[np.argsort(first, kind = 'stable')] = np.arange(len(first))
+    rank = point_rank[inverse.reshape(-1)]
+    keep = keep[np.lexsort((cam[keep], rank[keep]))]
+
+    cam, pid, px, py = cam[keep], pid[keep], observations["px"][keep], observations["py"][keep]
+    point_index = np.searchsorted(points["id"], pid)
+    if np.any(point_index >= len(points["id"])) or np.any(points["id"][np.minimum(point_index, len(points["id"]) - 1)] != pid):
+        raise KeyError("Points observed in the images are missing in points3D")
+    if POSE_INVERSE:
+        ## np.linalg.inv as _scaleFordepth, the result is identical to the reference
+        centers = np.linalg.inv(cameras["pose"])[:, :3, 3]
+    else:
+        centers = cameras["pose"][:, :3, 3]
+    diff = points["location"][point_index] - centers[cam]
+    ## matmul instead of a row-wise sum, identical to np.linalg.norm of each row
+    depth_recon = np.sqrt((diff[:, None, :] @ diff[:, :, None])[:, 0, 0])
+
+    depth_real = np.empty(len(cam))
+    order = np.argsort(cam, kind = 'stable')
+    bounds = np.searchsorted(cam[order], np.arange(len(cameras["name"]) + 1))
+    def sample(c):
+        idx = order[bounds[c]:bounds[c + 1]]
+        if len(idx) > 0:
+            depth_real[idx] = _sampleDepth(os.path.join(depthpath, cameras["name"][c]), depth_scale, px[idx], py[idx])
+    if num_threads is None:
+        num_threads = min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers = num_threads) as executor:
+        cameras_iter = executor.map(sample, range(len(cameras["name"])))
+        for _ in (progress(cameras_iter, total = len(cameras["name"])) if progress is not None else cameras_iter):
+            pass
+    return pid, cam, depth_real/depth_recon
+
+
+def _calculateDepthArrays(THRESHOLD, NUM_THRESHOLD, point, scale):
+    """
+    Columnar version of _calculateDepth with the same result bit for bit
+    Args:
+        point, scale: ordered as the return of _scaleForDepthArrays
+    """
+    num_points = len(np.unique(point))
+    valid = scale != 0
+    point, scale = point[valid], scale[valid]
+    ## groups are contiguous, a new group starts where the point id changes
+    starts = np.flatnonzero(np.r_[True, point[1:] != point[:-1]]) if len(point) else np.empty(0, dtype = np.int64)
+    counts = np.diff(np.r_[starts, len(point)])
+    sums = np.zeros(len(starts))
+    means = np.zeros(len(starts))
+    stds = np.zeros(len(starts))
+    ## the reductions run on rows of the same length, so numpy sums in the same order as for each point alone
+    for length in np.unique(counts):
+        groups = np.flatnonzero(counts == length)
+        values = scale[starts[groups][:, None] + np.arange(length)]
+        sums[groups] = np.sum(values, axis = 1)
+        means[groups] = np.mean(values, axis = 1)
+        stds[groups] = np.std(values, axis = 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        si = stds / means
+    selected = (si < THRESHOLD) & (si > 0) & (counts > NUM_THRESHOLD)
+    number = int(np.sum(counts[selected]))
+    print("remain {0:.2f}% vaild points".format(number * 100/num_points))
+    if number == 0:
+        return 0
+    else:
+        ## cumsum accumulates in order, as total_scale += ... over the points
+        return np.cumsum(sums[selected])[-1]/number
 
 
 if __name__ == "__main__":
@@ -120,4 +287,9 @@ if __name__ == "__main__":
             _scaleFordepth(depth, camera_idx, intrinsic, Camera_dict, PointsDict, PointsDepth)
     
     scale = _calculateDepth(THRESHOLD = 0.005, NUM_THRESHOLD = 3, PointsDepth = PointsDepth)
-    pass
\ No newline at end of file
+
+    cameras, observations = _parseImagesArrays(imagefilepath)
+    points = _parsePoints3DArrays(points3Dpath)
+    point, _, scales = _scaleForDepthArrays(cameras, observations, points, os.path.join(datapath, "depth"), 0.00025)
+    scale_arrays = _calculateDepthArrays(THRESHOLD = 0.005, NUM_THRESHOLD = 3, point = point, scale = scales)
+    assert scale == scale_arrays
\ No newline at end of file
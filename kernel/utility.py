@@ -33,13 +33,3 @@ def _generate_image_list(path, files):
     f= open(os.path.join(path, "image-list.txt"),"w+")
     for file in files:
         f.write(file + "\n")
-
-def _parse_camfile(camera_rgb_file):
-    camera_lines = []
-    file = open(camera_rgb_file, "r")
-    lines = file.read().split("\n")
-    for l in lines:
-        data = l.split(" ")
-        if data[0].isnumeric():
-            camera_lines.append(l)
-    return camera_lines
@@ -0,0 +1,273 @@
+import os
+import json
+import shutil
+import fcntl
+import threading
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+## ioctl request to clone a whole file (reflink) on btrfs/xfs, from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def _same_file_stat(src, dst):
+    ## skip the copy when the destination already has the same size and modification time
+    if not os.path.exists(dst):
+        return False
+    src_stat = os.stat(src)
+    dst_stat = os.stat(dst)
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def _reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+        ## copy_file_range copies inside the kernel and shares extents when the file system supports it
+        remain = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remain > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remain)
+                if copied == 0:
+                    break
+                remain -= copied
+        except (OSError, AttributeError):
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def copy_frame(src, dst, mode = "copy"):
+    """copy one file to the output package
+
+    Args:
+        src (str): [source file]
+        dst (str): [destination file]
+        mode (str): ["copy", "hardlink", "reflink" or "symlink"]
+
+    Returns:
+        [bool]: [False if the destination is already up to date and nothing was done]
+    """
+    if _same_file_stat(src, dst):
+        return False
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            ## e.g. across devices, fall back to a normal copy
+            pass
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+        return True
+    elif mode == "reflink":
+        _reflink(src, dst)
+        shutil.copystat(src, dst)
+        return True
+    shutil.copy2(src, dst)
+    return True
+
+
+class FrameCopier:
+    """
+    Copy the input rgb and depth frames to the output package on a thread pool,
+    the copies run in the background while the frames are rendered
+        mode: "copy", "hardlink", "reflink" or "symlink"
+    """
+    COPY_MODES = ["copy", "hardlink", "reflink", "symlink"]
+
+    def __init__(self, mode = "copy", num_threads = None):
+        assert(mode in self.COPY_MODES)
+        self.mode = mode
+        if num_threads is None:
+            num_threads = min(8, os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(max_workers = num_threads)
+        self._futures = []
+
+    def submit(self, src, dst):
+        self._futures.append(self._executor.submit(copy_frame, src, dst, self.mode))
+
+    def submit_all(self, pairs):
+        for src, dst in pairs:
+            self.submit(src, dst)
+
+    def close(self):
+        ## wait for all copies, errors in the copy threads are raised here
+        self._executor.shutdown(wait = True)
+        futures, self._futures = self._futures, []
+        return sum(future.result() for future in futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait = True)
+
+
+def file_key(path):
+    """[size, mtime_ns] of a file, None if it does not exist, the inputs of a checkpoint record are compared with it"""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class FrameCheckpoint:
+    """
+    Per-frame results of an export, one small json file per frame written as soon as the frame is done,
+    so that an interrupted export could be resumed
+    """
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        if not os.path.exists(self.dirpath):
+            os.makedirs(self.dirpath, exist_ok = True)
+
+    def _path(self, idx):
+        return os.path.join(self.dirpath, "{0:06d}.json".format(idx))
+
+    def save(self, idx, record):
+        ## write to a temporary file first, a killed export never leaves a truncated record
+        path = self._path(idx)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, idx):
+        path = self._path(idx)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+
+class StreamingJSONWriter:
+    """
+    Write a json object to disk one entry at a time, in the order the entries are added.
+    After every entry the file is closed with "}" again so it is valid json at any time.
+        indent=1 gives the same file as json.dump(..., indent=1), COMPACT writes without any whitespace
+    """
+    def __init__(self, path, COMPACT = False):
+        self.COMPACT = COMPACT
+        self._f = open(path, 'wb')
+        self._count = 0
+        self._f.write(b"{}")
+        self._tail_pos = 1
+
+    def write(self, key, value):
+        if self.COMPACT:
+            entry = json.dumps(str(key), ensure_ascii=False) + ":" + json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+            entry = ("" if self._count == 0 else ",") + entry
+            tail = "}"
+        else:
+            ## json strings never contain a raw newline, shift every line of the value by one level
+            entry = json.dumps(str(key), ensure_ascii=False) + ": " + json.dumps(value, ensure_ascii=False, indent=1).replace("\n", "\n ")
+            entry = ("\n " if self._count == 0 else ",\n ") + entry
+            tail = "\n}"
+        self._f.seek(self._tail_pos)
+        self._f.write(entry.encode('utf-8'))
+        self._tail_pos = self._f.tell()
+        self._f.write(tail.encode('utf-8'))
+        self._count += 1
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ImageEncoder:
+    """
+    Encode and save images on background threads, so the next frame is rendered while the last one is compressed.
+    Every image is written to a temporary file and renamed, an existing output is always complete.
+        compress_level: zlib level of the PNG files (0-9)
+        FAST_CODEC: encode PNG with OpenCV and the run-length zlib strategy, still lossless, much faster on masks
+        max_pending: maximal number of images waiting for encoding, submit blocks when it is reached
+    """
+    def __init__(self, num_threads = None, max_pending = 64, compress_level = 6, FAST_CODEC = False):
+        if num_threads is None:
+            num_threads = min(4, os.cpu_count() or 1)
+        self.compress_level = compress_level
+        self.FAST_CODEC = FAST_CODEC
+        self._executor = ThreadPoolExecutor(max_workers = num_threads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def _encode(self, array, path, format):
+        tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+        if self.FAST_CODEC and format.upper() == "PNG":
+            import cv2
+            if array.ndim == 3:
+                array = cv2.cvtColor(array, cv2.COLOR_RGBA2BGRA if array.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+            success, buf = cv2.imencode(".png", array, [cv2.IMWRITE_PNG_COMPRESSION, self.compress_level,
+                                                        cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE])
+            if not success:
+                raise IOError("Fail to encode " + path)
+            with open(tmp_path, "wb") as f:
+                f.write(buf.tobytes())
+        elif format.upper() == "PNG":
+            Image.fromarray(array).save(tmp_path, format = "PNG", compress_level = self.compress_level)
+        else:
+            Image.fromarray(array).save(tmp_path, format = format)
+        os.replace(tmp_path, path)
+
+    def _done(self, future):
+        ## failed jobs are kept until flush reports them
+        if future.exception() is None:
+            with self._lock:
+                self._futures.discard(future)
+        self._slots.release()
+
+    def _submit(self, fn, *args):
+        self._slots.acquire()
+        future = self._executor.submit(fn, *args)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def submit(self, array, path, format = "PNG"):
+        """queue an image, the array should not be modified afterwards, returns its future"""
+        return self._submit(self._encode, array, path, format)
+
+    def when_written(self, futures, fn, *args):
+        """
+        queue fn(*args) to run once the images of futures (returned by submit) are written, it is not run when one of them failed
+        the images are queued before, so they are taken by the threads first and this never waits for a job behind it
+        """
+        def _run():
+            if all(future.exception() is None for future in futures):
+                fn(*args)
+        return self._submit(_run)
+
+    def flush(self):
+        ## wait for all the queued images, errors in the encoding threads are raised here
+        with self._lock:
+            futures = list(self._futures)
+        errors = [future.exception() for future in futures]
+        with self._lock:
+            self._futures.difference_update(futures)
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait = True)
@@ -1,16 +1,49 @@
 import sys
 import os
 import json
+import argparse
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from parse import offlineParam
 from render import offlineRender
 from offlineRecon import offlineRecon
 
 if __name__ == "__main__":
-    config_path = sys.argv[1]
-    output_dir = sys.argv[2]
-    data_format = sys.argv[3]
+    parser = argparse.ArgumentParser(description="Offline interpolation and data export for ProgressLabeller")
+    parser.add_argument("config_path")
+    parser.add_argument("output_dir")
+    parser.add_argument("data_format")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of rendering (and key frame segment tracking) processes, each with its own renderer and scene")
+    parser.add_argument("--copy-mode", default="copy", choices=["copy", "hardlink", "reflink", "symlink"],
+                        help="how the input rgb and depth frames are put into the output")
+    parser.add_argument("--resume", action="store_true",
+                        help="(BOP) keep a checkpoint per frame and keep the frames of a previous export that are complete and not affected by changes")
+    parser.add_argument("--compact-json", action="store_true",
+                        help="(BOP) write scene_camera/scene_gt/scene_gt_info.json without indent")
+    parser.add_argument("--png-compression", type=int, default=6, choices=range(10), metavar="[0-9]",
+                        help="zlib level of the mask, label and rgb PNG files")
+    parser.add_argument("--fast-png", action="store_true",
+                        help="encode the PNG files with the faster OpenCV encoder (lossless)")
+    parser.add_argument("--interpolation", default="all", choices=["all", "KF_slerp", "KF_forward_m2f", "KF_forward_f2f"],
+                        help="poses of the frames between the key frames, \"all\" keeps the key frames only")
+    parser.add_argument("--interpolation-time", default="index", choices=["index", "name"],
+                        help="(KF_slerp) time of a frame, its index or its file name as a timestamp")
+    parser.add_argument("--render-backend", default="auto", choices=["auto", "pyrender", "raster"],
+                        help="mask/depth renderer, pyrender (OpenGL/EGL) or the CPU rasterizer for nodes without GPU, auto falls back to the CPU")
+    parser.add_argument("--lod-tolerance", type=float, default=None,
+                        help="render the masks with decimated models whose geometric error stays below this fraction of a pixel")
+    parser.add_argument("--lod-validation", type=int, default=10,
+                        help="number of frames on which the masks of the decimated models are compared with the full models")
+    parser.add_argument("--mask-format", default="png", choices=["png", "rle"],
+                        help="(BOP) masks as PNG files or COCO run-length encoded in scene_gt_masks.json")
+    args = parser.parse_args()
+    config_path = args.config_path
+    output_dir = args.output_dir
+    data_format = args.data_format
     param = offlineParam(config_path)
-    interpolation_type = "all"
-    offlineRecon(param, interpolation_type)
-    offlineRender(param, output_dir, interpolation_type, pkg_type=data_format)  
\ No newline at end of file
+    interpolation_type = args.interpolation
+    offlineRecon(param, interpolation_type, workers=args.workers, interpolation_time=args.interpolation_time)
+    offlineRender(param, output_dir, interpolation_type, pkg_type=data_format, workers=args.workers, copy_mode=args.copy_mode, RESUME=args.resume, COMPACT_JSON=args.compact_json,
+                  png_compression=args.png_compression, FAST_PNG=args.fast_png, render_backend=args.render_backend,
+                  lod_tolerance=args.lod_tolerance, lod_validation=args.lod_validation,
+                  mask_format=args.mask_format)
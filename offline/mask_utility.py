@@ -0,0 +1,247 @@
+import numpy as np
+
+
+def _bbox_from_presence(rows, cols):
+    """bounding boxes from per-row and per-column presence
+
+    Args:
+        rows (np.ndarray): [(N, H) bool, whether instance n has a pixel in each row]
+        cols (np.ndarray): [(N, W) bool, whether instance n has a pixel in each column]
+
+    Returns:
+        [np.ndarray]: [(N, 4) int, left, top, right, bottom (inclusive)]
+    """
+    top = np.argmax(rows, axis=1)
+    bottom = rows.shape[1] - 1 - np.argmax(rows[:, ::-1], axis=1)
+    left = np.argmax(cols, axis=1)
+    right = cols.shape[1] - 1 - np.argmax(cols[:, ::-1], axis=1)
+    return np.stack((left, top, right, bottom), axis=1)
+
+
+def visible_statistics(instance, num_instances):
+    """pixel count and bounding box of every instance in an instance-id image, in one pass over the image
+
+    Args:
+        instance (np.ndarray): [(H, W) instance id, 0 for background, 1..num_instances for the objects]
+        num_instances (int): [number of instances]
+
+    Returns:
+        count (np.ndarray): [(num_instances,) number of visible pixels]
+        bbox (np.ndarray): [(num_instances, 4) left, top, right, bottom (inclusive), meaningless if count is 0]
+    """
+    H, W = instance.shape
+    count = np.bincount(instance.ravel(), minlength=num_instances + 1)[1:num_instances + 1]
+    ## presence of every id in every row/column, the background column 0 is dropped afterwards
+    rows = np.zeros((num_instances + 1, H), dtype=bool)
+    cols = np.zeros((num_instances + 1, W), dtype=bool)
+    rows[instance, np.arange(H)[:, np.newaxis]] = True
+    cols[instance, np.arange(W)[np.newaxis, :]] = True
+    bbox = _bbox_from_presence(rows[1:], cols[1:])
+    return count, bbox
+
+
+def frame_statistics(instance, amodal, depth):
+    """BOP scene_gt_info statistics of all the objects in a frame
+
+    Args:
+        instance (np.ndarray): [(H, W) instance id image of the visible objects, obj_idx + 1 for the obj_idx-th object]
+        amodal (np.ndarray): [(N, H, W) bool, full (amodal) mask of every object]
+        depth (np.ndarray): [(H, W) input depth, 0 for invalid]
+
+    Returns:
+        [dict]: [arrays over the N objects: bbox_obj, bbox_visib as (N, 4) [x, y, w, h],
+                 px_count_all, px_count_valid, px_count_visib and visib_fract as (N,)]
+    """
+    num_instances = amodal.shape[0]
+    px_count_visib, bbox_visib = visible_statistics(instance, num_instances)
+
+    px_count_all = np.count_nonzero(amodal.reshape(num_instances, -1), axis=1)
+    px_count_valid = np.count_nonzero((amodal & (depth != 0)[np.newaxis]).reshape(num_instances, -1), axis=1)
+    bbox_obj = _bbox_from_presence(amodal.any(axis=2), amodal.any(axis=1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        visib_fract = np.where(px_count_all > 0, px_count_visib / px_count_all, 0.)
+    ## [left, top, right, bottom] to [x, y, w, h]
+    bbox_obj[:, 2:] -= bbox_obj[:, :2]
+    bbox_visib[:, 2:] -= bbox_visib[:, :2]
+    return {
+        "bbox_obj": bbox_obj,
+        "bbox_visib": bbox_visib,
+        "px_count_all": px_count_all,
+        "px_count_valid": px_count_valid,
+        "px_count_visib": px_count_visib,
+        "visib_fract": visib_fract,
+    }
+
+
+def _rle_counts(starts, ends, num_pixels):
+    """COCO run lengths (background first) of a mask from its runs of foreground pixels
+
+    Args:
+        starts (np.ndarray): [(R,) first pixel of every run, column-major order, increasing]
+        ends (np.ndarray): [(R,) pixel after every run]
+        num_pixels (int): [H * W]
+
+    Returns:
+        [np.ndarray]: [int64 alternating background and foreground run lengths]
+    """
+    bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = num_pixels
+    counts = np.diff(bounds)
+    ## no empty background run after a mask ending with foreground
+    return counts[:-1] if len(counts) > 1 and counts[-1] == 0 else counts
+
+
+def _rle_string(counts):
+    """compressed COCO counts string, the same as rleToString of pycocotools
+
+    Args:
+        counts (np.ndarray): [(M,) run lengths]
+
+    Returns:
+        [str]: [counts string]
+    """
+    x = counts.astype(np.int64)
+    ## from the fourth count on, the difference with the count two before is stored
+    x[3:] -= counts[1:-2]
+    chars = []
+    active = np.ones(len(x), dtype=bool)
+    ## 5 bits per character, 0x20 flags that more characters follow
+    while np.any(active):
+        c = x & 0x1f
+        x = x >> 5
+        more = np.where(c & 0x10, x != -1, x != 0) & active
+        chars.append(np.where(active, (c | (more * 0x20)) + 48, 0))
+        active = more
+    chars = np.stack(chars, axis=1)
+    return chars[chars > 0].astype(np.uint8).tobytes().decode('ascii')
+
+
+def _rle_parse(string):
+    """run lengths of a compressed COCO counts string, the same as rleFrString of pycocotools
+
+    Args:
+        string (str): [counts string]
+
+    Returns:
+        [np.ndarray]: [(M,) int64 run lengths]
+    """
+    c = np.frombuffer(string.encode('ascii'), dtype=np.uint8).astype(np.int64) - 48
+    last = (c & 0x20) == 0
+    value = np.cumsum(np.concatenate(([0], last[:-1])))
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    shift = 5 * (np.arange(len(c)) - starts[value])
+    x = np.add.reduceat((c & 0x1f) << shift, starts) if len(c) > 0 else np.zeros(0, dtype=np.int64)
+    ## sign extension of the negative differences
+    negative = (c[last] & 0x10) != 0
+    x[negative] -= np.int64(1) << (shift[last][negative] + 5)
+    counts = x.copy()
+    counts[2::2] = np.cumsum(x[2::2])
+    counts[3::2] = x[1] + np.cumsum(x[3::2]) if len(x) > 3 else x[3::2]
+    return counts
+
+
+def rle_encode(mask):
+    """COCO RLE of a binary mask, compatible with pycocotools.mask (decode, area, iou, ...)
+
+    Args:
+        mask (np.ndarray): [(H, W) bool]
+
+    Returns:
+        [dict]: [{"size": [H, W], "counts": compressed counts string}]
+    """
+    H, W = mask.shape
+    flat = np.ascontiguousarray(mask.T).ravel().view(np.uint8) if mask.dtype == bool else (mask.T.ravel() != 0).view(np.uint8)
+    edges = np.flatnonzero(np.diff(flat, prepend=np.uint8(0), append=np.uint8(0)))
+    return {"size": [H, W], "counts": _rle_string(_rle_counts(edges[0::2], edges[1::2], H * W))}
+
+
+def rle_encode_instances(instance, num_instances):
+    """COCO RLE of the mask of every instance in an instance-id image, with one pass over the runs of the image
+
+    Args:
+        instance (np.ndarray): [(H, W) instance id, 0 for background, 1..num_instances for the objects]
+        num_instances (int): [number of instances]
+
+    Returns:
+        [list]: [num_instances RLE dicts as rle_encode, the mask of instance k is instance == k + 1]
+    """
+    H, W = instance.shape
+    flat = instance.T.ravel()
+    ## runs of equal ids in column-major order
+    run_starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    run_ends = np.append(run_starts[1:], flat.size)
+    run_ids = flat[run_starts].astype(np.int64)
+    order = np.argsort(run_ids, kind='stable')
+    groups = np.searchsorted(run_ids[order], np.arange(num_instances + 2))
+    rles = []
+    for k in range(1, num_instances + 1):
+        runs = order[groups[k]:groups[k + 1]]
+        rles.append({"size": [H, W], "counts": _rle_string(_rle_counts(run_starts[runs], run_ends[runs], H * W))})
+    return rles
+
+
+def rle_decode(rle):
+    """binary mask of a COCO RLE
+
+    Args:
+        rle (dict): [{"size": [H, W], "counts": compressed string or list of run lengths}]
+
+    Returns:
+        [np.ndarray]: [(H, W) bool]
+    """
+    H, W = rle["size"]
+    counts = _rle_parse(rle["counts"]) if isinstance(rle["counts"], str) else np.asarray(rle["counts"], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(W, H).T
+
+
+if __name__ == "__main__":
+    ## write time and size of the BOP masks (mask and mask_visib of every object) as PNG files and as RLE in one json
+    import os
+    import json
+    import time
+    import tempfile
+    from PIL import Image
+    H, W, num_objects, num_frames = 720, 1280, 15, 20
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[:H, :W]
+    frames = []
+    for _ in range(num_frames):
+        ## ellipses at random depths, the nearest one is visible
+        depth = np.full((num_objects, H, W), np.inf)
+        for k in range(num_objects):
+            cy, cx, ry, rx = rng.uniform(0, H), rng.uniform(0, W), rng.uniform(20, 150), rng.uniform(20, 150)
+            depth[k][((rows - cy) / ry) ** 2 + ((cols - cx) / rx) ** 2 <= 1] = rng.uniform(1, 2)
+        amodal = np.isfinite(depth)
+        instance = np.where(amodal.any(axis=0), np.argmin(depth, axis=0) + 1, 0).astype(np.uint16)
+        frames.append((amodal, instance))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.time()
+        for idx, (amodal, instance) in enumerate(frames):
+            for k in range(num_objects):
+                Image.fromarray((amodal[k] * 255).astype(np.uint8)).save(os.path.join(tmpdir, "{0:06d}_{1:06d}_mask.png".format(idx, k)), compress_level=6)
+                Image.fromarray(((instance == k + 1) * 255).astype(np.uint8)).save(os.path.join(tmpdir, "{0:06d}_{1:06d}_visib.png".format(idx, k)), compress_level=6)
+        t_png = time.time() - start
+        size_png = sum(os.path.getsize(os.path.join(tmpdir, name)) for name in os.listdir(tmpdir))
+
+        start = time.time()
+        masks = {}
+        for idx, (amodal, instance) in enumerate(frames):
+            masks[str(idx)] = [{"mask": rle_encode(amodal[k]), "mask_visib": visib} for k, visib in enumerate(rle_encode_instances(instance, num_objects))]
+        with open(os.path.join(tmpdir, "scene_gt_masks.json"), "w") as f:
+            json.dump(masks, f, separators=(",", ":"))
+        t_rle = time.time() - start
+        size_rle = os.path.getsize(os.path.join(tmpdir, "scene_gt_masks.json"))
+
+    for idx, (amodal, instance) in enumerate(frames):
+        for k in range(num_objects):
+            assert np.array_equal(rle_decode(masks[str(idx)][k]["mask"]), amodal[k])
+            assert np.array_equal(rle_decode(masks[str(idx)][k]["mask_visib"]), instance == k + 1)
+    print("{0} frames of {1} objects, {2}x{3}".format(num_frames, num_objects, W, H))
+    print("PNG: {0} files, {1:.2f} s, {2:.1f} kB".format(2 * num_frames * num_objects, t_png, size_png / 1000))
+    print("RLE: 1 file, {0:.2f} s, {1:.1f} kB".format(t_rle, size_rle / 1000))
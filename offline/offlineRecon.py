@@ -2,13 +2,44 @@ import os
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
-from kernel.geometry import _pose2Rotation, _rotation2Pose
+from kernel.geometry import _interpolatePoses
+from kernel.pose_utility import inverse
+from kernel.campose_utility import read_campose, write_campose
 from kernel.utility import _select_sample_files
+from kernel.frame_utility import FrameReader
+import multiprocessing
+
+_worker_kf = None
+
+def _init_f2f_worker(config, datasrc, depth_scale):
+    ## every worker process owns its tracker, the segments only share the known key frame poses
+    global _worker_kf
+    from kernel.kf_pycuda.kinect_fusion import KinectFusion
+    _worker_kf = (KinectFusion(cfg=config), datasrc, depth_scale)
+
+def _f2f_worker(task):
+    keypair, imgorder, keypose = task
+    kf, datasrc, depth_scale = _worker_kf
+    ## a single decoding thread per worker, the processes already keep the cores busy
+    frames = FrameReader.from_names(datasrc, imgorder, depth_scale, 1.5, num_threads = 1)
+    poses = []
+    for imgname, (color_im, depth_im) in zip(imgorder, frames):
+        if imgname == keypair[0]:
+            kf.F2FPoseEstimation(color_im, depth_im, keypose)
+        else:
+            poses.append((imgname, kf.F2FPoseEstimation(color_im, depth_im, None)))
+    return poses
 
 class offlineRecon:
-    def __init__(self, param, interpolation_type = "KF_forward") -> None:
+    def __init__(self, param, interpolation_type = "KF_forward", workers = 1, interpolation_time = "index") -> None:
+        """
+        workers: number of processes tracking the key frame pair segments of "KF_forward_f2f", each process has its own tracker
+        interpolation_time: time of a frame for "KF_slerp", "index": position in the sorted frames, "name": file name as a timestamp (e.g. 1305031102.175304.png)
+        """
         print("Start offline reconstruction interpolation")
         self.param = param
+        self.workers = workers
+        self.interpolation_time = interpolation_time
         self.datasrc = self.param.datasrc
         self.reconstructionsrc = self.param.reconstructionsrc
         self.CAM_INVERSE = self.param.camera["inverse_pose"]
@@ -50,14 +81,8 @@ class offlineRecon:
                 self.wholecam[img] = self.keyposes[img]
 
     def _parsecamfile(self):
-        f = open(os.path.join(self.reconstructionsrc, "campose.txt"))
-        lines = f.readlines()
-        for l in lines:
-            datas = l.split(" ")
-            if datas[0].isnumeric():
-                self.keyposes[datas[-1].split("\n")[0]] = _pose2Rotation([[float(datas[5]), float(datas[6]), float(datas[7])],\
-                                                        [float(datas[1]), float(datas[2]), float(datas[3]), float(datas[4])]])
-                pass
+        camposes = read_campose(os.path.join(self.reconstructionsrc, "campose.txt"))
+        self.keyposes = dict(zip(camposes.names, camposes.matrices()))
 
     def _applytrans2cam(self):
         # Axis_align = np.array([[1, 0, 0, 0],
@@ -65,21 +90,24 @@ class offlineRecon:
         #                       [0, 0, -1, 0],
         #                       [0, 0, 0, 1],]
         #     )
+        if len(self.keyposes) == 0:
+            return
         scale = self.param.recon["scale"]
         trans = self.param.recon["trans"]
-        for cam in self.keyposes:
-            origin_pose = self.keyposes[cam]
-            origin_pose[:3, 3] = origin_pose[:3, 3] * scale
-            # origin_pose = np.linalg.inv(origin_pose).dot(Axis_align)
-            if self.CAM_INVERSE:
-                origin_pose = np.linalg.inv(origin_pose)
-            self.keyposes[cam] = trans.dot(origin_pose)
+        origin_poses = np.stack(list(self.keyposes.values()))
+        origin_poses[:, :3, 3] = origin_poses[:, :3, 3] * scale
+        # origin_poses = axis_align(inverse(origin_poses))
+        if self.CAM_INVERSE:
+            origin_poses = inverse(origin_poses)
+        self.keyposes = dict(zip(self.keyposes.keys(), np.matmul(trans, origin_poses)))
     
     def _interpolation(self, type):
-        assert type in ["KF_forward_m2f", "KF_forward_f2f", "all"]
+        assert type in ["KF_forward_m2f", "KF_forward_f2f", "KF_slerp", "all"]
         if type == "all":
             ## don't need do anything
             pass
+        if type == "KF_slerp":
+            self._interpolationKFSlerp()
         if type == "KF_forward_m2f":
             try: 
                 from kernel.kf_pycuda.kinect_fusion import KinectFusion
@@ -100,8 +128,9 @@ class offlineRecon:
                     tsdf_trunc_margin = 0.015, 
                     pcd_voxel_size = 0.005) 
                 self.kf = KinectFusion(cfg=config)
+                frames = iter(self._framereader([imgname for keypair in self.wholemap for imgname in self._orderKFForwardM2F(keypair, self.wholemap[keypair])]))
                 for keypair in tqdm(self.wholemap):
-                    self._interpolationKFForwardM2F(keypair, self.wholemap[keypair])
+                    self._interpolationKFForwardM2F(keypair, self.wholemap[keypair], frames)
                 for idx, prefix in enumerate(self.wholecam.keys()):
                     if idx < len(self.kf.cam_poses):
                         self.wholecam[prefix] = self.kf.cam_poses[idx]
@@ -124,46 +153,83 @@ class offlineRecon:
                     tsdf_voxel_size = 0.0025, 
                     tsdf_trunc_margin = 0.015, 
                     pcd_voxel_size = 0.005) 
+                if self.workers > 1:
+                    self._parallelKFForwardF2F(config)
+                    return
                 self.kf = KinectFusion(cfg=config)
+                frames = iter(self._framereader([imgname for keypair in self.wholemap for imgname in self._orderKFForwardF2F(keypair, self.wholemap[keypair])]))
                 for keypair in tqdm(self.wholemap):
-                    self._interpolationKFForwardF2F(keypair, self.wholemap[keypair])
+                    self._interpolationKFForwardF2F(keypair, self.wholemap[keypair], frames)
                 for idx, prefix in enumerate(self.wholecam.keys()):
                     if idx < len(self.kf.cam_poses):
                         self.wholecam[prefix] = self.kf.cam_poses[idx]
 
-    def _interpolationKFForwardM2F(self, keypair, imglists):
-        for imgname in [keypair[0]] + imglists:
-            color_im_path = os.path.join(self.rgb_path, imgname)
-            depth_im_path = os.path.join(self.depth_path, imgname)
-            color_im = np.array(Image.open(color_im_path))
-            depth_im = np.array(Image.open(depth_im_path)).astype(np.float32) * self.depth_scale
-            depth_im[depth_im > 1.5] = 0
+    def _frametimes(self):
+        assert self.interpolation_time in ["index", "name"]
+        if self.interpolation_time == "index":
+            return {img: idx for idx, img in enumerate(self.wholecam)}
+        else:
+            return {img: float(os.path.splitext(img)[0]) for img in self.wholecam}
+
+    def _interpolationKFSlerp(self):
+        ## closed form interpolation between the poses of each key frame pair, all the frames in one batch
+        frametimes = self._frametimes()
+        pairs = [(keypair, imgname) for keypair in self.wholemap for imgname in self.wholemap[keypair]]
+        if len(pairs) == 0:
+            return
+        start = np.array([frametimes[keypair[0]] for keypair, _ in pairs], dtype = np.float64)
+        end = np.array([frametimes[keypair[1]] for keypair, _ in pairs], dtype = np.float64)
+        t = (np.array([frametimes[imgname] for _, imgname in pairs], dtype = np.float64) - start) / (end - start)
+        poses = _interpolatePoses(np.stack([self.keyposes[keypair[0]] for keypair, _ in pairs]), 
+                                  np.stack([self.keyposes[keypair[1]] for keypair, _ in pairs]), t)
+        for (_, imgname), pose in zip(pairs, poses):
+            self.wholecam[imgname] = pose
+
+    def _framereader(self, imgnames):
+        ## frames of all the key frame pairs in the processing order, decoded ahead of the tracking
+        return FrameReader.from_names(self.datasrc, imgnames, self.depth_scale, 1.5)
+
+    def _orderKFForwardM2F(self, keypair, imglists):
+        return [keypair[0]] + imglists
+
+    def _orderKFForwardF2F(self, keypair, imglists):
+        return [keypair[0]] + imglists[:int(len(imglists)/2)] + (imglists[int(len(imglists)/2):] + [keypair[1]])[::-1]
+
+    def _interpolationKFForwardM2F(self, keypair, imglists, frames):
+        for imgname in self._orderKFForwardM2F(keypair, imglists):
+            color_im, depth_im = next(frames)
             if imgname == keypair[0]:
                 self.kf.interpolation_update(color_im, depth_im, self.keyposes[keypair[0]])
             else:
                 self.kf.interpolation_update(color_im, depth_im, None)
 
-    def _interpolationKFForwardF2F(self, keypair, imglists):
-        for imgname in [keypair[0]] + imglists[:int(len(imglists)/2)] + (imglists[int(len(imglists)/2):] + [keypair[1]])[::-1]:
-            color_im_path = os.path.join(self.rgb_path, imgname)
-            depth_im_path = os.path.join(self.depth_path, imgname)
-            color_im = np.array(Image.open(color_im_path))
-            depth_im = np.array(Image.open(depth_im_path)).astype(np.float32) * self.depth_scale
-            depth_im[depth_im > 1.5] = 0
+    def _interpolationKFForwardF2F(self, keypair, imglists, frames):
+        for imgname in self._orderKFForwardF2F(keypair, imglists):
+            color_im, depth_im = next(frames)
             if imgname == keypair[0]:
                 self.kf.F2FPoseEstimation(color_im, depth_im, self.keyposes[keypair[0]])
             else:
                 pose = self.kf.F2FPoseEstimation(color_im, depth_im, None)
                 self.wholecam[imgname] = pose
-              
-            
+
+    def _parallelKFForwardF2F(self, config):
+        ## each key frame pair segment starts from its known key frame pose, so the segments are tracked independently
+        tasks = [(keypair, self._orderKFForwardF2F(keypair, self.wholemap[keypair]), self.keyposes[keypair[0]]) for keypair in self.wholemap]
+        ## longest segments first, the short ones fill the gaps at the end
+        tasks.sort(key = lambda task: len(task[1]), reverse = True)
+        ## spawn instead of fork, the cuda context could not be shared with the child processes
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(min(self.workers, max(1, len(tasks))), initializer = _init_f2f_worker, 
+                      initargs = (config, self.datasrc, self.depth_scale)) as pool:
+            for poses in tqdm(pool.imap_unordered(_f2f_worker, tasks), total = len(tasks)):
+                ## self.wholecam keeps the frame order, only the poses are filled in
+                for imgname, pose in poses:
+                    self.wholecam[imgname] = pose
     
     def _savecampose(self, campose_filename):
-        with open(os.path.join(self.reconstructionsrc, campose_filename), 'w') as f:
-            f.write('# IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME\n')
-            f.write('\n')
-            for idx, cam in enumerate(self.wholecam.keys()):
-                if self.wholecam[cam].any():
-                    pose = _rotation2Pose(self.wholecam[cam])
-                    f.write(str(idx) + " {0} {1} {2} {3} {4} {5} {6} 1 ".format(*pose[1], *pose[0])+ cam + "\n")
+        ## frames without pose are not written, the image id is the index in all the frames
+        frames = [(idx, cam) for idx, cam in enumerate(self.wholecam.keys()) if self.wholecam[cam].any()]
+        write_campose(os.path.join(self.reconstructionsrc, campose_filename), 
+                      np.stack([self.wholecam[cam] for _, cam in frames]).reshape(-1, 4, 4), 
+                      [cam for _, cam in frames], ids = [idx for idx, _ in frames])
 
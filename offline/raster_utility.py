@@ -0,0 +1,294 @@
+import numpy as np
+import pyrender
+from numba import njit, prange
+
+## rows of the image rasterized by one parallel task
+BAND_HEIGHT = 16
+
+
+@njit(cache=True)
+def _clip_triangles(points, faces, face_ids, face_cull, fx, fy, cx, cy, znear):
+    """
+    Clip the triangles against the near plane and project them into the image
+    Args:
+        points: [N, 3] vertices in the camera frame (x right, y down, z forward)
+        faces: [M, 3] triangles
+        face_ids: [M] instance index of each triangle
+        face_cull: [M] the triangle is culled when seen from the back
+    Returns:
+        tri_uv: [K, 3, 2] pixel coordinates of the vertices of the clipped triangles
+        tri_invz: [K, 3] inverse depth of the vertices
+        tri_ids: [K] instance index
+        tri_cull: [K] back face culling
+    """
+    M = len(faces)
+    tri_uv = np.empty((2 * M, 3, 2))
+    tri_invz = np.empty((2 * M, 3))
+    tri_ids = np.empty(2 * M, dtype = np.int64)
+    tri_cull = np.empty(2 * M, dtype = np.bool_)
+    polygon = np.empty((4, 3))
+    K = 0
+    for m in range(M):
+        ## Sutherland-Hodgman against z >= znear, a triangle becomes 0, 1 or 2 triangles
+        n = 0
+        for k in range(3):
+            a = points[faces[m, k]]
+            b = points[faces[m, (k + 1) % 3]]
+            a_in = a[2] >= znear
+            b_in = b[2] >= znear
+            if a_in:
+                polygon[n] = a
+                n += 1
+            if a_in != b_in:
+                t = (znear - a[2]) / (b[2] - a[2])
+                polygon[n] = a + t * (b - a)
+                polygon[n, 2] = znear
+                n += 1
+        for k in range(1, n - 1):
+            for j, p in enumerate((0, k, k + 1)):
+                tri_uv[K, j, 0] = cx + fx * polygon[p, 0] / polygon[p, 2]
+                tri_uv[K, j, 1] = cy + fy * polygon[p, 1] / polygon[p, 2]
+                tri_invz[K, j] = 1. / polygon[p, 2]
+            tri_ids[K] = face_ids[m]
+            tri_cull[K] = face_cull[m]
+            K += 1
+    return tri_uv[:K], tri_invz[:K], tri_ids[:K], tri_cull[:K]
+
+
+@njit(cache=True)
+def _inside(w, dx, dy):
+    ## pixel centers on a shared edge belong to exactly one of the two triangles, the edge runs in opposite directions in them
+    return w > 0 or (w == 0 and (dy > 0 or (dy == 0 and dx > 0)))
+
+
+@njit(cache=True)
+def _bin_triangles(tri_uv, width, height):
+    """
+    List the triangles by the bands of rows their v extent covers, the triangles out of the image are dropped
+    Returns:
+        offsets: [num_bands + 1] the triangles of band b are order[offsets[b]:offsets[b + 1]]
+        order: triangle indices, increasing in every band so the depth ties are resolved as without binning
+    """
+    K = len(tri_uv)
+    num_bands = (height + BAND_HEIGHT - 1) // BAND_HEIGHT
+    first = np.empty(K, dtype = np.int64)
+    last = np.empty(K, dtype = np.int64)
+    offsets = np.zeros(num_bands + 1, dtype = np.int64)
+    for k in range(K):
+        u_min = min(tri_uv[k, 0, 0], tri_uv[k, 1, 0], tri_uv[k, 2, 0])
+        u_max = max(tri_uv[k, 0, 0], tri_uv[k, 1, 0], tri_uv[k, 2, 0])
+        v_min = min(tri_uv[k, 0, 1], tri_uv[k, 1, 1], tri_uv[k, 2, 1])
+        v_max = max(tri_uv[k, 0, 1], tri_uv[k, 1, 1], tri_uv[k, 2, 1])
+        ## rows and columns whose centers could be covered, as in _rasterize
+        r0 = max(0, int(np.ceil(v_min - 0.5)))
+        r1 = min(height - 1, int(np.floor(v_max - 0.5)))
+        c0 = max(0, int(np.ceil(u_min - 0.5)))
+        c1 = min(width - 1, int(np.floor(u_max - 0.5)))
+        if r0 > r1 or c0 > c1:
+            first[k] = 0
+            last[k] = -1
+            continue
+        first[k] = r0 // BAND_HEIGHT
+        last[k] = r1 // BAND_HEIGHT
+        for band in range(first[k], last[k] + 1):
+            offsets[band + 1] += 1
+    for band in range(num_bands):
+        offsets[band + 1] += offsets[band]
+    order = np.empty(offsets[num_bands], dtype = np.int64)
+    fill = offsets[:num_bands].copy()
+    for k in range(K):
+        for band in range(first[k], last[k] + 1):
+            order[fill[band]] = k
+            fill[band] += 1
+    return offsets, order
+
+
+@njit(parallel=True, error_model='numpy', cache=True)
+def _rasterize(tri_uv, tri_invz, tri_ids, tri_cull, width, height, zfar, depth, ids):
+    """
+    Z-buffer rasterization of the projected triangles, sampled at the pixel centers
+    Args:
+        tri_cull: skip the back faces of these triangles, as the OpenGL renderer does for single sided materials
+        depth: [H, W] output depth, 0 for background
+        ids: [H, W] output instance index, -1 for background
+    """
+    ## every band only goes through the triangles of its rows
+    offsets, order = _bin_triangles(tri_uv, width, height)
+    num_bands = len(offsets) - 1
+    for band in prange(num_bands):
+        row_start = band * BAND_HEIGHT
+        row_end = min(row_start + BAND_HEIGHT, height)
+        for i in range(offsets[band], offsets[band + 1]):
+            k = order[i]
+            u0, v0 = tri_uv[k, 0, 0], tri_uv[k, 0, 1]
+            u1, v1 = tri_uv[k, 1, 0], tri_uv[k, 1, 1]
+            u2, v2 = tri_uv[k, 2, 0], tri_uv[k, 2, 1]
+            ## rows whose centers (r + 0.5) could be covered, in this band
+            r0 = max(row_start, int(np.ceil(min(v0, v1, v2) - 0.5)))
+            r1 = min(row_end - 1, int(np.floor(max(v0, v1, v2) - 0.5)))
+            if r0 > r1:
+                continue
+            c0 = max(0, int(np.ceil(min(u0, u1, u2) - 0.5)))
+            c1 = min(width - 1, int(np.floor(max(u0, u1, u2) - 0.5)))
+            area = (u1 - u0) * (v2 - v0) - (v1 - v0) * (u2 - u0)
+            ## front faces are counter-clockwise in the OpenGL window (y up), so clockwise (area < 0) in the image (y down)
+            if area == 0 or (tri_cull[k] and area > 0):
+                continue
+            z0, z1, z2 = tri_invz[k, 0], tri_invz[k, 1], tri_invz[k, 2]
+            if area < 0:
+                ## same orientation for all the triangles, the edge functions are positive inside
+                u1, v1, u2, v2 = u2, v2, u1, v1
+                z1, z2 = z2, z1
+                area = -area
+            for r in range(r0, r1 + 1):
+                y = r + 0.5
+                for c in range(c0, c1 + 1):
+                    x = c + 0.5
+                    w0 = (u2 - u1) * (y - v1) - (v2 - v1) * (x - u1)
+                    if not _inside(w0, u2 - u1, v2 - v1):
+                        continue
+                    w1 = (u0 - u2) * (y - v2) - (v0 - v2) * (x - u2)
+                    if not _inside(w1, u0 - u2, v0 - v2):
+                        continue
+                    w2 = (u1 - u0) * (y - v0) - (v1 - v0) * (x - u0)
+                    if not _inside(w2, u1 - u0, v1 - v0):
+                        continue
+                    ## the inverse depth is linear in the image
+                    z = area / (w0 * z0 + w1 * z1 + w2 * z2)
+                    if z > zfar:
+                        continue
+                    if depth[r, c] == 0 or z < depth[r, c]:
+                        depth[r, c] = z
+                        ids[r, c] = tri_ids[k]
+
+
+class RasterRenderer:
+    """
+    CPU replacement of pyrender.OffscreenRenderer for the segmentation renders (RenderFlags.SEG), without OpenGL context.
+    The scene, its IntrinsicsCamera and the poses are the same pyrender objects, the camera looks along -z with y up
+    (OpenGL), flipped by Axis_align into the image frame.
+    """
+    def __init__(self, viewport_width, viewport_height, CULL = True):
+        """
+        CULL: cull the back faces of the single sided materials (doubleSided False), as the OpenGL renderer
+        """
+        self.viewport_width = viewport_width
+        self.viewport_height = viewport_height
+        self.CULL = CULL
+        ## vertices, triangles and back face culling of the meshes, by primitive
+        self._geometry = {}
+
+    def _primitive_geometry(self, primitive):
+        if primitive not in self._geometry:
+            positions = np.asarray(primitive.positions, dtype = np.float64)
+            if primitive.indices is None:
+                faces = np.arange(len(positions), dtype = np.int64).reshape(-1, 3)
+            else:
+                faces = np.asarray(primitive.indices, dtype = np.int64).reshape(-1, 3)
+            cull = self.CULL and not (primitive.material is not None and primitive.material.doubleSided)
+            self._geometry[primitive] = (positions, faces, cull)
+        return self._geometry[primitive]
+
+    def render_instances(self, scene, nodes):
+        """
+        Args:
+            scene: pyrender.Scene with an IntrinsicsCamera as main camera
+            nodes: list of the mesh nodes to render
+        Returns:
+            depth: [H, W] float32 depth, 0 for background
+            ids: [H, W] index of the node in nodes for each pixel, -1 for background
+        """
+        camera = scene.main_camera_node.camera
+        ## world -> camera (x right, y down, z forward)
+        world2cam = np.linalg.inv(scene.get_pose(scene.main_camera_node))
+        world2cam[1:3] *= -1
+        points, faces, face_ids, face_cull = [], [], [], []
+        num_points = 0
+        for node_idx, node in enumerate(nodes):
+            node_pose = world2cam.dot(scene.get_pose(node))
+            for primitive in node.mesh.primitives:
+                positions, primitive_faces, cull = self._primitive_geometry(primitive)
+                instance_poses = [np.eye(4)] if primitive.poses is None else primitive.poses
+                for instance_pose in instance_poses:
+                    T = node_pose.dot(instance_pose)
+                    points.append(positions.dot(T[:3, :3].T) + T[:3, 3])
+                    faces.append(primitive_faces + num_points)
+                    face_ids.append(np.full(len(primitive_faces), node_idx, dtype = np.int64))
+                    face_cull.append(np.full(len(primitive_faces), cull, dtype = np.bool_))
+                    num_points += len(positions)
+        depth = np.zeros((self.viewport_height, self.viewport_width), dtype = np.float64)
+        ids = np.full((self.viewport_height, self.viewport_width), -1, dtype = np.int64)
+        if len(faces) > 0:
+            tri_uv, tri_invz, tri_ids, tri_cull = _clip_triangles(np.concatenate(points), np.concatenate(faces), np.concatenate(face_ids),
+                                                                  np.concatenate(face_cull), camera.fx, camera.fy, camera.cx, camera.cy, camera.znear)
+            _rasterize(tri_uv, tri_invz, tri_ids, tri_cull, self.viewport_width, self.viewport_height,
+                       np.inf if camera.zfar is None else camera.zfar, depth, ids)
+        return depth.astype(np.float32), ids
+
+    def render(self, scene, flags = pyrender.constants.RenderFlags.SEG, seg_node_map = None):
+        """
+        Same outputs as pyrender.OffscreenRenderer.render with RenderFlags.SEG, only the nodes of seg_node_map are rendered
+        Returns:
+            color: [H, W, 3] uint8 segmentation color of each pixel, 0 for background
+            depth: [H, W] float32 depth, 0 for background
+        """
+        assert flags & pyrender.constants.RenderFlags.SEG, "the CPU rasterizer only renders segmentation images"
+        nodes = list(seg_node_map)
+        depth, ids = self.render_instances(scene, nodes)
+        colors = np.zeros((len(nodes) + 1, 3), dtype = np.uint8)
+        colors[:len(nodes)] = [seg_node_map[node] for node in nodes]
+        ## index -1 (background) picks the last, black, color
+        return colors[ids], depth
+
+    def delete(self):
+        self._geometry = {}
+
+
+if __name__ == "__main__":
+    ## compare the instance masks and depths with the OpenGL renderer on a test scene
+    ## tolerance: at most 0.01% of the pixels get another instance (ties at shared edges and equal depths),
+    ## the depth of the other pixels is within 1e-4 relative
+    import os
+    import time
+    import trimesh
+    width, height = 640, 480
+    scene = pyrender.Scene()
+    camera = pyrender.Node(camera = pyrender.camera.IntrinsicsCamera(600., 610., 320.5, 241.2, znear = 0.05, zfar = 100.0), matrix = np.eye(4))
+    scene.add_node(camera)
+    rng = np.random.default_rng(1)
+    meshes = [pyrender.Mesh.from_trimesh(trimesh.creation.icosphere(subdivisions = 4, radius = 0.3)),
+              pyrender.Mesh.from_trimesh(trimesh.creation.box(extents = (0.4, 0.3, 0.5))),
+              pyrender.Mesh.from_trimesh(trimesh.creation.cylinder(radius = 0.15, height = 0.6), smooth = False)]
+    seg_node_map = {}
+    for i in range(9):
+        T = trimesh.transformations.random_rotation_matrix(rng.random(3))
+        T[:3, 3] = [rng.uniform(-0.6, 0.6), rng.uniform(-0.4, 0.4), rng.uniform(-3, -1.2)]
+        if i == 8:
+            ## crossing the near plane
+            T[:3, 3] = [0.2, -0.1, -0.1]
+        node = pyrender.Node(mesh = meshes[i % 3], matrix = T)
+        scene.add_node(node)
+        seg_node_map[node] = (i + 1, 0, 0)
+
+    os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+    gl_renderer = pyrender.OffscreenRenderer(width, height)
+    cpu_renderer = RasterRenderer(width, height)
+    cpu_renderer.render(scene, seg_node_map = seg_node_map)
+    for trial in range(5):
+        pose = trimesh.transformations.rotation_matrix(rng.uniform(-0.2, 0.2), rng.random(3))
+        scene.set_pose(camera, pose)
+        start = time.time()
+        gl_color, gl_depth = gl_renderer.render(scene, flags = pyrender.constants.RenderFlags.SEG, seg_node_map = seg_node_map)
+        t_gl = time.time() - start
+        start = time.time()
+        cpu_color, cpu_depth = cpu_renderer.render(scene, seg_node_map = seg_node_map)
+        t_cpu = time.time() - start
+        gl_ids = np.where(gl_depth > 0, gl_color[:, :, 0], 0)
+        cpu_ids = cpu_color[:, :, 0]
+        num_diff = int((gl_ids != cpu_ids).sum())
+        same = (gl_ids == cpu_ids) & (gl_ids > 0)
+        depth_error = np.abs(gl_depth[same] - cpu_depth[same]) / gl_depth[same]
+        print("pose {0}: {1} object pixels, {2} differ, max depth error {3:.1e}, OpenGL {4:.1f} ms, CPU {5:.1f} ms".format(
+              trial, int((gl_ids > 0).sum()), num_diff, depth_error.max(), t_gl * 1000, t_cpu * 1000))
+        assert num_diff <= 1e-4 * width * height
+        assert depth_error.max() < 1e-4
@@ -5,7 +5,9 @@ import os
 import json
 import trimesh
 import pyrender
-from kernel.geometry import _pose2Rotation
+from kernel.pose_utility import inverse, axis_align
+from kernel.campose_utility import read_campose
+from kernel.model_utility import load_mesh, load_model_lod, LOD_LEVELS
 from PIL import Image
 from tqdm import tqdm
 from scipy.io import savemat
@@ -13,15 +15,83 @@ import copy
 import open3d as o3d
 import cv2
 import time
-os.environ['PYOPENGL_PLATFORM'] = 'egl'
+import multiprocessing
+import multiprocessing.util
+import contextlib
+import heapq
+import shutil
+from export_utility import FrameCopier, FrameCheckpoint, StreamingJSONWriter, ImageEncoder, file_key
+from mask_utility import frame_statistics, visible_statistics, rle_encode, rle_encode_instances
+from raster_utility import RasterRenderer
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
+_worker_render = None
+
+def _init_worker(param, outputdir, interpolation_type, pkg_type, copy_mode, RESUME, png_compression, FAST_PNG, render_backend, lod_tolerance, mask_format):
+    ## every worker process owns its renderer, scene and image encoder
+    global _worker_render
+    _worker_render = offlineRender(param, outputdir, interpolation_type, pkg_type, workers = 1, copy_mode = copy_mode, RESUME = RESUME, 
+                                   png_compression = png_compression, FAST_PNG = FAST_PNG, RENDER = False, render_backend = render_backend,
+                                   lod_tolerance = lod_tolerance, mask_format = mask_format)
+    ## the queued images are written before the worker exits
+    multiprocessing.util.Finalize(None, _worker_render.encoder.close, exitpriority = 10)
+
+def _create_renderer(render_backend, width, height):
+    '''
+    "pyrender" (OpenGL, EGL by default), "raster" (CPU rasterizer of raster_utility) or "auto", pyrender when an OpenGL context could be created
+    '''
+    assert(render_backend in ["auto", "pyrender", "raster"])
+    if render_backend != "raster":
+        try:
+            return pyrender.OffscreenRenderer(width, height)
+        except Exception as e:
+            ## the failures of the platforms are not of one type (ImportError, RuntimeError, EGL/OSMesa errors)
+            if render_backend == "pyrender":
+                raise
+            print("No OpenGL context ({0}), rendering with the CPU rasterizer".format(e))
+    return RasterRenderer(width, height)
+
+def _render_worker(task):
+    frame_method, idx, cam_name = task
+    return getattr(_worker_render, frame_method)(idx, cam_name)
 
 class offlineRender:
-    def __init__(self, param, outputdir, interpolation_type, pkg_type = "BOP") -> None:
+    def __init__(self, param, outputdir, interpolation_type, pkg_type = "BOP", workers = 1, copy_mode = "copy", RESUME = False, COMPACT_JSON = False, 
+                 png_compression = 6, FAST_PNG = False, RENDER = True, render_backend = "auto", lod_tolerance = None, lod_validation = 10, 
+                 mask_format = "png") -> None:
+        '''
+        workers: number of processes rendering the frames, each process has its own renderer and scene
+        copy_mode: how the input rgb and depth are put into the output, "copy", "hardlink", "reflink" or "symlink"
+        RESUME: (BOP) keep a checkpoint per frame (.checkpoint) and only render the frames without complete outputs or affected by changes
+        COMPACT_JSON: (BOP) write the scene json files without indent and whitespace
+        png_compression: zlib level (0-9) of the mask, label and rgb PNG files, these are encoded in the background
+        FAST_PNG: encode the PNG files with the faster OpenCV encoder, the images are the same
+        RENDER: False to only prepare the scene and the renderer without rendering (used by the worker processes)
+        render_backend: "pyrender" (OpenGL), "raster" (CPU rasterizer, no OpenGL context needed) or "auto" (pyrender if available)
+        lod_tolerance: render the masks with decimated models (kernel.model_utility.load_model_lod) whose geometric error projects
+                       below this many pixels, None for the full models
+        lod_validation: number of frames on which the masks of the decimated models are compared with the full models (lod_validation.json)
+        mask_format: (BOP) "png" for the mask and mask_visib PNG files, "rle" for the COCO run-length encoded masks of all the frames
+                     in scene_gt_masks.json (mask_utility.rle_encode, readable with pycocotools)
+        '''
         assert(pkg_type in ["ProgressLabeller", "BOP", "YCBV", "Yourtype"])
-        print("Start offline rendering")
+        assert(mask_format in ["png", "rle"])
+        if RENDER:
+            print("Start offline rendering")
         self.param = param
         self.interpolation_type = interpolation_type
         self.outputpath = outputdir
+        self.pkg_type = pkg_type
+        self.workers = workers
+        self.copy_mode = copy_mode
+        self.RESUME = RESUME
+        self.COMPACT_JSON = COMPACT_JSON
+        self.png_compression = png_compression
+        self.FAST_PNG = FAST_PNG
+        self.render_backend = render_backend
+        self.lod_tolerance = lod_tolerance
+        self.lod_validation = lod_validation
+        self.mask_format = mask_format
         self.modelsrc = self.param.modelsrc
         self.reconstructionsrc = self.param.reconstructionsrc
         self.datasrc = self.param.datasrc
@@ -29,26 +99,61 @@ class offlineRender:
         self.objects = self.param.objs
         
         self._parsecamfile()
-        if pkg_type == "ProgressLabeller":
+        if pkg_type == "BOP":
+            self.object_label = param.object_label
+            self._prepare_scene_BOP()
+        elif pkg_type in ["YCBV", "Yourtype"]:
+            self.object_label = param.object_label
             self._prepare_scene()
+        else:
+            self._prepare_scene()
+        ## with several workers, the frames are rendered in the worker processes only
+        self.render = None
+        self.encoder = None
+        if self.workers <= 1:
+            self.render = _create_renderer(self.render_backend, self.param.camera["resolution"][0], self.param.camera["resolution"][1])
+            self.encoder = ImageEncoder(compress_level = self.png_compression, FAST_CODEC = self.FAST_PNG)
+        if not RENDER:
+            return
+
+        if pkg_type == "ProgressLabeller":
             self._createallpkgs()
-            self.render = pyrender.OffscreenRenderer(self.param.camera["resolution"][0], self.param.camera["resolution"][1])
             self.renderAll()
         elif pkg_type == "BOP":
-            self.object_label = param.object_label
-            self._prepare_scene_BOP()
-            self.render = pyrender.OffscreenRenderer(self.param.camera["resolution"][0], self.param.camera["resolution"][1])
             self.renderBOP()
         elif pkg_type == "YCBV":    
-            self.object_label = param.object_label
-            self._prepare_scene()
-            self.render = pyrender.OffscreenRenderer(self.param.camera["resolution"][0], self.param.camera["resolution"][1])
             self.renderYCBV()
         elif pkg_type == "Yourtype":
-            self.object_label = param.object_label
-            self._prepare_scene()
-            self.render = pyrender.OffscreenRenderer(self.param.camera["resolution"][0], self.param.camera["resolution"][1])            
             self.renderYourtype()
+        self._validateLOD()
+
+    def _renderframes(self, frame_method, frames = None):
+        '''
+        Call self.<frame_method>(idx, cam_name) for every (idx, cam_name) in frames (default all frames) and yield the results in frame order
+        With several workers, the frame list is sharded into contiguous chunks over the worker processes
+        '''
+        if frames is None:
+            frames = list(enumerate(self.camposes))
+        tasks = [(frame_method, idx, cam_name) for idx, cam_name in frames]
+        if len(tasks) == 0:
+            return
+        if self.workers <= 1:
+            for task in tqdm(tasks):
+                yield getattr(self, frame_method)(task[1], task[2])
+            self.encoder.flush()
+        else:
+            ## spawn instead of fork, the EGL/OSMesa context could not be shared with the child processes
+            ctx = multiprocessing.get_context("spawn")
+            chunksize = max(1, int(np.ceil(len(tasks) / (4 * self.workers))))
+            with ctx.Pool(self.workers, initializer = _init_worker, 
+                          initargs = (self.param, self.outputpath, self.interpolation_type, self.pkg_type, self.copy_mode, self.RESUME,
+                                      self.png_compression, self.FAST_PNG, self.render_backend, self.lod_tolerance,
+                                      self.mask_format)) as pool:
+                for result in tqdm(pool.imap(_render_worker, tasks, chunksize = chunksize), total = len(tasks)):
+                    yield result
+                ## let the workers exit normally and finish their queued images
+                pool.close()
+                pool.join()
     
     def data_export(self, target_dir):
         if not os.path.exists(target_dir):
@@ -65,67 +170,225 @@ class offlineRender:
                                                znear=0.05, zfar=100.0, name=None)
         self.nc = pyrender.Node(camera=cam, matrix=np.eye(4))
         self.scene.add_node(self.nc)
+        ## the instances of a model share one mesh
+        meshes = {}
         for obj_instancename in self.objects:
             obj = obj_instancename.split(".")[0]
             ## for full model
             if self.objects[obj_instancename]['type'] == 'normal':
-                tm = trimesh.load(os.path.join(self.modelsrc, obj, obj+".obj"))
-                mesh = pyrender.Mesh.from_trimesh(tm, smooth = False)
+                tm = load_mesh(os.path.join(self.modelsrc, obj, obj+".obj"))
+                if obj not in meshes:
+                    meshes[obj] = pyrender.Mesh.from_trimesh(tm, smooth = False)
+                mesh = meshes[obj]
                 node = pyrender.Node(mesh=mesh, matrix=self.objects[obj_instancename]['trans'])
-                self.objectmap[node] = {"index":object_index, "name":obj_instancename, "trans":self.objects[obj_instancename]['trans']}
+                self.objectmap[node] = {"index":object_index, "name":obj_instancename, "trans":self.objects[obj_instancename]['trans'], "bounds":tm.bounds,
+                                        "model":os.path.join(self.modelsrc, obj, obj+".obj"), "mesh":mesh}
                 self.scene.add_node(node)
                 object_index += 1
+        self._prepare_segmentation()
+
+    def _prepare_segmentation(self):
+        ## flat color for each object node, the color encodes the instance id (objectmap order + 1)
+        self.seg_node_map = {}
+        for obj_idx, node in enumerate(self.objectmap):
+            instance_id = obj_idx + 1
+            self.seg_node_map[node] = (instance_id & 255, (instance_id >> 8) & 255, 0)
+        ## decimated meshes by (model, level) and geometric errors of the levels by model
+        self.lod_meshes = {}
+        self.lod_errors = {}
+        ## corners of the bounding boxes of the objects in the world frame, [K, 8, 4], for the frustum culling
+        self.node_corners = np.zeros((len(self.objectmap), 8, 4))
+        for obj_idx, node in enumerate(self.objectmap):
+            bounds = self.objectmap[node]["bounds"]
+            corners = np.array([[x, y, z, 1] for x in bounds[:, 0] for y in bounds[:, 1] for z in bounds[:, 2]])
+            self.node_corners[obj_idx] = corners.dot(self.objectmap[node]["trans"].T)
+
+    def _cullnodes(self, cam_name):
+        '''
+        Frustum culling of the objects for one frame, conservative: the bounding box corners are projected with the camera pose and intrinsics
+            visible: [K] False for the objects which could not be seen (behind the camera or outside the image)
+            rois: [K, 4] (left, top, right, bottom) pixel rectangle (right and bottom excluded) holding the projection of each object,
+                  the whole image for the objects crossing the near plane
+        '''
+        width, height = self.param.camera["resolution"][0], self.param.camera["resolution"][1]
+        znear = self.nc.camera.znear
+        cam_pts = np.matmul(self.node_corners, inverse(self.camposes[cam_name]).T)[..., :3]
+        depth = cam_pts[..., 2]
+        rois = np.tile(np.array([0, 0, width, height], dtype = np.int64), (len(self.node_corners), 1))
+        front = np.all(depth > znear, axis = 1)
+        if np.any(front):
+            pixels = np.matmul(cam_pts[front], self.intrinsic.T)
+            pixels = pixels[..., :2] / pixels[..., 2:]
+            ## one pixel of margin around the projected box
+            lower = np.floor(pixels.min(axis = 1)) - 1
+            upper = np.ceil(pixels.max(axis = 1)) + 1
+            rois[front, 0] = np.clip(lower[:, 0], 0, width)
+            rois[front, 1] = np.clip(lower[:, 1], 0, height)
+            rois[front, 2] = np.clip(upper[:, 0], 0, width)
+            rois[front, 3] = np.clip(upper[:, 1], 0, height)
+        visible = ~np.all(depth <= znear, axis = 1) & (rois[:, 2] > rois[:, 0]) & (rois[:, 3] > rois[:, 1])
+        return visible, rois
+
+    def _lodlevel(self, node, depth):
+        '''
+        Coarsest level of detail of an object whose error projects below lod_tolerance pixels at the depth of its nearest point, None for the full model
+            depth: nearest depth of the bounding box of the object
+        A displacement d at depth z moves its projection by less than f * d / z * (1 + r) pixels, r is the largest distance
+        in the image to the principal point divided by f
+        '''
+        if depth <= self.nc.camera.znear:
+            return None
+        model = self.objectmap[node]["model"]
+        if model not in self.lod_errors:
+            self.lod_errors[model] = [load_model_lod(model, level)[3] for level in range(LOD_LEVELS)]
+        width, height = self.param.camera["resolution"][0], self.param.camera["resolution"][1]
+        fx, fy, cx, cy = self.intrinsic[0, 0], self.intrinsic[1, 1], self.intrinsic[0, 2], self.intrinsic[1, 2]
+        pixel_per_unit = max(fx, fy) / depth * (1 + max(cx, width - cx, cy, height - cy) / min(fx, fy))
+        for level in range(LOD_LEVELS):
+            if self.lod_errors[model][level] * pixel_per_unit <= self.lod_tolerance:
+                return level
+        return None
+
+    def _lodmesh(self, node, level):
+        ## decimated models shared by the instances, double sided: collapsed triangles could have flipped
+        key = (self.objectmap[node]["model"], level)
+        if key not in self.lod_meshes:
+            vertices, faces, normals, _ = load_model_lod(self.objectmap[node]["model"], level)
+            if len(faces) >= len(load_mesh(self.objectmap[node]["model"]).faces):
+                ## not smaller than the full model
+                self.lod_meshes[key] = self.objectmap[node]["mesh"]
+            else:
+                tm = trimesh.Trimesh(vertices = vertices, faces = faces, vertex_normals = normals, process = False)
+                self.lod_meshes[key] = pyrender.Mesh.from_trimesh(tm, material = pyrender.MetallicRoughnessMaterial(doubleSided = True))
+                ## the meshes stay in the scene in nodes which are never rendered (not in the seg_node_map), so the OpenGL
+                ## renderer keeps their buffers when the objects switch levels
+                for mesh in [self.lod_meshes[key], self.objectmap[node]["mesh"]]:
+                    if mesh not in self.scene.meshes:
+                        self.scene.add_node(pyrender.Node(mesh = mesh, matrix = np.eye(4)))
+        return self.lod_meshes[key]
+
+    def _selectlod(self, cam_name, FULL = False):
+        '''
+        Put the level of detail of every object for one frame into the scene, nothing without lod_tolerance
+            FULL: put back the full models
+        '''
+        if self.lod_tolerance is None:
+            return
+        ## nearest depth of the bounding boxes, the depth is linear so its minimum over a box is at a corner
+        depth = np.matmul(self.node_corners, inverse(self.camposes[cam_name])[2]).min(axis = 1)
+        for obj_idx, node in enumerate(self.objectmap):
+            level = None if FULL else self._lodlevel(node, depth[obj_idx])
+            node.mesh = self.objectmap[node]["mesh"] if level is None else self._lodmesh(node, level)
+
+    def _validateLOD(self):
+        '''
+        Compare the masks (amodal and visible) rendered with the levels of detail and with the full models on lod_validation frames
+        spread over the sequence, the IoU of every object in view is written into lod_validation.json
+        '''
+        if self.lod_tolerance is None or self.lod_validation <= 0 or len(self.camposes) == 0:
+            return
+        render = self.render
+        if self.render is None:
+            self.render = _create_renderer(self.render_backend, self.param.camera["resolution"][0], self.param.camera["resolution"][1])
+        cam_names = list(self.camposes)
+        frames = np.unique(np.linspace(0, len(cam_names) - 1, min(self.lod_validation, len(cam_names))).round().astype(int))
+        ious = {"mask": {}, "mask_visib": {}}
+        for idx in frames:
+            cam_name = cam_names[idx]
+            camT = axis_align(self.camposes[cam_name])
+            visible, rois = self._cullnodes(cam_name)
+            masks = []
+            for FULL in [True, False]:
+                self._selectlod(cam_name, FULL = FULL)
+                _, instance = self._render_instances(camT, visible)
+                masks.append({"mask": [self._render_amodal(node, rois[obj_idx]) > 0 if visible[obj_idx] else None for obj_idx, node in enumerate(self.objectmap)],
+                              "mask_visib": [instance == obj_idx + 1 for obj_idx in range(len(self.objectmap))]})
+            for obj_idx, node in enumerate(self.objectmap):
+                if not visible[obj_idx]:
+                    continue
+                for mask_type in ious:
+                    full, lod = masks[0][mask_type][obj_idx], masks[1][mask_type][obj_idx]
+                    union = np.count_nonzero(full | lod)
+                    if union > 0:
+                        ious[mask_type].setdefault(self.objectmap[node]["name"], []).append(np.count_nonzero(full & lod) / union)
+        self._selectlod(cam_names[0], FULL = True)
+        self.render = render
+        report = {"lod_tolerance": self.lod_tolerance, "frames": [cam_names[idx] for idx in frames]}
+        for mask_type in ious:
+            values = [iou for name in ious[mask_type] for iou in ious[mask_type][name]]
+            report[mask_type] = {"mean_iou": float(np.mean(values)) if values else None, "min_iou": float(np.min(values)) if values else None,
+                                 "objects": {name: {"mean_iou": float(np.mean(ious[mask_type][name])), "min_iou": float(np.min(ious[mask_type][name]))}
+                                             for name in ious[mask_type]}}
+            print("Level of detail {0} IoU on {1} frames: mean {2}, min {3}".format(mask_type, len(frames), report[mask_type]["mean_iou"], report[mask_type]["min_iou"]))
+        with open(os.path.join(self.outputpath, "lod_validation.json"), "w") as f:
+            json.dump(report, f, indent = True)
 
     def _parsecamfile(self):
-        self.camposes = {}
-        f = open(os.path.join(self.reconstructionsrc, "campose_all_{0}.txt".format(self.interpolation_type)))
-        # f = open(os.path.join(self.reconstructionsrc, "campose.txt"))
-        lines = f.readlines()
-        for l in lines:
-            datas = l.split(" ")
-            if datas[0].isnumeric():
-                self.camposes[datas[-1].split("\n")[0]] = _pose2Rotation([[float(datas[5]), float(datas[6]), float(datas[7])],\
-                                                           [float(datas[1]), float(datas[2]), float(datas[3]), float(datas[4])]])
+        camposes = read_campose(os.path.join(self.reconstructionsrc, "campose_all_{0}.txt".format(self.interpolation_type)))
+        # camposes = read_campose(os.path.join(self.reconstructionsrc, "campose.txt"))
+        self.camposes = dict(zip(camposes.names, camposes.matrices()))
     
     def _applytrans2cam(self):
-        Axis_align = np.array([[1, 0, 0, 0],
-                               [0, -1, 0, 0],
-                               [0, 0, -1, 0],
-                               [0, 0, 0, 1],]
-            )
+        if len(self.camposes) == 0:
+            return
         scale = self.param.recon["scale"]
         trans = self.param.recon["trans"]
-        for cam in self.camposes:
-            origin_pose = self.camposes[cam]
-            origin_pose[:3, 3] = origin_pose[:3, 3] * scale
-            if self.CAM_INVERSE:
-                origin_pose = np.linalg.inv(origin_pose).dot(Axis_align)
-            else:
-                origin_pose = origin_pose.dot(Axis_align)
-            self.camposes[cam] = trans.dot(origin_pose)
+        origin_poses = np.stack(list(self.camposes.values()))
+        origin_poses[:, :3, 3] = origin_poses[:, :3, 3] * scale
+        if self.CAM_INVERSE:
+            origin_poses = inverse(origin_poses)
+        self.camposes = dict(zip(self.camposes.keys(), np.matmul(trans, axis_align(origin_poses))))
 
-    def _render(self, cam_pose, scene):
+    def _render(self, cam_pose, scene, visible = None):
         ##segimg is the instance segmentation for each part(normal or each part for the split)
-        scene.set_pose(self.nc, pose=cam_pose)
-        flags = pyrender.constants.RenderFlags.DEPTH_ONLY
-        segimg = np.zeros((self.param.camera["resolution"][1], self.param.camera["resolution"][0]), dtype=np.uint8)
+        _, instance = self._render_instances(cam_pose, visible)
+        return instance.astype(np.uint8)
 
-        full_depth = self.render.render(scene, flags = flags)
-        for node in self.objectmap:
-            node.mesh.is_visible = False
-        
-        for node in self.objectmap:
-            node.mesh.is_visible = True
-            depth = self.render.render(scene, flags = flags)
-            mask = np.logical_and(
-                (np.abs(depth - full_depth) < 1e-6), np.abs(full_depth) > 0
-            )
-            segimg[mask] = self.objectmap[node]['index'] + 1
-            node.mesh.is_visible = False
-        
-        for node in self.objectmap:
-            node.mesh.is_visible = True
-        return segimg
+    def _render_instances(self, cam_pose, visible = None):
+        '''
+        Render the whole scene once with flat instance colors
+            visible: [K] objects to render (see _cullnodes), default all objects
+            full_depth: depth of the whole scene, 0 for background
+            instance: instance id of each pixel, 0 for background, obj_idx + 1 for the obj_idx-th node in self.objectmap
+        '''
+        self.scene.set_pose(self.nc, pose=cam_pose)
+        if visible is None:
+            seg_node_map = self.seg_node_map
+        else:
+            seg_node_map = {node: self.seg_node_map[node] for obj_idx, node in enumerate(self.objectmap) if visible[obj_idx]}
+        if len(seg_node_map) == 0:
+            full_depth = np.zeros((self.param.camera["resolution"][1], self.param.camera["resolution"][0]), dtype = np.float32)
+            return full_depth, np.zeros(full_depth.shape, dtype = np.uint16)
+        flags = pyrender.constants.RenderFlags.SEG
+        color, full_depth = self.render.render(self.scene, flags = flags, seg_node_map = seg_node_map)
+        instance = color[:, :, 0].astype(np.uint16) + (color[:, :, 1].astype(np.uint16) << 8)
+        instance[full_depth <= 0] = 0
+        return full_depth, instance
+
+    def _render_amodal(self, node, roi = None):
+        '''
+        Render the depth of one object without occlusion (amodal), the camera pose is set by _render_instances
+            roi: (left, top, right, bottom) only render this rectangle of the image (see _cullnodes), the depth is 0 outside
+        '''
+        flags = pyrender.constants.RenderFlags.SEG
+        width, height = self.param.camera["resolution"][0], self.param.camera["resolution"][1]
+        if roi is None or tuple(roi) == (0, 0, width, height):
+            _, depth = self.render.render(self.scene, flags = flags, seg_node_map = {node: self.seg_node_map[node]})
+            return depth
+        ## a smaller viewport with the principal point moved by the corner of the rectangle samples the same pixel centers
+        left, top, right, bottom = [int(v) for v in roi]
+        camera = self.nc.camera
+        cx, cy = camera.cx, camera.cy
+        camera.cx, camera.cy = cx - left, cy - top
+        self.render.viewport_width, self.render.viewport_height = right - left, bottom - top
+        try:
+            _, roi_depth = self.render.render(self.scene, flags = flags, seg_node_map = {node: self.seg_node_map[node]})
+        finally:
+            camera.cx, camera.cy = cx, cy
+            self.render.viewport_width, self.render.viewport_height = width, height
+        depth = np.zeros((height, width), dtype = roi_depth.dtype)
+        depth[top:bottom, left:right] = roi_depth
+        return depth
 
     def _createpkg(self, dir):
         if os.path.exists(dir):
@@ -142,25 +405,24 @@ class offlineRender:
     
     def renderAll(self):
         ## generate whole output dataset
-        Axis_align = np.array([[1, 0, 0, 0],
-                               [0, -1, 0, 0],
-                               [0, 0, -1, 0],
-                               [0, 0, 0, 1],]
-                                )
-       
-        for cam in tqdm(self.camposes):
-            camT = self.camposes[cam].dot(Axis_align)
-            segment = self._render(camT, self.scene)
-            perfix = cam.split(".")[0]
-            inputrgb = np.array(Image.open(os.path.join(self.datasrc, "rgb", cam)))
-
-            for node in self.objectmap:
-                posepath = os.path.join(self.outputpath, self.objectmap[node]["name"], "pose")
-                rgbpath = os.path.join(self.outputpath, self.objectmap[node]["name"], "rgb")
-                modelT = self.objectmap[node]["trans"]
-                model_camT = np.linalg.inv(modelT).dot(self.camposes[cam])
-                self._createpose(posepath, perfix, model_camT)
-                self._createrbg(inputrgb, segment, os.path.join(rgbpath, cam), self.objectmap[node]["index"] + 1)
+        for _ in self._renderframes("_renderAllframe"):
+            pass
+
+    def _renderAllframe(self, idx, cam):
+        camT = axis_align(self.camposes[cam])
+        visible, _ = self._cullnodes(cam)
+        self._selectlod(cam)
+        segment = self._render(camT, self.scene, visible)
+        perfix = cam.split(".")[0]
+        inputrgb = np.array(Image.open(os.path.join(self.datasrc, "rgb", cam)))
+
+        for node in self.objectmap:
+            posepath = os.path.join(self.outputpath, self.objectmap[node]["name"], "pose")
+            rgbpath = os.path.join(self.outputpath, self.objectmap[node]["name"], "rgb")
+            modelT = self.objectmap[node]["trans"]
+            model_camT = inverse(modelT).dot(self.camposes[cam])
+            self._createpose(posepath, perfix, model_camT)
+            self._createrbg(inputrgb, segment, os.path.join(rgbpath, cam), self.objectmap[node]["index"] + 1)
 
     def _createpose(self, path, perfix, T):
         posefileName = os.path.join(path, perfix + ".txt")
@@ -171,92 +433,178 @@ class offlineRender:
         rgb = inputrgb.copy()
         mask = np.repeat((segment != segment_index)[:, :, np.newaxis], 3, axis=2)
         rgb[mask] = 0
-        img = Image.fromarray(rgb)
-        img.save(outputpath)
+        self.encoder.submit(rgb, outputpath)
     
 
     def renderBOP(self):
         ## should be change by user, 
         self._createpkg(os.path.join(self.outputpath, "depth"))
-        self._createpkg(os.path.join(self.outputpath, "mask"))
-        self._createpkg(os.path.join(self.outputpath, "mask_visib"))
+        if self.mask_format == "png":
+            self._createpkg(os.path.join(self.outputpath, "mask"))
+            self._createpkg(os.path.join(self.outputpath, "mask_visib"))
         self._createpkg(os.path.join(self.outputpath, "rgb"))
-        scene_camera = {}
-        scene_gt = {}
-        scene_gt_info = {}
-        for idx, cam_name in tqdm(enumerate(self.camposes)):
-            os.system('cp ' + os.path.join(self.datasrc, "rgb", cam_name) + ' ' + os.path.join(self.outputpath, "rgb", "{0:06d}.png".format(idx)))
-            os.system('cp ' + os.path.join(self.datasrc, "depth", cam_name) + ' ' + os.path.join(self.outputpath, "depth", "{0:06d}.png".format(idx)))
-            inputdepth = Image.open(os.path.join(self.datasrc, "depth", cam_name))
-            ### 
-            scene_camera[idx] = {
-                "cam_K": self.intrinsic.flatten().tolist(),
-                "cam_R_w2c": (self.camposes[cam_name][:3, :3]).flatten().tolist(),
-                "cam_t_w2c": (self.camposes[cam_name][:3, 3]).flatten().tolist(),
-                "depth_scale": np.round(self.param.data['depth_scale'], 5),
-                "mode": 0
-            }
-            scene_gt[idx] = list()
-            scene_gt_info[idx] = list()
-            ## render
-            Axis_align = np.array([[1, 0, 0, 0],
-                               [0, -1, 0, 0],
-                               [0, 0, -1, 0],
-                               [0, 0, 0, 1],]
-            )
-            camT = self.camposes[cam_name].dot(Axis_align)
-            self.scene.set_pose(self.nc, pose=camT)
-            flags = pyrender.constants.RenderFlags.DEPTH_ONLY
-            for node in self.objectmap:
-                node.mesh.is_visible = True
-            full_depth = self.render.render(self.scene, flags = flags)
-
-            for node in self.objectmap:
-                node.mesh.is_visible = False
-            
-            for obj_idx, node in enumerate(self.objectmap):
-                node.mesh.is_visible = True
-                depth = self.render.render(self.scene, flags = flags)
-                mask = np.logical_and(
-                    (np.abs(depth - full_depth) < 1e-6), np.abs(full_depth) > 0
-                )
-
-                ## calculate ketpoints location
-                instance_name = self.objectmap[node]['name']
-                cam_world_T = np.linalg.inv(self.camposes[cam_name])
-
-                mask_trim = (np.abs(depth) > 0)
-                mask_visiable_trim = mask
-                mask_pillow = Image.fromarray((mask_trim * 255).astype('uint8'))
-                mask_pillow.save(os.path.join(self.outputpath, "mask", "{0:06d}_{1:06d}.png".format(idx ,obj_idx)))
-                mask_visiable_pillow = Image.fromarray((mask_visiable_trim * 255).astype('uint8'))
-                mask_visiable_pillow.save(os.path.join(self.outputpath, "mask_visib", "{0:06d}_{1:06d}.png".format(idx ,obj_idx)))
-                node.mesh.is_visible = False
-                if not self._getbbx(mask_trim)[0]:
-                    continue
-                scene_gt_info[idx].append({
-                    "bbox_obj": self._getbbx(mask_trim)[1], 
-                    "bbox_visib": self._getbbx(mask_visiable_trim)[1],
-                    "px_count_all": int(np.sum(depth > 0)),
-                    "px_count_valid": int(np.sum(np.array(inputdepth)[mask_trim] != 0)),
-                    "px_count_visib": int(np.sum(mask_visiable_trim)),
-                    "visib_fract": float(np.sum(mask_visiable_trim)/np.sum(depth > 0)),
-                })
-                modelT = self.objectmap[node]["trans"]
-                model_camT = np.linalg.inv(modelT).dot(self.camposes[cam_name])
-                scene_gt[idx].append({
-                    "cam_R_m2c": (model_camT[:3, :3]).flatten().tolist(),
-                    "cam_t_m2c":(model_camT[:3, 3]).flatten().tolist(),
-                    "obj_id": self.objectmap[node]['index']
-                })
-            # if idx == 1: # TODO: remove later, rerun entire scene
-            #     break
-        with open(os.path.join(self.outputpath, 'scene_camera.json'), 'w', encoding='utf-8') as f:
-            json.dump(scene_camera, f, ensure_ascii=False, indent=1)
-        with open(os.path.join(self.outputpath, 'scene_gt.json'), 'w', encoding='utf-8') as f:
-            json.dump(scene_gt, f, ensure_ascii=False, indent=1)
-        with open(os.path.join(self.outputpath, 'scene_gt_info.json'), 'w', encoding='utf-8') as f:
-            json.dump(scene_gt_info, f, ensure_ascii=False, indent=1)
+        ## copy all the input frames in the background while rendering
+        copier = FrameCopier(self.copy_mode)
+        for idx, cam_name in enumerate(self.camposes):
+            copier.submit(os.path.join(self.datasrc, "rgb", cam_name), os.path.join(self.outputpath, "rgb", "{0:06d}.png".format(idx)))
+            copier.submit(os.path.join(self.datasrc, "depth", cam_name), os.path.join(self.outputpath, "depth", "{0:06d}.png".format(idx)))
+        ## frames with an up-to-date checkpoint are not rendered again, the checkpoints are only kept when resuming
+        checkpoint = None
+        if self.RESUME:
+            checkpoint = FrameCheckpoint(os.path.join(self.outputpath, ".checkpoint"))
+        elif os.path.exists(os.path.join(self.outputpath, ".checkpoint")):
+            ## the records of an earlier export no longer match its outputs
+            shutil.rmtree(os.path.join(self.outputpath, ".checkpoint"))
+        uptodate = set()
+        todo = []
+        for idx, cam_name in enumerate(self.camposes):
+            record = checkpoint.load(idx) if checkpoint is not None else None
+            if record is not None and self._isuptodateBOP(idx, cam_name, record):
+                uptodate.add(idx)
+            else:
+                todo.append((idx, cam_name))
+        if self.RESUME:
+            print("Resume BOP export: {0} of {1} frames to render".format(len(todo), len(self.camposes)))
+        ## the scene json files are written frame by frame, nothing is accumulated in memory
+        ## the run-length encoded masks are always compact, they are not meant to be read
+        with copier, \
+             StreamingJSONWriter(os.path.join(self.outputpath, 'scene_camera.json'), COMPACT = self.COMPACT_JSON) as scene_camera, \
+             StreamingJSONWriter(os.path.join(self.outputpath, 'scene_gt.json'), COMPACT = self.COMPACT_JSON) as scene_gt, \
+             StreamingJSONWriter(os.path.join(self.outputpath, 'scene_gt_info.json'), COMPACT = self.COMPACT_JSON) as scene_gt_info, \
+             StreamingJSONWriter(os.path.join(self.outputpath, 'scene_gt_masks.json'), COMPACT = True) if self.mask_format == "rle" else contextlib.nullcontext() as scene_gt_masks:
+            ## the rendered frames are merged in frame order with the up-to-date ones, both iterators are run to their end
+            ## so that the workers are joined after their queued images are written
+            for idx, camera, gt, gt_info, masks in heapq.merge(self._renderframes("_renderBOPframe", todo),
+                                                               self._checkpointedBOP(checkpoint, sorted(uptodate)),
+                                                               key = lambda frame: frame[0]):
+                scene_camera.write(idx, camera)
+                scene_gt.write(idx, gt)
+                scene_gt_info.write(idx, gt_info)
+                if scene_gt_masks is not None:
+                    scene_gt_masks.write(idx, masks)
+        if self.encoder is not None:
+            self.encoder.flush()
+
+    def _checkpointedBOP(self, checkpoint, frames):
+        ## the results of the up-to-date frames, as returned by _renderBOPframe
+        for idx in frames:
+            record = checkpoint.load(idx)
+            yield idx, record["scene_camera"], record["scene_gt"], record["scene_gt_info"], record.get("masks")
+
+    def _renderBOPframe(self, idx, cam_name):
+        inputdepth = np.array(Image.open(os.path.join(self.datasrc, "depth", cam_name)))
+        ### 
+        scene_camera = {
+            "cam_K": self.intrinsic.flatten().tolist(),
+            "cam_R_w2c": (self.camposes[cam_name][:3, :3]).flatten().tolist(),
+            "cam_t_w2c": (self.camposes[cam_name][:3, 3]).flatten().tolist(),
+            "depth_scale": np.round(self.param.data['depth_scale'], 5),
+            "mode": 0
+        }
+        scene_gt = list()
+        scene_gt_info = list()
+        visible = list()
+        ## render
+        camT = axis_align(self.camposes[cam_name])
+        ## the objects out of the view are not rendered, their masks are empty and they are not in scene_gt
+        inview, rois = self._cullnodes(cam_name)
+        self._selectlod(cam_name)
+        full_depth, instance = self._render_instances(camT, inview)
+
+        amodal = np.zeros((len(self.objectmap),) + instance.shape, dtype=bool)
+        written = []
+        for obj_idx, node in enumerate(self.objectmap):
+            if inview[obj_idx]:
+                amodal[obj_idx] = self._render_amodal(node, rois[obj_idx]) > 0
+            if self.mask_format == "png":
+                written.append(self.encoder.submit((amodal[obj_idx] * 255).astype('uint8'), 
+                                                   os.path.join(self.outputpath, "mask", "{0:06d}_{1:06d}.png".format(idx ,obj_idx))))
+                written.append(self.encoder.submit(((instance == obj_idx + 1) * 255).astype('uint8'), 
+                                                   os.path.join(self.outputpath, "mask_visib", "{0:06d}_{1:06d}.png".format(idx ,obj_idx))))
+        ## the masks of all objects in the order of the PNG file names, obj_idx
+        masks = None
+        if self.mask_format == "rle":
+            masks = [{"mask": rle_encode(amodal[obj_idx]), "mask_visib": mask_visib} 
+                     for obj_idx, mask_visib in enumerate(rle_encode_instances(instance, len(self.objectmap)))]
+
+        ## statistics of all objects at once
+        stats = frame_statistics(instance, amodal, inputdepth)
+        for obj_idx, node in enumerate(self.objectmap):
+            if stats["px_count_all"][obj_idx] == 0:
+                continue
+            scene_gt_info.append({
+                "bbox_obj": stats["bbox_obj"][obj_idx].tolist(), 
+                "bbox_visib": stats["bbox_visib"][obj_idx].tolist() if stats["px_count_visib"][obj_idx] > 0 else [],
+                "px_count_all": int(stats["px_count_all"][obj_idx]),
+                "px_count_valid": int(stats["px_count_valid"][obj_idx]),
+                "px_count_visib": int(stats["px_count_visib"][obj_idx]),
+                "visib_fract": float(stats["visib_fract"][obj_idx]),
+            })
+            modelT = self.objectmap[node]["trans"]
+            model_camT = inverse(modelT).dot(self.camposes[cam_name])
+            scene_gt.append({
+                "cam_R_m2c": (model_camT[:3, :3]).flatten().tolist(),
+                "cam_t_m2c":(model_camT[:3, 3]).flatten().tolist(),
+                "obj_id": self.objectmap[node]['index']
+            })
+            visible.append(self.objectmap[node]['name'])
+        if self.RESUME:
+            ## the checkpoint is written after the masks of the frame, a frame with a checkpoint always has its masks
+            self.encoder.when_written(written, FrameCheckpoint(os.path.join(self.outputpath, ".checkpoint")).save, idx, {
+                "cam_name": cam_name,
+                "cam_pose": self.camposes[cam_name].tolist(),
+                "inputs": self._inputsBOP(cam_name),
+                "objects": {self.objectmap[node]['name']: self.objectmap[node]['trans'].tolist() for node in self.objectmap},
+                "visible": visible,
+                "scene_camera": scene_camera,
+                "scene_gt": scene_gt,
+                "scene_gt_info": scene_gt_info,
+                "masks": masks,
+            })
+        return idx, scene_camera, scene_gt, scene_gt_info, masks
+
+    def _isuptodateBOP(self, idx, cam_name, record):
+        '''
+        Check whether the checkpoint record of a frame still holds
+            the camera pose and the objects (names and order) should be the same
+            the intrinsics, depth scale, level of detail tolerance, model files and input depth frame should be the same (_inputsBOP)
+            an object whose pose changed should neither be visible in the record nor could be visible with the new pose
+            mask and mask_visib of all objects should exist, as PNG files or in the record with the run-length encoding
+        '''
+        if record["cam_name"] != cam_name or list(record["objects"].keys()) != [self.objectmap[node]['name'] for node in self.objectmap]:
+            return False
+        if not np.allclose(np.array(record["cam_pose"]), self.camposes[cam_name]):
+            return False
+        if record.get("inputs") != self._inputsBOP(cam_name):
+            return False
+        for node in self.objectmap:
+            name = self.objectmap[node]['name']
+            if np.allclose(np.array(record["objects"][name]), self.objectmap[node]['trans']):
+                continue
+            if name in record["visible"] or self._maybevisible(node, cam_name):
+                return False
+        if self.mask_format == "rle":
+            return record.get("masks") is not None
+        for obj_idx in range(len(self.objectmap)):
+            for folder in ["mask", "mask_visib"]:
+                if not os.path.exists(os.path.join(self.outputpath, folder, "{0:06d}_{1:06d}.png".format(idx ,obj_idx))):
+                    return False
+        return True
+
+    def _inputsBOP(self, cam_name):
+        ## everything besides the poses the outputs of a frame depend on, as it reads back from the json record
+        return {
+            "cam_K": self.intrinsic.flatten().tolist(),
+            "depth_scale": float(np.round(self.param.data['depth_scale'], 5)),
+            "lod_tolerance": self.lod_tolerance,
+            "models": {self.objectmap[node]["model"]: file_key(self.objectmap[node]["model"]) for node in self.objectmap},
+            "depth": file_key(os.path.join(self.datasrc, "depth", cam_name)),
+        }
+
+    def _maybevisible(self, node, cam_name):
+        ## conservative test: project the corners of the model bounding box into the image
+        visible, _ = self._cullnodes(cam_name)
+        return bool(visible[list(self.objectmap).index(node)])
 
     def _prepare_scene_BOP(self):
         self.objectmap = {}
@@ -268,15 +616,21 @@ class offlineRender:
                                             znear=0.05, zfar=100.0, name=None)
         self.nc = pyrender.Node(camera=cam, matrix=np.eye(4))
         self.scene.add_node(self.nc)
+        ## the instances of a model share one mesh
+        meshes = {}
         for obj_instancename in self.objects:
             ## for full model
             obj = obj_instancename.split(".")[0]
             if self.objects[obj_instancename]['type'] == 'normal':
-                tm = trimesh.load(os.path.join(self.modelsrc, obj, obj+".obj"))
-                mesh = pyrender.Mesh.from_trimesh(tm)
+                tm = load_mesh(os.path.join(self.modelsrc, obj, obj+".obj"))
+                if obj not in meshes:
+                    meshes[obj] = pyrender.Mesh.from_trimesh(tm)
+                mesh = meshes[obj]
                 node = pyrender.Node(mesh=mesh, matrix=self.objects[obj_instancename]['trans'])
-                self.objectmap[node] = {"index":self.object_label[obj], "name":obj_instancename , "trans":self.objects[obj_instancename ]['trans']}
+                self.objectmap[node] = {"index":self.object_label[obj], "name":obj_instancename , "trans":self.objects[obj_instancename ]['trans'], "bounds":tm.bounds,
+                                        "model":os.path.join(self.modelsrc, obj, obj+".obj"), "mesh":mesh}
                 self.scene.add_node(node)
+        self._prepare_segmentation()
 
     
     def _getbbx(self, mask):
@@ -292,66 +646,57 @@ class offlineRender:
     
     def renderYCBV(self):
         self._createpkg(self.outputpath)
-        for idx, cam_name in tqdm(enumerate(self.camposes)):
-            os.system('cp ' + os.path.join(self.datasrc, "rgb", cam_name) + ' ' + os.path.join(self.outputpath, "{0:06d}-color.png".format(idx)))
-            os.system('cp ' + os.path.join(self.datasrc, "depth", cam_name) + ' ' + os.path.join(self.outputpath, "{0:06d}-depth.png".format(idx)))
-            ## render
-            Axis_align = np.array([[1, 0, 0, 0],
-                               [0, -1, 0, 0],
-                               [0, 0, -1, 0],
-                               [0, 0, 0, 1],]
-            )
-            camT = self.camposes[cam_name].dot(Axis_align)
-            self.scene.set_pose(self.nc, pose=camT)
-            flags = pyrender.constants.RenderFlags.DEPTH_ONLY
-
-            segimg = np.zeros((self.param.camera["resolution"][1], self.param.camera["resolution"][0]), dtype=np.uint8)
-            vertmap = np.zeros((self.param.camera["resolution"][1], self.param.camera["resolution"][0]), dtype=np.float32)
-            for node in self.objectmap:
-                node.mesh.is_visible = True
-            full_depth = self.render.render(self.scene, flags = flags)
-
-            for node in self.objectmap:
-                node.mesh.is_visible = False
-            
-            ## create -label.txt
-            txtfile = open(os.path.join(self.outputpath, "{0:06d}-box.txt".format(idx)),"w+")
-            ## create -meta.mat
-            mat = {}
-            mat['cls_indexes'] = np.empty((0, 1), dtype = np.uint8)
-            mat['center'] = np.empty((0, 2))
-            mat['factor_depth'] = np.array([[np.around(1/self.param.data['depth_scale'])]], dtype = np.uint16)
-            mat['intrinsic_matrix'] = self.intrinsic
-            mat['poses'] = np.empty((3, 4, 0))
-            mat['rotation_translation_matrix'] = self.camposes[cam_name][:3, :]
-            for obj_idx, node in enumerate(self.objectmap):
-                node.mesh.is_visible = True
-                depth = self.render.render(self.scene, flags = flags)
-                mask = np.logical_and(
-                    (np.abs(depth - full_depth) < 1e-6), np.abs(full_depth) > 0
-                )
-                mask_visiable = (mask * 255).astype('uint8')
-                segimg[mask] = self.object_label[self.objectmap[node]["name"].split(".")[0]]
-                node.mesh.is_visible = False
-                if not self._getbbxycb(mask_visiable)[0]:
-                    continue
-                else:
-                    bbx = self._getbbxycb(mask_visiable)[1]
-                    txtfile.write(self.objectmap[node]["name"].split(".")[0] + f' {bbx[0]} {bbx[1]} {bbx[2]} {bbx[3]}\n')
-                    mat['cls_indexes'] = np.vstack((mat['cls_indexes'], np.array([[self.object_label[self.objectmap[node]["name"].split(".")[0]]]], dtype = np.uint8)))
-                    
-                    modelT = self.objectmap[node]["trans"]
-                    model_camT = np.linalg.inv(self.camposes[cam_name]).dot(modelT)
-                    center_homo = self.intrinsic @ model_camT[:3, 3]
-                    center = center_homo[:2]/center_homo[2]
-                    mat['center'] = np.vstack((mat['center'], center))
-                    mat['poses'] = np.concatenate((mat['poses'], model_camT[:3, :, np.newaxis]), axis = 2)
-                    pass
-
-            txtfile.close()
-            savemat(os.path.join(self.outputpath, "{0:06d}-meta.mat".format(idx)), mat)
-            segimg_pillow = Image.fromarray(segimg)
-            segimg_pillow.save(os.path.join(self.outputpath, "{0:06d}-label.png".format(idx)))
+        ## copy all the input frames in the background while rendering
+        copier = FrameCopier(self.copy_mode)
+        for idx, cam_name in enumerate(self.camposes):
+            copier.submit(os.path.join(self.datasrc, "rgb", cam_name), os.path.join(self.outputpath, "{0:06d}-color.png".format(idx)))
+            copier.submit(os.path.join(self.datasrc, "depth", cam_name), os.path.join(self.outputpath, "{0:06d}-depth.png".format(idx)))
+        with copier:
+            for _ in self._renderframes("_renderYCBVframe"):
+                pass
+
+    def _renderYCBVframe(self, idx, cam_name):
+        ## map instance id to the object label
+        label_lut = np.zeros(len(self.objectmap) + 1, dtype=np.uint8)
+        for obj_idx, node in enumerate(self.objectmap):
+            label_lut[obj_idx + 1] = self.object_label[self.objectmap[node]["name"].split(".")[0]]
+        ## render
+        camT = axis_align(self.camposes[cam_name])
+        visible, _ = self._cullnodes(cam_name)
+        self._selectlod(cam_name)
+        _, instance = self._render_instances(camT, visible)
+        segimg = label_lut[instance]
+        
+        ## create -label.txt
+        txtfile = open(os.path.join(self.outputpath, "{0:06d}-box.txt".format(idx)),"w+")
+        ## create -meta.mat
+        mat = {}
+        mat['cls_indexes'] = np.empty((0, 1), dtype = np.uint8)
+        mat['center'] = np.empty((0, 2))
+        mat['factor_depth'] = np.array([[np.around(1/self.param.data['depth_scale'])]], dtype = np.uint16)
+        mat['intrinsic_matrix'] = self.intrinsic
+        mat['poses'] = np.empty((3, 4, 0))
+        mat['rotation_translation_matrix'] = self.camposes[cam_name][:3, :]
+        visib_count, visib_bbox = visible_statistics(instance, len(self.objectmap))
+        for obj_idx, node in enumerate(self.objectmap):
+            if visib_count[obj_idx] == 0:
+                continue
+            else:
+                bbx = visib_bbox[obj_idx].tolist()
+                txtfile.write(self.objectmap[node]["name"].split(".")[0] + f' {bbx[0]} {bbx[1]} {bbx[2]} {bbx[3]}\n')
+                mat['cls_indexes'] = np.vstack((mat['cls_indexes'], np.array([[self.object_label[self.objectmap[node]["name"].split(".")[0]]]], dtype = np.uint8)))
+                
+                modelT = self.objectmap[node]["trans"]
+                model_camT = inverse(self.camposes[cam_name]).dot(modelT)
+                center_homo = self.intrinsic @ model_camT[:3, 3]
+                center = center_homo[:2]/center_homo[2]
+                mat['center'] = np.vstack((mat['center'], center))
+                mat['poses'] = np.concatenate((mat['poses'], model_camT[:3, :, np.newaxis]), axis = 2)
+                pass
+
+        txtfile.close()
+        savemat(os.path.join(self.outputpath, "{0:06d}-meta.mat".format(idx)), mat)
+        self.encoder.submit(segimg, os.path.join(self.outputpath, "{0:06d}-label.png".format(idx)))
 
     def _getbbxycb(self, mask):
         pixel_list = np.where(mask)
@@ -378,12 +723,7 @@ class offlineRender:
             os.path.join(self.datasrc, "depth", cam_name): path to the original depth
 
             Remember to use the following because the camera pose we use and the camera pose for pyrender have different coordinate system:
-            Axis_align = np.array([[1, 0, 0, 0],
-                                [0, -1, 0, 0],
-                                [0, 0, -1, 0],
-                                [0, 0, 0, 1],]
-            )
-            camT = self.camposes[cam_name].dot(Axis_align)
+            camT = axis_align(self.camposes[cam_name])  (kernel.pose_utility, flip the y and z axes of the camera)
 
         '''
         raise NotImplementedError
@@ -1,61 +1,213 @@
 import os
 import sys
 import time
+import numpy as np
+import trimesh
+from numba import njit
+from kernel.model_utility import save_model_arrays
 
-def split_obj(filepath):
-    with open(filepath) as f:
-        lines = f.readlines()
-    obj_files = []
-    o_index_list = [] 
-    index_l = 0
-    while index_l < len(lines):
-        l = lines[index_l]
-        if l[:2] == "o ":
-            o_index_list.append(index_l)
-        index_l += 1
-
-    o_index = 1
-    while o_index < len(o_index_list):
-        obj_files.append(lines[o_index_list[o_index - 1]:o_index_list[o_index]])
-        o_index += 1
-
-    obj_files.append(lines[o_index_list[-1]:])    
-    obj_start = lines[:o_index_list[0]]
-    total_v = 0
-    total_from_last = 0
-    for file in obj_files:
-        file_name = file[0][2:-1] + ".obj"
-        f = open(os.path.join(os.path.dirname(filepath), file_name), "w")
-        all_file = obj_start+file
-        for l in all_file:
-
-            if l[:2] == "v ":
-                total_v += 1
-                l_new = l
-            elif l[:2] == "f ":
-                point_pairs = l.split(" ")[1:]
-                l_new = "f "
-                for point_p in point_pairs:
-                    if "//" in point_p:
-                        p_num_pair = point_p.split("//")
-                        for p_num in p_num_pair:
-                            l_new += str(int(p_num) - total_from_last)
-                            l_new += "//"
-                        l_new = l_new[:-2]
-                        l_new += " "
-                    elif "/" in point_p:
-                        p_num_pair = point_p.split("/")
-                        for p_num in p_num_pair:
-                            l_new += str(int(p_num) - total_from_last)
-                            l_new += "/"
-                        l_new = l_new[:-2]
-                        l_new += " "                            
-
-                l_new = l_new[:-1]
-                l_new += "\n" 
+## buffer size of the reader and of the writer of every object, the face lines are rebased in blocks of about this size
+BUFFER_SIZE = 1 << 20
+
+
+@njit(cache=True)
+def _write_int(out, n_out, value):
+    if value < 0:
+        out[n_out] = 45
+        n_out += 1
+        value = -value
+    start = n_out
+    while True:
+        out[n_out] = 48 + value % 10
+        n_out += 1
+        value //= 10
+        if value == 0:
+            break
+    ## the digits were written from the least significant one
+    end = n_out - 1
+    while start < end:
+        out[start], out[end] = out[end], out[start]
+        start += 1
+        end -= 1
+    return n_out
+
+
+@njit(cache=True)
+def _rebase_elements(text, bases, num_vertices, out, indices, sizes):
+    """
+    Rebase the v, v/vt, v//vn and v/vt/vn indices of a block of f/l/p lines on the first v, vt and vn of the object,
+    negative (relative) indices are kept as they are.
+    The vertex indices of the faces are also written into indices, 0-based in the object, and their number into sizes
+    Returns:
+        n_out: number of bytes written into out
+        n_indices: number of vertex indices
+        n_faces: number of faces
+    """
+    n_out = 0
+    n_indices = 0
+    n_faces = 0
+    slot = 0
+    face = False
+    line_start = True
+    comment = False
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if line_start:
+            face = c == 102 # f
+            if face:
+                sizes[n_faces] = 0
+                n_faces += 1
+            line_start = False
+        if c == 10: # \n
+            line_start = True
+            comment = False
+            slot = 0
+        elif comment:
+            pass
+        elif c == 35: # #
+            comment = True
+        elif c == 47: # /
+            slot += 1
+        elif c == 32 or c == 9 or c == 13:
+            slot = 0
+        elif (c >= 48 and c <= 57) or c == 45:
+            sign = 1
+            if c == 45:
+                sign = -1
+                i += 1
+            value = 0
+            while i < n and text[i] >= 48 and text[i] <= 57:
+                value = value * 10 + text[i] - 48
+                i += 1
+            value *= sign
+            if value > 0 and slot < 3:
+                n_out = _write_int(out, n_out, value - bases[slot])
+            else:
+                n_out = _write_int(out, n_out, value)
+            if face and slot == 0:
+                indices[n_indices] = value - 1 - bases[0] if value > 0 else num_vertices + value
+                n_indices += 1
+                sizes[n_faces - 1] += 1
+            continue
+        out[n_out] = c
+        n_out += 1
+        i += 1
+    return n_out, n_indices, n_faces
+
+
+def _fan_triangles(indices, sizes):
+    ## polygons with more than 3 vertices are split in a fan around their first vertex
+    sizes = sizes[sizes >= 3]
+    starts = np.cumsum(sizes) - sizes
+    num_triangles = sizes - 2
+    first = np.repeat(starts, num_triangles)
+    second = first + 1 + np.arange(num_triangles.sum()) - np.repeat(np.cumsum(num_triangles) - num_triangles, num_triangles)
+    return np.stack([indices[first], indices[second], indices[second + 1]], axis = 1)
+
+
+class _ObjectWriter:
+    """
+    Buffered writer of one "o" group, optionally collecting the vertices and triangles of the binary mesh
+    """
+    def __init__(self, path, header, name_line, bases, BINARY = False):
+        self.path = path
+        self.f = open(path, "wb", buffering = BUFFER_SIZE)
+        self.f.writelines(header)
+        self.f.write(name_line)
+        ## counts of v, vt and vn before the object
+        self.bases = np.array(bases, dtype = np.int64)
+        self.BINARY = BINARY
+        self.vertices = []
+        self.triangles = []
+        self.elements = []
+        self.elements_size = 0
+
+    def vertex(self, line):
+        self.flush()
+        self.f.write(line)
+        if self.BINARY:
+            self.vertices.append(line[2:])
+
+    def line(self, line):
+        self.flush()
+        self.f.write(line)
+
+    def element(self, line):
+        self.elements.append(line)
+        self.elements_size += len(line)
+        if self.elements_size >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.elements) == 0:
+            return
+        text = np.frombuffer(b"".join(self.elements), dtype = np.uint8)
+        ## a rebased index is at most one byte longer than the original one (the sign)
+        out = np.empty(2 * len(text), dtype = np.uint8)
+        indices = np.empty(len(text), dtype = np.int64)
+        sizes = np.empty(len(self.elements), dtype = np.int64)
+        n_out, n_indices, n_faces = _rebase_elements(text, self.bases, len(self.vertices), out, indices, sizes)
+        self.f.write(out[:n_out].tobytes())
+        if self.BINARY:
+            self.triangles.append(_fan_triangles(indices[:n_indices], sizes[:n_faces]))
+        self.elements = []
+        self.elements_size = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        if self.BINARY:
+            vertices = np.array(b" ".join(self.vertices).split(), dtype = np.float32).reshape(len(self.vertices), -1)[:, :3]
+            faces = np.concatenate(self.triangles + [np.empty((0, 3), dtype = np.int64)])
+            ## processed like trimesh.load does for kernel.model_utility.load_model_arrays
+            tm = trimesh.Trimesh(vertices = vertices, faces = faces)
+            save_model_arrays(self.path, tm.vertices, tm.faces, tm.vertex_normals)
+        print("Successfully split {0}".format(os.path.basename(self.path)))
+
+
+def split_obj(filepath, BINARY = False):
+    """
+    Split an obj file into one obj file per "o" group, written next to the input and named after the group,
+    in a single streaming pass.
+    The lines before the first "o" (mtllib, comments) are copied into every object file, the face, line and point
+    indices are rebased on separate v, vt and vn counters.
+    Args:
+        filepath: path of the obj file
+        BINARY: also write the binary cache entry (kernel.model_utility) of every object file, with the fan triangulated faces,
+                so the renderers do not parse the new obj files again
+    """
+    header = []
+    writer = None
+    ## running counts of v, vt and vn of the whole file
+    counts = [0, 0, 0]
+    with open(filepath, "rb", buffering = BUFFER_SIZE) as f:
+        for line in f:
+            key = line[:2]
+            if key == b"f " or key == b"l " or key == b"p ":
+                if writer is not None:
+                    writer.element(line)
+            elif key == b"v ":
+                counts[0] += 1
+                if writer is not None:
+                    writer.vertex(line)
+            elif line[:3] == b"vt ":
+                counts[1] += 1
+                if writer is not None:
+                    writer.line(line)
+            elif line[:3] == b"vn ":
+                counts[2] += 1
+                if writer is not None:
+                    writer.line(line)
+            elif key == b"o ":
+                if writer is not None:
+                    writer.close()
+                file_name = line[2:].strip().decode("utf-8") + ".obj"
+                writer = _ObjectWriter(os.path.join(os.path.dirname(filepath), file_name), header, line, counts, BINARY = BINARY)
+            elif writer is None:
+                header.append(line)
             else:
-                l_new = l
-            f.write(l_new)
-        print("Successfully split {0}".format(file_name))
-        f.close()
-        total_from_last = total_v
+                writer.line(line)
+    if writer is not None:
+        writer.close()
@@ -19,7 +19,8 @@ from kernel.blender_utility import \
     _get_configuration, _get_reconstruction_insameworkspace, _get_obj_insameworkspace, _get_workspace_name, _apply_trans2obj, \
     _align_reconstruction
 from registeration.init_configuration import config
-from kernel.utility import _trans2transstring,  _parse_camfile, _select_sample_files
+from kernel.utility import _trans2transstring, _select_sample_files
+from kernel.campose_utility import read_campose
 from kernel.blender_utility import _is_progresslabeller_object, _initreconpose, _get_obj_insameworkspace
 from panel.FloatScreenPanel import draw_for_area
 import registeration.register 
@@ -219,8 +220,7 @@ class ImportReconResult(Operator):
             return {'FINISHED'}
         else:
             camera_rgb_file = os.path.join(config.reconstructionsrc, "campose.txt")  
-            camera_lines = _parse_camfile(camera_rgb_file)
-            self.total_cam_num = len(camera_lines)
+            self.total_cam_num = len(read_campose(camera_rgb_file))
             return context.window_manager.invoke_props_dialog(self, width = 400)
 
     def draw(self, context):